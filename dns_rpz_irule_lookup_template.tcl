@@ -0,0 +1,64 @@
+when DNS_REQUEST {
+    # set query_name
+    set query_name [DNS::question name]
+
+    # white list check
+    if { [class match $query_name ends_with white_Domains] } {
+        return
+    }
+
+    # black list check
+    if { [class match $query_name ends_with blacklist_Domains] } {
+        if { [DNS::question type] equals "A"} {
+            DNS::answer insert "$query_name. 600 [DNS::question class] [DNS::question type] 34.102.218.71"
+            DNS::return
+        } elseif {[DNS::question type] equals "AAAA" } {
+            DNS::answer insert "$query_name. 600 [DNS::question class] [DNS::question type] 2600:1901:0:9b4c::"
+            DNS::return
+        }
+    }
+
+    # START_DG_IP_MAP_BLOCK
+set rpz_lookup_dg "rpz_blacklist_fqdn_kv"
+set rpz_lookup_delta_dg "rpz_blacklist_fqdn_kv_delta"
+    # END_DG_IP_MAP_BLOCK
+    # exact name first, then each .suffix from longest to shortest (wildcard keys)
+    # one class lookup per label instead of one per landing IP data group
+    # the delta data group holds small updates on top of the external one; "-" marks a removed key
+    set lookup_name [string tolower $query_name]
+    set candidate $lookup_name
+    set pos [string first "." $lookup_name]
+    while { 1 } {
+        if { $rpz_lookup_delta_dg ne "" && [class match $candidate equals $rpz_lookup_delta_dg] } {
+            set action [class match -value $candidate equals $rpz_lookup_delta_dg]
+            if { $action eq "-" } {
+                set action ""
+            }
+        } else {
+            set action [class match -value $candidate equals $rpz_lookup_dg]
+        }
+        if { $action ne "" || $pos < 0 } {
+            break
+        }
+        set candidate [string range $lookup_name $pos end]
+        set pos [string first "." $lookup_name [expr {$pos + 1}]]
+    }
+    if { $action eq "" || $action eq "passthru" } {
+        return
+    }
+    if { $action eq "nxdomain" } {
+        DNS::answer clear
+        DNS::header rcode NXDOMAIN
+        DNS::return
+    }
+    if { ([DNS::question type] eq "A" && ![string match "*:*" $action] && $action ne "nodata") ||
+         ([DNS::question type] eq "AAAA" && [string match "*:*" $action]) } {
+        DNS::answer clear
+        DNS::answer insert "$query_name. 30 [DNS::question class] [DNS::question type] $action"
+        DNS::return
+    } else {
+        DNS::answer clear
+        DNS::answer insert "$query_name. 30 IN SOA ns.rpz.local. admin.rpz.local. 2023010101 3600 600 86400 30"
+        DNS::return
+    }
+}
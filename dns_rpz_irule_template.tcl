@@ -20,17 +20,18 @@ when DNS_REQUEST {
 
     # START_DG_IP_MAP_BLOCK
 set dg_ip_map {
-    "phishtw_182_173_0_170" "182.173.0.170"
-    "rpztw_112_121_114_76" "112.121.114.76"
-    "rpztw_182_173_0_181" "182.173.0.181"
-    "rpztw_210_64_24_25" "210.64.24.25"
-    "rpztw_210_69_155_3" "210.69.155.3"
-    "rpztw_34_102_218_71" "34.102.218.71"
-    "rpztw_35_206_236_238" "35.206.236.238"
+    "phishtw_182_173_0_170" "182.173.0.170" "phishtw_182_173_0_170_delta"
+    "rpztw_112_121_114_76" "112.121.114.76" "rpztw_112_121_114_76_delta"
+    "rpztw_182_173_0_181" "182.173.0.181" "rpztw_182_173_0_181_delta"
+    "rpztw_210_64_24_25" "210.64.24.25" "rpztw_210_64_24_25_delta"
+    "rpztw_210_69_155_3" "210.69.155.3" "rpztw_210_69_155_3_delta"
+    "rpztw_34_102_218_71" "34.102.218.71" "rpztw_34_102_218_71_delta"
+    "rpztw_35_206_236_238" "35.206.236.238" "rpztw_35_206_236_238_delta"
 }
     # END_DG_IP_MAP_BLOCK
-    foreach {dg ip} $dg_ip_map {
-        if { [class match $query_name ends_with $dg] } {
+    # delta_dg holds domains added since the external data group was last reloaded ("" when unused)
+    foreach {dg ip delta_dg} $dg_ip_map {
+        if { [class match $query_name ends_with $dg] || ($delta_dg ne "" && [class match $query_name ends_with $delta_dg]) } {
             if { [DNS::question type] eq "A" } {
                 DNS::answer clear
                 DNS::answer insert "$query_name. 30 [DNS::question class] [DNS::question type] $ip"
@@ -18,11 +18,18 @@ import re # 用於 iRule 修改
 from datetime import datetime
 import requests
 import json
+import shlex
+import hashlib
+import concurrent.futures
+import contextlib
+import threading
+import bisect
+from collections import deque
 
 # --- 設定日誌 ---
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s',
     handlers=[
         logging.FileHandler("f5_updater.log", encoding='utf-8'),
         logging.StreamHandler(sys.stdout)
@@ -42,13 +49,39 @@ DEFAULT_KNOWN_LANDING_IPS = {
 PHISHTW_ZONE_NAME = "phishtw."
 PHISHTW_LANDING_IP = "182.173.0.170"
 HTTP_SERVER = "10.8.38.223:8080" # 腳本執行機的 IP，用於 F5 下載
-UPDATE_INTERVAL_SECONDS = 5 * 60
+UPDATE_INTERVAL_SECONDS = 5 * 60 # 未訂閱或無法連線轉換器時的定期更新間隔 (秒)
+ENABLE_GENERATION_SUBSCRIBE = True # 以長輪詢訂閱轉換器的輸出 generation，只在轉換器發布新檔案時推送
+CONVERTER_GENERATION_URL = f"http://{HTTP_SERVER}/_generation" # rpz_converter.py 的 generation 長輪詢端點
+GENERATION_POLL_TIMEOUT = 60 # 單次長輪詢等待秒數 (需不大於轉換器的 GENERATION_POLL_MAX_WAIT)
+FALLBACK_UPDATE_INTERVAL_SECONDS = 60 * 60 # 訂閱模式下即使沒有新 generation 也執行一次完整更新的間隔 (秒)，作為安全網
 LOCAL_MASTER_IRULE_FILE = "/opt/rpz_project/dns_rpz_irule_template.tcl"
 TARGET_IRULE_NAME_ON_F5 = "rpz_fqdn_v10"
 IRULE_DG_MAP_START_MARKER = "# START_DG_IP_MAP_BLOCK"
 IRULE_DG_MAP_END_MARKER = "# END_DG_IP_MAP_BLOCK"
+DATAGROUP_SHARD_COUNT = 1 # 每個 Landing IP 域名列表的分片數 (<zone>_<ip>_s<k>)，需與 rpz_converter.py 相同；每個分片各自為一個 Data Group 並列入 dg_ip_map
+IRULE_LOOKUP_MODE = "dg_ip_map" # "dg_ip_map": 每個 Landing IP 一個 Data Group，iRule 逐一 class match ends_with；"suffix_lookup": 單一合併 Data Group，iRule 依標籤後綴以 class match -value 查詢
+LOCAL_LOOKUP_IRULE_FILE = "/opt/rpz_project/dns_rpz_irule_lookup_template.tcl" # suffix_lookup 模式使用的 iRule 範本
+FQDN_LOOKUP_DATAGROUP_NAME = "rpz_blacklist_fqdn_kv" # suffix_lookup 模式使用的合併 Key/Value Data Group (由 rpz_converter.py 產生)
 ENABLE_IRULE_AUTO_UPDATE = True
 MANAGE_RPZIP_BLACKLIST = False
+MAX_CONCURRENT_DEVICES = 8 # 同時更新的 F5 設備數量上限
+ENABLE_TMSH_BATCH = True # 以單一 tmsh 交易送出同一設備的所有 Data Group 操作 (False 則每個操作各自執行 tmsh)
+TMSH_BATCH_TIMEOUT = 300 # 批次 tmsh 交易的逾時 (秒)
+TMSH_DATAGROUP_LINE_PATTERN = re.compile(r'^(ltm data-group external|ltm data-group internal|sys file data-group) (\S+) \{(.*)\}$')
+TMSH_PROPERTY_PATTERN = re.compile(r'\b(type|external-file-name|source-path) (\S+)')
+LOCAL_DATAGROUP_DIR = "f5_datagroups" # rpz_converter.py 的輸出目錄 (與 HTTP 伺服器提供的檔案相同)
+ENABLE_DELTA_UPDATES = True # 字串 Data Group 小幅變更時只更新對應的 internal 覆蓋 Data Group (<名稱>_delta) 的記錄，不重新載入整個 external Data Group
+DELTA_DATAGROUP_SUFFIX = "_delta" # 覆蓋 Data Group 名稱的後綴 (iRule 同時查詢 external Data Group 與其覆蓋 Data Group)
+DELTA_DIR_NAME = "deltas" # rpz_converter.py 產生的差異檔目錄 (位於 LOCAL_DATAGROUP_DIR 下)
+DELTA_MAX_CHANGE_RATIO = 0.01 # 覆蓋記錄數超過 external Data Group 記錄數的此比例時，改為完整重新載入並清空覆蓋
+DELTA_MAX_RECORDS = 2000 # 覆蓋 Data Group 的記錄數上限 (internal Data Group 存於設備設定中，不宜過大)
+OVERLAY_RECORD_PATTERN = re.compile(r'^[A-Za-z0-9._*:-]+$') # 可直接寫入 tmsh records 的鍵與值，其他字元的條目改為完整重新載入
+OUTPUT_MANIFEST_FILE = "manifest.json" # rpz_converter.py 在輸出目錄中產生的清單檔 (檔案雜湊、大小與記錄數)
+DEVICE_STATE_FILE = "f5_device_state.json" # 記錄各設備上次成功推送的 Data Group 內容雜湊與 iRule 雜湊
+LATENCY_HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # 操作延遲直方圖的區間上限 (秒)，超過最後一個區間計入 +Inf
+LATENCY_HISTOGRAM_WINDOW = 12 # 滾動直方圖涵蓋的最近週期數 (5 分鐘間隔約為 1 小時)
+TIMING_REPORT_FILE = "f5_updater_timing.jsonl" # 每個週期的設備操作延遲報告 (每行一個週期的 JSON)，設為 None 則只寫入日誌
+SLOWEST_OPERATIONS_TO_REPORT = 5 # 週期報告中列出最慢的 tmsh 操作數量
 
 try:
     import urllib3
@@ -56,9 +89,138 @@ try:
 except ImportError:
     logger.warning("urllib3 未安裝，無法禁用 InsecureRequestWarning。")
 F5_API_VERIFY_SSL = False
+ENABLE_PERSISTENT_CONNECTIONS = True # 跨週期保留每台設備的 SSH 連線與 HTTPS 工作階段 (False 則每個週期結束時關閉)
+SSH_CONNECT_TIMEOUT = 20 # SSH 連線逾時 (秒)
+SSH_KEEPALIVE_INTERVAL = 30 # SSH keepalive 封包間隔 (秒)，避免閒置連線在兩個週期之間被防火牆或設備切斷
+F5_API_TOKEN_AUTH = True # iControl REST 以 /mgmt/shared/authn/login 取得的 token 認證 (False 或登入失敗時每次以 Basic Auth)
+F5_API_LOGIN_PROVIDER = "tmos" # token 登入使用的 loginProviderName
+F5_API_TOKEN_REFRESH_MARGIN = 60 # token 到期前多少秒即重新登入
+F5_API_TIMEOUT = 60 # iControl REST 請求逾時 (秒)
+
+# --- 操作延遲記錄 ---
+operation_timings = {} # 本週期: 設備名稱 -> [{'operation', 'target', 'seconds', 'bytes_sent', 'success'}]
+operation_timings_lock = threading.Lock() # 各設備在不同執行緒中更新，寫入 operation_timings 時需加鎖
+latency_history = deque(maxlen=LATENCY_HISTOGRAM_WINDOW) # 最近各週期的直方圖: "設備|操作" -> {'buckets': [...], 'count', 'sum'}
+
+# --- 設備連線 ---
+device_connections = {} # 設備名稱 -> DeviceConnection，跨週期重複使用
+device_connections_lock = threading.Lock()
 
 # --- 函數定義 ---
 
+def record_operation(device_name, operation, seconds, bytes_sent=0, target=None, success=True):
+    """記錄單一設備操作的延遲 (秒) 與送出的 bytes"""
+    entry = {'operation': operation, 'target': target, 'seconds': round(seconds, 4),
+             'bytes_sent': bytes_sent, 'success': success}
+    with operation_timings_lock:
+        operation_timings.setdefault(device_name, []).append(entry)
+
+@contextlib.contextmanager
+def timed_operation(device_name, operation, target=None, bytes_sent=0):
+    """量測 with 區塊的耗時並記錄為設備操作；區塊內可將 yield 的 dict 的 'success' 設為 False，發生例外時自動視為失敗"""
+    result = {'success': True}
+    started = time.perf_counter()
+    try:
+        yield result
+    except BaseException:
+        result['success'] = False
+        raise
+    finally:
+        record_operation(device_name, operation, time.perf_counter() - started, bytes_sent, target, result['success'])
+
+def tmsh_command_target(command):
+    """取出 tmsh 命令操作的物件名稱 (/Common/<名稱>)，用於找出哪個 Data Group 較慢"""
+    match = re.search(r'/Common/(\S+)', command)
+    return match.group(1) if match else None
+
+def latency_histogram(durations):
+    """將延遲列表依 LATENCY_HISTOGRAM_BUCKETS 計數，最後一格為 +Inf"""
+    buckets = [0] * (len(LATENCY_HISTOGRAM_BUCKETS) + 1)
+    for seconds in durations:
+        buckets[bisect.bisect_left(LATENCY_HISTOGRAM_BUCKETS, seconds)] += 1
+    return {'buckets': buckets, 'count': len(durations), 'sum': round(sum(durations), 4)}
+
+def format_histogram(histogram):
+    """將直方圖轉為日誌用的精簡文字，只列出有計數的區間"""
+    labels = [f"≤{bound}s" for bound in LATENCY_HISTOGRAM_BUCKETS] + [f">{LATENCY_HISTOGRAM_BUCKETS[-1]}s"]
+    parts = [f"{label} {count}" for label, count in zip(labels, histogram['buckets']) if count]
+    return f"{', '.join(parts)} (共 {histogram['count']} 次，平均 {histogram['sum'] / histogram['count']:.3f} 秒)"
+
+def report_operation_timings(cycle_started_at):
+    """
+    彙整本週期各設備的操作延遲：每台設備的連線、tmsh、iRule PATCH 耗時與送出的 bytes，最慢的 tmsh 操作，
+    並更新最近 LATENCY_HISTOGRAM_WINDOW 個週期的滾動直方圖。報告寫入日誌與 TIMING_REPORT_FILE。
+    """
+    with operation_timings_lock:
+        timings = {name: list(entries) for name, entries in operation_timings.items()}
+        operation_timings.clear()
+    if not timings:
+        return None
+
+    devices = {}
+    cycle_durations = {}
+    for device_name, entries in sorted(timings.items()):
+        summary = {'connect_seconds': 0, 'tmsh_commands': 0, 'tmsh_seconds': 0, 'tmsh_max_seconds': 0,
+                   'irule_patch_seconds': 0, 'bytes_sent': 0, 'failed_operations': 0, 'total_seconds': 0}
+        for entry in entries:
+            operation, seconds = entry['operation'], entry['seconds']
+            summary['bytes_sent'] += entry['bytes_sent']
+            if not entry['success']:
+                summary['failed_operations'] += 1
+            if operation == 'device_total':
+                summary['total_seconds'] = seconds
+                continue
+            if operation == 'ssh_connect':
+                summary['connect_seconds'] += seconds
+            elif operation == 'irule_patch':
+                summary['irule_patch_seconds'] += seconds
+            elif operation.startswith('tmsh'):
+                summary['tmsh_commands'] += 1
+                summary['tmsh_seconds'] += seconds
+                summary['tmsh_max_seconds'] = max(summary['tmsh_max_seconds'], seconds)
+            cycle_durations.setdefault(f"{device_name}|{operation}", []).append(seconds)
+        devices[device_name] = {key: round(value, 4) if isinstance(value, float) else value for key, value in summary.items()}
+        logger.info(f"[延遲] {device_name}: 總計 {summary['total_seconds']:.2f} 秒，SSH 連線 {summary['connect_seconds']:.2f} 秒，"
+                    f"tmsh {summary['tmsh_commands']} 個命令共 {summary['tmsh_seconds']:.2f} 秒 (最長 {summary['tmsh_max_seconds']:.2f} 秒)，"
+                    f"iRule PATCH {summary['irule_patch_seconds']:.2f} 秒，送出 {summary['bytes_sent']} bytes，"
+                    f"失敗操作 {summary['failed_operations']} 個")
+
+    slowest = sorted(((entry['seconds'], device_name, entry['operation'], entry['target'])
+                      for device_name, entries in timings.items() for entry in entries
+                      if entry['operation'].startswith('tmsh')), reverse=True)[:SLOWEST_OPERATIONS_TO_REPORT]
+    for seconds, device_name, operation, target in slowest:
+        logger.info(f"[延遲] 最慢的 tmsh 操作: {device_name} {operation} {target or ''} {seconds:.2f} 秒")
+
+    latency_history.append({key: latency_histogram(durations) for key, durations in cycle_durations.items()})
+    rolling = {}
+    for cycle_histograms in latency_history:
+        for key, histogram in cycle_histograms.items():
+            merged = rolling.setdefault(key, {'buckets': [0] * len(histogram['buckets']), 'count': 0, 'sum': 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+            merged['count'] += histogram['count']
+            merged['sum'] = round(merged['sum'] + histogram['sum'], 4)
+    for key, histogram in sorted(rolling.items()):
+        device_name, operation = key.split('|', 1)
+        logger.info(f"[延遲直方圖 最近 {len(latency_history)} 個週期] {device_name} {operation}: {format_histogram(histogram)}")
+
+    report = {
+        'cycle_started_at': cycle_started_at,
+        'devices': devices,
+        'slowest_tmsh_operations': [{'device': device_name, 'operation': operation, 'target': target, 'seconds': seconds}
+                                    for seconds, device_name, operation, target in slowest],
+        'histogram_buckets': list(LATENCY_HISTOGRAM_BUCKETS),
+        'rolling_histogram_cycles': len(latency_history),
+        'rolling_histogram': rolling,
+        'operations': timings,
+    }
+    if TIMING_REPORT_FILE:
+        try:
+            with open(TIMING_REPORT_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(report, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"寫入延遲報告 {TIMING_REPORT_FILE} 時發生錯誤: {e}")
+    return report
+
 def create_f5_devices_file_example():
     if os.path.exists(F5_DEVICES_FILE):
         logger.debug(f"文件 {F5_DEVICES_FILE} 已存在。")
@@ -148,6 +310,12 @@ def load_landing_ips():
              logger.error(f"設定的 PHISHTW_LANDING_IP ({PHISHTW_LANDING_IP}) 不是有效的 IP 地址。")
     return ips
 
+def domain_list_names(name_base):
+    """Landing IP 域名列表的檔名 (不含 .txt)；DATAGROUP_SHARD_COUNT 大於 1 時為各分片的檔名"""
+    if DATAGROUP_SHARD_COUNT > 1:
+        return [f"{name_base}_s{shard}" for shard in range(DATAGROUP_SHARD_COUNT)]
+    return [name_base]
+
 def generate_datagroup_management_list():
     datagroups_to_manage = []
     irule_map_entries = []
@@ -155,27 +323,35 @@ def generate_datagroup_management_list():
     fqdn_zones = read_file_lines(FQDN_ZONE_LIST_FILE)
     ip_zones = read_file_lines(IP_ZONE_LIST_FILE)
 
+    if IRULE_LOOKUP_MODE == "suffix_lookup":
+        # 所有 FQDN zone 合併為單一 Key/Value Data Group，不再需要各 Landing IP 的域名列表 Data Group
+        if fqdn_zones:
+            file_url = f"http://{HTTP_SERVER}/{FQDN_LOOKUP_DATAGROUP_NAME}.txt"
+            datagroups_to_manage.append({'name': FQDN_LOOKUP_DATAGROUP_NAME.replace('-', '_'), 'file_url': file_url, 'type': 'string',
+                                         'delta_mode': 'kv'})
+        fqdn_zones = []
+
     for zone in fqdn_zones:
         zone_prefix = zone.rstrip('.').replace('.', '_')
         if zone == PHISHTW_ZONE_NAME:
             if PHISHTW_LANDING_IP:
                 ip = PHISHTW_LANDING_IP
                 ip_filename_part = ip.replace('.', '_')
-                dg_name_base = f"{zone_prefix}_{ip_filename_part}"
-                dg_name_on_f5 = dg_name_base.replace('-', '_')
-                file_url = f"http://{HTTP_SERVER}/{dg_name_base}.txt"
-                datagroups_to_manage.append({'name': dg_name_on_f5, 'file_url': file_url, 'type': 'string'})
-                irule_map_entries.append((dg_name_on_f5, ip))
+                for dg_name_base in domain_list_names(f"{zone_prefix}_{ip_filename_part}"):
+                    dg_name_on_f5 = dg_name_base.replace('-', '_')
+                    file_url = f"http://{HTTP_SERVER}/{dg_name_base}.txt"
+                    datagroups_to_manage.append({'name': dg_name_on_f5, 'file_url': file_url, 'type': 'string', 'delta_mode': 'ends_with'})
+                    irule_map_entries.append((dg_name_on_f5, ip))
         else:
             for ip in landing_ips:
                 if ip == PHISHTW_LANDING_IP and zone != PHISHTW_ZONE_NAME:
                     continue
                 ip_filename_part = ip.replace('.', '_')
-                dg_name_base = f"{zone_prefix}_{ip_filename_part}"
-                dg_name_on_f5 = dg_name_base.replace('-', '_')
-                file_url = f"http://{HTTP_SERVER}/{dg_name_base}.txt"
-                datagroups_to_manage.append({'name': dg_name_on_f5, 'file_url': file_url, 'type': 'string'})
-                irule_map_entries.append((dg_name_on_f5, ip))
+                for dg_name_base in domain_list_names(f"{zone_prefix}_{ip_filename_part}"):
+                    dg_name_on_f5 = dg_name_base.replace('-', '_')
+                    file_url = f"http://{HTTP_SERVER}/{dg_name_base}.txt"
+                    datagroups_to_manage.append({'name': dg_name_on_f5, 'file_url': file_url, 'type': 'string', 'delta_mode': 'ends_with'})
+                    irule_map_entries.append((dg_name_on_f5, ip))
 
     for zone in ip_zones:
         zone_prefix = zone.rstrip('.').replace('.', '_')
@@ -196,17 +372,23 @@ def generate_datagroup_management_list():
     logger.info(f"iRule 的 dg_ip_map 將包含 {len(irule_map_entries)} 個條目。")
     return datagroups_to_manage, irule_map_entries
 
-def execute_tmsh_command(ssh_client, command, device_name):
+def execute_tmsh_command(ssh_client, command, device_name, log_output=True, operation=None):
     full_command = f"tmsh {command}"
     logger.info(f"在 {device_name} 上執行 (TMSH): {command}")
+    operation = operation or f"tmsh_{command.split(' ', 1)[0]}"
     try:
-        stdin, stdout, stderr = ssh_client.exec_command(full_command, timeout=60)
-        exit_status = stdout.channel.recv_exit_status()
-        output = stdout.read().decode('utf-8', errors='ignore').strip()
-        error = stderr.read().decode('utf-8', errors='ignore').strip()
+        with timed_operation(device_name, operation, tmsh_command_target(command), len(full_command.encode('utf-8'))) as timing:
+            stdin, stdout, stderr = ssh_client.exec_command(full_command, timeout=60)
+            exit_status = stdout.channel.recv_exit_status()
+            output = stdout.read().decode('utf-8', errors='ignore').strip()
+            error = stderr.read().decode('utf-8', errors='ignore').strip()
+            timing['success'] = exit_status == 0
 
         if exit_status == 0:
-            logger.info(f"TMSH 命令成功 on {device_name}: {output if output else '無輸出'}")
+            if log_output:
+                logger.info(f"TMSH 命令成功 on {device_name}: {output if output else '無輸出'}")
+            else:
+                logger.info(f"TMSH 命令成功 on {device_name} (輸出 {len(output.splitlines())} 行)")
             return True, output, ""
         else:
             logger.error(f"TMSH 命令失敗 on {device_name} (Exit Status: {exit_status}): {command}")
@@ -263,15 +445,511 @@ def ensure_datagroup_exists_on_f5(ssh_client, device_name, dg_name, dg_type, fil
     
     return False
 
-def generate_irule_dg_map_tcl_block(irule_map_entries):
+def fetch_datagroup_inventory(ssh_client, device_name):
+    """
+    以單次 tmsh 查詢取得設備上所有 external Data Group 及其 sys file 的 source-path，
+    回傳 {名稱: {'type': ..., 'source_path': ...}}，失敗時回傳 None。
+    ENABLE_DELTA_UPDATES 啟用時一併列出 internal Data Group ({'type': ..., 'internal': True})，用於判斷覆蓋 Data Group 是否存在。
+    """
+    queries = ["list ltm data-group external one-line", "list sys file data-group one-line"]
+    if ENABLE_DELTA_UPDATES:
+        queries.append("list ltm data-group internal one-line")
+    command = "-c " + shlex.quote("; ".join(queries))
+    success, output, error = execute_tmsh_command(ssh_client, command, device_name, log_output=False, operation="tmsh_inventory")
+    if not success:
+        logger.warning(f"無法取得 {device_name} 上的 Data Group 清單，將改為逐一檢查。錯誤: {error}")
+        return None
+    datagroups = {}
+    internal = {}
+    source_paths = {}
+    for line in output.splitlines():
+        match = TMSH_DATAGROUP_LINE_PATTERN.match(line.strip())
+        if not match:
+            continue
+        kind, name, properties = match.groups()
+        name = name[len("/Common/"):] if name.startswith("/Common/") else name
+        props = dict(TMSH_PROPERTY_PATTERN.findall(properties))
+        if kind == "ltm data-group external":
+            file_name = props.get('external-file-name', name)
+            file_name = file_name[len("/Common/"):] if file_name.startswith("/Common/") else file_name
+            datagroups[name] = {'type': props.get('type'), 'file_name': file_name}
+        elif kind == "ltm data-group internal":
+            internal[name] = {'type': props.get('type'), 'internal': True}
+        else:
+            source_paths[name] = props.get('source-path')
+    inventory = {}
+    for name, info in datagroups.items():
+        inventory[name] = {'type': info['type'], 'source_path': source_paths.get(info['file_name'])}
+    logger.info(f"{device_name} 上目前共有 {len(inventory)} 個 external Data Group。")
+    for name, info in internal.items():
+        inventory.setdefault(name, info)
+    return inventory
+
+def load_output_manifest():
+    """讀取 rpz_converter.py 在輸出目錄產生的清單檔，回傳 {檔名: 清單條目}，不存在或無法讀取時回傳空字典"""
+    manifest_path = os.path.join(LOCAL_DATAGROUP_DIR, OUTPUT_MANIFEST_FILE)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"讀取輸出清單 {manifest_path} 失敗，將自行計算檔案雜湊: {e}")
+        return {}
+
+def compute_datagroup_hashes(datagroups):
+    """
+    取得本地 Data Group 檔案 (LOCAL_DATAGROUP_DIR) 的 SHA-256，寫入每個 dg_info 的 'content_hash'。
+    優先使用轉換器輸出清單中的雜湊與記錄數 ('records'，檔案大小與修改時間相符時)，清單中沒有的檔案才自行計算雜湊。
+    """
+    manifest_files = load_output_manifest()
+    missing = 0
+    for dg_info in datagroups:
+        file_name = dg_info['file_url'].rsplit('/', 1)[-1]
+        file_path = os.path.join(LOCAL_DATAGROUP_DIR, file_name)
+        try:
+            entry = manifest_files.get(file_name)
+            stat_result = os.stat(file_path)
+            dg_info['records'] = None
+            if entry and stat_result.st_size == entry.get('size') and stat_result.st_mtime_ns == entry.get('mtime_ns'):
+                dg_info['content_hash'] = entry['sha256']
+                dg_info['records'] = entry.get('records')
+                continue
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            dg_info['content_hash'] = digest.hexdigest()
+        except OSError:
+            dg_info['content_hash'] = None
+            missing += 1
+    if missing:
+        logger.warning(f"有 {missing} 個 Data Group 在 {LOCAL_DATAGROUP_DIR} 中找不到本地檔案，這些 Data Group 每次都會重新更新。")
+
+def load_device_state():
+    """讀取上次成功推送到各設備的狀態 (Data Group 的 URL/內容雜湊與 iRule 雜湊)"""
+    if not os.path.exists(DEVICE_STATE_FILE):
+        return {}
+    try:
+        with open(DEVICE_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"讀取設備狀態檔 {DEVICE_STATE_FILE} 失敗，將全部重新更新: {e}")
+        return {}
+
+def save_device_state(state):
+    try:
+        tmp_path = DEVICE_STATE_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, DEVICE_STATE_FILE)
+    except Exception as e:
+        logger.error(f"寫入設備狀態檔 {DEVICE_STATE_FILE} 失敗: {e}")
+
+def datagroup_is_current(dg_info, inventory, pushed):
+    """判斷設備上的 Data Group 是否已指向相同 URL 且內容未變，不需要再次 modify"""
+    current = inventory.get(dg_info['name'])
+    if current is None or pushed is None or dg_info.get('content_hash') is None:
+        return False
+    if current['type'] and current['type'] != dg_info['type']:
+        return False
+    if current['source_path'] and current['source_path'] != dg_info['file_url']:
+        return False
+    return pushed.get('file_url') == dg_info['file_url'] and pushed.get('content_hash') == dg_info['content_hash']
+
+def execute_tmsh_batch(ssh_client, commands, device_name):
+    """在單一 tmsh 工作階段中以 CLI 交易執行多個命令 (全部成功或全部不生效)"""
+    script = "; ".join(["create cli transaction"] + commands + ["submit cli transaction"])
+    logger.info(f"在 {device_name} 上以單一 tmsh 交易執行 {len(commands)} 個命令...")
+    full_command = f"tmsh -c {shlex.quote(script)}"
+    try:
+        with timed_operation(device_name, "tmsh_batch", f"{len(commands)} commands", len(full_command.encode('utf-8'))) as timing:
+            stdin, stdout, stderr = ssh_client.exec_command(full_command, timeout=TMSH_BATCH_TIMEOUT)
+            exit_status = stdout.channel.recv_exit_status()
+            output = stdout.read().decode('utf-8', errors='ignore').strip()
+            error = stderr.read().decode('utf-8', errors='ignore').strip()
+            timing['success'] = exit_status == 0 and "transaction failed" not in (output + error).lower()
+        if timing['success']:
+            logger.info(f"TMSH 交易成功 on {device_name} ({len(commands)} 個命令)。")
+            return True, output, ""
+        logger.error(f"TMSH 交易失敗 on {device_name} (Exit Status: {exit_status})")
+        if error or output: logger.error(f"TMSH 錯誤詳情: {error or output}")
+        return False, output, error or output
+    except Exception as e:
+        logger.error(f"在 {device_name} 上執行 TMSH 交易時發生異常: {e}", exc_info=True)
+        return False, "", str(e)
+
+def datagroup_command(dg_info, dg_exists):
+    """產生建立或更新單一 Data Group source-path 的 tmsh 命令"""
+    if dg_exists:
+        return f"modify ltm data-group external /Common/{dg_info['name']} source-path {dg_info['file_url']}"
+    return f"create ltm data-group external /Common/{dg_info['name']} type {dg_info['type']} source-path {dg_info['file_url']}"
+
+def sync_datagroups_batched(ssh_client, device_name, datagroups, inventory):
+    """
+    以單一 tmsh 交易送出全部建立/更新命令 (是否存在以 inventory 判斷)。
+    交易失敗時從錯誤訊息找出出問題的 Data Group，改用 ensure_datagroup_exists_on_f5 逐一處理 (含回退邏輯)，
+    其餘 Data Group 再以交易重送一次。回傳更新失敗的 Data Group 名稱清單。
+    """
+    if inventory is None:
+        return sync_datagroups_individually(ssh_client, device_name, datagroups)
+
+    failed_names = []
+    pending = list(datagroups)
+    for attempt in range(2):
+        if not pending:
+            return failed_names
+        commands = [datagroup_command(dg_info, dg_info['name'] in inventory) for dg_info in pending]
+        success, _, error = execute_tmsh_batch(ssh_client, commands, device_name)
+        if success:
+            for dg_info in pending:
+                action = "更新" if dg_info['name'] in inventory else "建立"
+                logger.info(f"Data Group '/Common/{dg_info['name']}' 已{action} source-path 為 {dg_info['file_url']} on {device_name}。")
+            return failed_names
+        failed = [dg_info for dg_info in pending if re.search(rf"(^|[/\s'\"]){re.escape(dg_info['name'])}($|[\s'\")])", error)]
+        if not failed:
+            break
+        logger.warning(f"交易中以下 Data Group 發生錯誤，將逐一處理: {', '.join(dg_info['name'] for dg_info in failed)}")
+        failed_names.extend(sync_datagroups_individually(ssh_client, device_name, failed))
+        pending = [dg_info for dg_info in pending if dg_info not in failed]
+    logger.warning(f"無法以交易更新 {device_name} 上的 Data Group，改為逐一處理 {len(pending)} 個 Data Group。")
+    return failed_names + sync_datagroups_individually(ssh_client, device_name, pending)
+
+def sync_datagroups_individually(ssh_client, device_name, datagroups):
+    """逐一處理 Data Group (每個 Data Group 各自執行 list/create/modify)，回傳更新失敗的 Data Group 名稱清單"""
+    failed_names = []
+    for dg_info in datagroups:
+        if not ensure_datagroup_exists_on_f5(ssh_client, device_name, dg_info['name'], dg_info['type'], dg_info['file_url']):
+            failed_names.append(dg_info['name'])
+    return failed_names
+
+def overlay_datagroup_name(dg_name):
+    return f"{dg_name}{DELTA_DATAGROUP_SUFFIX}"
+
+def load_delta_changes(file_name, from_hash, to_hash):
+    """
+    依序讀取 rpz_converter.py 產生的差異檔 (<檔名>.<SHA-256>.delta)，組出檔案由 from_hash 版本到 to_hash 版本的
+    累積變更 {行: '+' 或 '-'}，先新增後刪除 (或相反) 的行互相抵銷。差異檔鏈不完整時回傳 None。
+    """
+    changes = {}
+    current = from_hash
+    visited = set()
+    while current != to_hash:
+        if current in visited:
+            return None
+        visited.add(current)
+        delta_path = os.path.join(LOCAL_DATAGROUP_DIR, DELTA_DIR_NAME, f"{file_name}.{current}.delta")
+        try:
+            with open(delta_path, 'r', encoding='utf-8') as f:
+                header = f.readline().split()
+                if len(header) != 3 or header[1] != current:
+                    return None
+                for line in f:
+                    op, entry = line[0], line[1:].rstrip('\n')
+                    if changes.get(entry, op) != op:
+                        del changes[entry]
+                    else:
+                        changes[entry] = op
+        except OSError:
+            return None
+        current = header[2]
+    return changes
+
+def overlay_records(changes, delta_mode):
+    """
+    將累積變更轉為覆蓋 Data Group 的記錄 {鍵: 值}。
+    kv (合併查詢 Data Group): 新增或變更的鍵對應新值，刪除的鍵對應 "-" (iRule 視為不存在並繼續查詢上一層後綴)；
+    ends_with (Landing IP 域名列表): 只能表示新增的域名 (值為空)，有刪除時回傳 None。
+    含有 tmsh 需跳脫字元的條目同樣回傳 None (改為完整重新載入)。
+    """
+    records = {}
+    removed = set()
+    for line, op in changes.items():
+        entry = line.rstrip(',')
+        if delta_mode == 'kv':
+            key, _, value = entry.partition(' := ')
+            key, value = key.strip('"'), value.strip('"')
+        else:
+            key, value = entry.strip('"'), ''
+        if not OVERLAY_RECORD_PATTERN.match(key) or (value and not OVERLAY_RECORD_PATTERN.match(value)):
+            return None
+        if op == '+':
+            records[key] = value
+        elif delta_mode == 'kv':
+            removed.add(key)
+        else:
+            return None
+    for key in removed - records.keys():
+        records[key] = '-'
+    return records
+
+def overlay_commands(dg_name, records, exists):
+    """
+    產生設定覆蓋 Data Group 記錄的 tmsh 命令候選 (依序嘗試)。exists 為 None 表示不確定是否存在 (先 modify，失敗再 create)。
+    """
+    name = overlay_datagroup_name(dg_name)
+    items = " ".join(f'"{key}" {{ data "{value}" }}' if value else f'"{key}" {{ }}' for key, value in sorted(records.items()))
+    modify = f"modify ltm data-group internal /Common/{name} " + (f"records replace-all-with {{ {items} }}" if records else "records none")
+    create = f"create ltm data-group internal /Common/{name} type string" + (f" records add {{ {items} }}" if records else "")
+    if exists is None:
+        return [modify, create]
+    return [modify] if exists else [create]
+
+def plan_delta_updates(datagroups, pending, inventory, pushed, device_name):
+    """
+    決定需要更新的 Data Group 以完整重新載入 (source-path) 或只更新覆蓋 Data Group。
+    回傳 (需完整重新載入的 dg_info 列表, {Data Group 名稱: {'records': 覆蓋記錄, 'base_hash': 設備上 external Data Group 的內容雜湊或 None}})。
+    只有差異檔鏈完整、且覆蓋記錄數不超過 DELTA_MAX_RECORDS 與 DELTA_MAX_CHANGE_RATIO 時才以覆蓋更新 (base_hash 不為 None)；
+    完整重新載入時清空覆蓋 (base_hash 為 None)，設備上缺少的覆蓋 Data Group 也會建立 (iRule 會參照)。
+    """
+    pending_names = {dg_info['name'] for dg_info in pending}
+    full_reload = []
+    overlay_plan = {}
+    for dg_info in datagroups:
+        name = dg_info['name']
+        if not dg_info.get('delta_mode'):
+            if name in pending_names:
+                full_reload.append(dg_info)
+            continue
+        if inventory is None:
+            # 無法得知設備現況時全部完整重新載入並清空覆蓋
+            if name in pending_names:
+                full_reload.append(dg_info)
+                overlay_plan[name] = {'records': {}, 'base_hash': None}
+            continue
+        overlay_exists = overlay_datagroup_name(name) in inventory
+        previous = pushed.get(name) or {}
+        base_hash = previous.get('base_hash', previous.get('content_hash'))
+        if name not in pending_names:
+            if not overlay_exists:
+                if base_hash != previous.get('content_hash'):
+                    # 覆蓋 Data Group 已被移除，設備上的內容不再是上次推送的版本
+                    full_reload.append(dg_info)
+                overlay_plan[name] = {'records': {}, 'base_hash': None}
+            continue
+        records = None
+        current = inventory.get(name)
+        if (overlay_exists and current and previous.get('file_url') == dg_info['file_url']
+                and current['source_path'] in (None, dg_info['file_url']) and previous.get('type') == dg_info['type']
+                and base_hash and dg_info.get('content_hash') and dg_info.get('records')):
+            changes = load_delta_changes(dg_info['file_url'].rsplit('/', 1)[-1], base_hash, dg_info['content_hash'])
+            if changes is not None:
+                records = overlay_records(changes, dg_info['delta_mode'])
+            limit = min(DELTA_MAX_RECORDS, DELTA_MAX_CHANGE_RATIO * dg_info['records'])
+            if records is not None and len(records) > limit:
+                logger.info(f"{device_name}: {name} 的覆蓋記錄 {len(records)} 筆超過上限 {limit:.0f} 筆，改為完整重新載入。")
+                records = None
+        if records is None:
+            full_reload.append(dg_info)
+            overlay_plan[name] = {'records': {}, 'base_hash': None}
+        else:
+            overlay_plan[name] = {'records': records, 'base_hash': base_hash}
+    delta_count = sum(1 for plan in overlay_plan.values() if plan['base_hash'])
+    if delta_count:
+        logger.info(f"{device_name}: {delta_count} 個 Data Group 以覆蓋記錄更新，{len(full_reload)} 個完整重新載入。")
+    return full_reload, overlay_plan
+
+def sync_overlay_datagroups(ssh_client, device_name, overlay_plan, inventory, skip_names):
+    """
+    依 overlay_plan 設定覆蓋 Data Group 的記錄 (skip_names 中的 Data Group 略過，例如完整重新載入失敗者)。
+    以單一 tmsh 交易送出，失敗時逐一執行。回傳設定失敗的 Data Group 名稱清單。
+    """
+    commands = {}
+    for name, plan in overlay_plan.items():
+        if name in skip_names:
+            continue
+        exists = None if inventory is None else overlay_datagroup_name(name) in inventory
+        commands[name] = overlay_commands(name, plan['records'], exists)
+    if not commands:
+        return []
+    if ENABLE_TMSH_BATCH and inventory is not None:
+        success, _, _ = execute_tmsh_batch(ssh_client, [candidates[0] for candidates in commands.values()], device_name)
+        if success:
+            logger.info(f"已更新 {device_name} 上 {len(commands)} 個覆蓋 Data Group。")
+            return []
+        logger.warning(f"無法以交易更新 {device_name} 上的覆蓋 Data Group，改為逐一處理。")
+    failed_names = []
+    for name, candidates in commands.items():
+        if not any(execute_tmsh_command(ssh_client, "-c " + shlex.quote(command), device_name, operation="tmsh_overlay")[0]
+                   for command in candidates):
+            logger.error(f"無法設定 {device_name} 上的覆蓋 Data Group '{overlay_datagroup_name(name)}'。")
+            failed_names.append(name)
+    return failed_names
+
+def generate_irule_dg_map_tcl_block(irule_map_entries, lookup_mode=None):
+    """
+    產生 iRule 範本標記之間的 Tcl 區塊；suffix_lookup 模式只需指定合併查詢的 Data Group 名稱。
+    每個 Data Group 另附其覆蓋 Data Group 名稱 (ENABLE_DELTA_UPDATES 停用時為空字串)。
+    """
+    if (lookup_mode or IRULE_LOOKUP_MODE) == "suffix_lookup":
+        dg_name = FQDN_LOOKUP_DATAGROUP_NAME.replace("-", "_")
+        delta_dg_name = overlay_datagroup_name(dg_name) if ENABLE_DELTA_UPDATES else ""
+        return f'set rpz_lookup_dg "{dg_name}"\nset rpz_lookup_delta_dg "{delta_dg_name}"'
     if not irule_map_entries:
         return "set dg_ip_map {}"
     map_lines = []
     for dg_name, ip_address in sorted(list(set(irule_map_entries))):
-        map_lines.append(f'    "{dg_name}" "{ip_address}"')
+        delta_dg_name = overlay_datagroup_name(dg_name) if ENABLE_DELTA_UPDATES else ""
+        map_lines.append(f'    "{dg_name}" "{ip_address}" "{delta_dg_name}"')
     return "set dg_ip_map {\n" + "\n".join(map_lines) + "\n}"
 
-def update_irule_on_f5_api(device_ip, device_username, device_password, device_name, irule_name_on_f5, local_template_path, irule_map_entries_list):
+def irule_template_path():
+    """依 IRULE_LOOKUP_MODE 回傳要使用的本地 iRule 範本路徑"""
+    return LOCAL_LOOKUP_IRULE_FILE if IRULE_LOOKUP_MODE == "suffix_lookup" else LOCAL_MASTER_IRULE_FILE
+
+class DeviceConnection:
+    """
+    單一設備可跨週期重複使用的連線: paramiko SSH 連線 (tmsh) 與 requests.Session (iControl REST)。
+    使用前檢查 SSH transport 是否仍存活，失效時自動重新連線；REST 以 token 認證，到期前或收到 401 時重新登入。
+    同一設備同一時間只由一個執行緒處理，因此物件本身不加鎖。
+    """
+
+    def __init__(self, device):
+        self.name = device['name']
+        self.ip = device['ip']
+        self.username = device['username']
+        self.password = device['password']
+        self.ssh_client = None
+        self.session = None
+        self.token = None
+        self.token_expires_at = 0
+
+    def matches(self, device):
+        """設備的 IP 或帳密變更時不可沿用舊連線"""
+        return (self.ip, self.username, self.password) == (device['ip'], device['username'], device['password'])
+
+    def ssh_is_alive(self):
+        if self.ssh_client is None:
+            return False
+        transport = self.ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore() # 實際送出封包，確認對端仍回應而非半開連線
+            return True
+        except Exception:
+            return False
+
+    def get_ssh(self):
+        """回傳可用的 SSH 連線，必要時 (首次、連線失效) 重新建立"""
+        if self.ssh_is_alive():
+            logger.info(f"沿用與 {self.name} ({self.ip}) 既有的 SSH 連線。")
+            return self.ssh_client
+        if self.ssh_client is not None:
+            logger.warning(f"與 {self.name} ({self.ip}) 的 SSH 連線已失效，重新連線。")
+            self.close_ssh()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with timed_operation(self.name, "ssh_connect", self.ip):
+            client.connect(hostname=self.ip, username=self.username,
+                           password=self.password, timeout=SSH_CONNECT_TIMEOUT)
+        transport = client.get_transport()
+        if transport is not None and SSH_KEEPALIVE_INTERVAL:
+            transport.set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        self.ssh_client = client
+        logger.info(f"成功連接到 {self.name} (SSH for Data Groups)。")
+        return client
+
+    def close_ssh(self):
+        if self.ssh_client is not None:
+            try:
+                self.ssh_client.close()
+                logger.info(f"已從 {self.name} 斷開 SSH 連接。")
+            except Exception:
+                pass
+            self.ssh_client = None
+
+    def get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.verify = F5_API_VERIFY_SSL
+            self.session.headers.update({"Content-Type": "application/json"})
+        return self.session
+
+    def login(self):
+        """向 /mgmt/shared/authn/login 取得 token 並設定到 Session，失敗時回傳 False (改用 Basic Auth)"""
+        session = self.get_session()
+        session.headers.pop("X-F5-Auth-Token", None)
+        self.token = None
+        payload = {"username": self.username, "password": self.password, "loginProviderName": F5_API_LOGIN_PROVIDER}
+        try:
+            with timed_operation(self.name, "api_login", self.ip) as timing:
+                response = session.post(f"https://{self.ip}/mgmt/shared/authn/login",
+                                        data=json.dumps(payload), timeout=F5_API_TIMEOUT)
+                timing['success'] = response.ok
+            response.raise_for_status()
+            token_info = response.json().get('token', {})
+            self.token = token_info['token']
+            # timeout 為 token 有效秒數 (預設 1200)
+            self.token_expires_at = time.time() + int(token_info.get('timeout', 1200))
+        except Exception as e:
+            logger.warning(f"向 {self.name} ({self.ip}) 取得 API token 失敗，改用 Basic Auth: {e}")
+            return False
+        session.headers["X-F5-Auth-Token"] = self.token
+        logger.info(f"已取得 {self.name} 的 API token。")
+        return True
+
+    def token_is_valid(self):
+        return self.token is not None and time.time() < self.token_expires_at - F5_API_TOKEN_REFRESH_MARGIN
+
+    def api_request(self, method, url, **kwargs):
+        """
+        以 Session 送出 iControl REST 請求。token 認證時收到 401 會重新登入並重試一次；
+        連線層錯誤 (例如設備重啟後的舊 keep-alive 連線) 會重建 Session 後重試一次。
+        """
+        kwargs.setdefault('timeout', F5_API_TIMEOUT)
+        for attempt in range(2):
+            session = self.get_session()
+            use_token = F5_API_TOKEN_AUTH and (self.token_is_valid() or self.login())
+            auth = None if use_token else (self.username, self.password)
+            try:
+                response = session.request(method, url, auth=auth, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if attempt:
+                    raise
+                logger.warning(f"與 {self.name} 的 HTTPS 連線中斷，重建工作階段後重試。")
+                self.close_session()
+                continue
+            if response.status_code == 401 and use_token and not attempt:
+                logger.warning(f"{self.name} 的 API token 已失效，重新登入後重試。")
+                self.token = None
+                continue
+            return response
+        return response
+
+    def close_session(self):
+        if self.session is not None:
+            try:
+                self.session.close()
+            except Exception:
+                pass
+            self.session = None
+        self.token = None
+
+    def close(self):
+        self.close_ssh()
+        self.close_session()
+
+def get_device_connection(device):
+    """取得設備的 DeviceConnection，設備設定變更時關閉舊連線並重新建立"""
+    with device_connections_lock:
+        connection = device_connections.get(device['name'])
+        if connection is not None and not connection.matches(device):
+            logger.info(f"{device['name']} 的連線設定已變更，關閉舊連線。")
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = DeviceConnection(device)
+            device_connections[device['name']] = connection
+        return connection
+
+def close_device_connections(keep_names=()):
+    """關閉不在 keep_names 中的設備連線 (預設全部關閉)"""
+    with device_connections_lock:
+        for name in [name for name in device_connections if name not in keep_names]:
+            device_connections.pop(name).close()
+
+def update_irule_on_f5_api(device_ip, device_username, device_password, device_name, irule_name_on_f5, local_template_path, irule_map_entries_list, device_state=None, connection=None):
     if not ENABLE_IRULE_AUTO_UPDATE:
         logger.info(f"iRule 自動更新功能已停用，跳過更新 {irule_name_on_f5} on {device_name}。")
         return True
@@ -296,9 +974,13 @@ def update_irule_on_f5_api(device_ip, device_username, device_password, device_n
     if num_replacements == 0:
         logger.error(f"在 iRule 範本 {local_template_path} 中未找到標記 "
                      f"'{IRULE_DG_MAP_START_MARKER}' 和 '{IRULE_DG_MAP_END_MARKER}'，"
-                     f"或格式不符。無法自動更新 dg_ip_map。")
+                     f"或格式不符。無法自動更新 iRule 的 Data Group 設定區塊。")
         return False
     
+    irule_hash = hashlib.sha256(f"{irule_name_on_f5}\n{modified_irule_content.strip()}".encode('utf-8')).hexdigest()
+    if device_state is not None and device_state.get('irule_hash') == irule_hash:
+        logger.info(f"iRule '{irule_name_on_f5}' 內容與上次推送到 {device_name} 的版本相同，略過更新。")
+        return True
     logger.info(f"已根據最新的 Data Group 列表產生 iRule '{irule_name_on_f5}' 的新內容。")
     irule_path_segment = f"~Common~{irule_name_on_f5}"
     api_url = f"https://{device_ip}/mgmt/tm/ltm/rule/{irule_path_segment}"
@@ -306,16 +988,24 @@ def update_irule_on_f5_api(device_ip, device_username, device_password, device_n
     payload = {"apiAnonymous": modified_irule_content.strip()}
     logger.info(f"準備透過 API PATCH 請求更新 iRule '{irule_path_segment}' on {device_name} (內容已省略)。 URL: {api_url}")
 
+    request_body = json.dumps(payload)
     try:
-        response = requests.patch(
-            api_url,
-            auth=(device_username, device_password),
-            headers=headers,
-            data=json.dumps(payload),
-            verify=F5_API_VERIFY_SSL
-        )
+        with timed_operation(device_name, "irule_patch", irule_name_on_f5, len(request_body.encode('utf-8'))) as timing:
+            if connection is not None:
+                response = connection.api_request("PATCH", api_url, data=request_body)
+            else:
+                response = requests.patch(
+                    api_url,
+                    auth=(device_username, device_password),
+                    headers=headers,
+                    data=request_body,
+                    verify=F5_API_VERIFY_SSL
+                )
+            timing['success'] = response.ok
         response.raise_for_status()
         logger.info(f"iRule '{irule_path_segment}' 透過 API 成功更新於 {device_name}。")
+        if device_state is not None:
+            device_state['irule_hash'] = irule_hash
         return True
     except requests.exceptions.HTTPError as http_err:
         logger.error(f"透過 API 更新 iRule '{irule_path_segment}' 時發生 HTTP 錯誤: {http_err}")
@@ -330,99 +1020,211 @@ def update_irule_on_f5_api(device_ip, device_username, device_password, device_n
         logger.error(f"透過 API 更新 iRule '{irule_path_segment}' 時發生未知錯誤: {e}", exc_info=True)
         return False
 
+def update_single_device(device, datagroups_to_manage, irule_map_entries, device_state):
+    """
+    更新單一設備的 Data Group 與 iRule，回傳 (是否完全成功, 失敗原因)。
+    device_state 為該設備上次成功推送的狀態，只有定義或內容有變更的 Data Group 與 iRule 才會寫入設備，
+    成功推送後 device_state 會就地更新。
+    """
+    device_all_ops_success = True 
+    connection = get_device_connection(device)
+    device_started = time.perf_counter()
+    try:
+        if datagroups_to_manage:
+            logger.info(f"準備透過 SSH 連接 {device['name']} ({device['ip']}) 進行 Data Group 操作...")
+            ssh_client_for_dg = connection.get_ssh()
+            inventory = fetch_datagroup_inventory(ssh_client_for_dg, device['name'])
+            pushed = device_state.get('datagroups', {})
+            if inventory is None:
+                pending = list(datagroups_to_manage)
+            else:
+                pending = [dg_info for dg_info in datagroups_to_manage
+                           if not datagroup_is_current(dg_info, inventory, pushed.get(dg_info['name']))]
+            unchanged = len(datagroups_to_manage) - len(pending)
+            logger.info(f"{device['name']}: {len(pending)} 個 Data Group 需要更新，{unchanged} 個未變更略過。")
+            failed_names = []
+            full_reload, overlay_plan = pending, {}
+            if ENABLE_DELTA_UPDATES:
+                full_reload, overlay_plan = plan_delta_updates(datagroups_to_manage, pending, inventory, pushed, device['name'])
+            if full_reload:
+                if ENABLE_TMSH_BATCH:
+                    failed_names = sync_datagroups_batched(ssh_client_for_dg, device['name'], full_reload, inventory)
+                else:
+                    failed_names = sync_datagroups_individually(ssh_client_for_dg, device['name'], full_reload)
+            if overlay_plan:
+                failed_names += sync_overlay_datagroups(ssh_client_for_dg, device['name'], overlay_plan, inventory, failed_names)
+            updated_names = ({dg_info['name'] for dg_info in full_reload}
+                             | {name for name, plan in overlay_plan.items() if plan['base_hash']})
+            new_pushed = {}
+            for dg_info in datagroups_to_manage:
+                name = dg_info['name']
+                plan = overlay_plan.get(name)
+                if name not in updated_names:
+                    if name in pushed:
+                        new_pushed[name] = pushed[name]
+                elif name not in failed_names:
+                    new_pushed[name] = {'file_url': dg_info['file_url'], 'type': dg_info['type'],
+                                        'content_hash': dg_info.get('content_hash')}
+                    if plan and plan['base_hash']:
+                        # 設備上的 external Data Group 仍為 base_hash 版本，加上覆蓋記錄後等同 content_hash 版本
+                        new_pushed[name]['base_hash'] = plan['base_hash']
+                        new_pushed[name]['overlay_records'] = len(plan['records'])
+            device_state['datagroups'] = new_pushed
+            device_all_ops_success = not failed_names
+        else:
+            logger.info(f"沒有 Data Group 需要管理 for {device['name']}。")
+
+        if ENABLE_IRULE_AUTO_UPDATE:
+            if device_all_ops_success: 
+                if not update_irule_on_f5_api(
+                    device['ip'], device['username'], device['password'], device['name'],
+                    TARGET_IRULE_NAME_ON_F5, irule_template_path(), irule_map_entries, device_state,
+                    connection):
+                    device_all_ops_success = False
+            else:
+                logger.warning(f"由於 Data Group 更新時發生錯誤，跳過在 {device['name']} 上更新 iRule。")
+        else:
+             logger.info(f"iRule 自動更新已停用，跳過在 {device['name']} 上更新 iRule。")
+
+        if device_all_ops_success:
+            return True, None
+        return False, "部分或全部操作失敗"
+    except paramiko.AuthenticationException:
+        logger.error(f"連接 {device['name']} ({device['ip']}) 進行 Data Group 操作時身份驗證失敗！")
+        connection.close_ssh()
+        return False, "Data Group 操作 - 身份驗證失敗"
+    except paramiko.SSHException as sshEx:
+        logger.error(f"無法建立 SSH 連接到 {device['name']} ({device['ip']}) 進行 Data Group 操作: {sshEx}")
+        connection.close_ssh()
+        return False, "Data Group 操作 - SSH 連接失敗"
+    except Exception as e:
+        logger.error(f"處理設備 {device['name']} ({device['ip']}) 時發生未知錯誤: {e}", exc_info=True)
+        connection.close() # 狀態不明的連線不再沿用，下個週期重新建立
+        return False, f"未知錯誤: {e}"
+    finally:
+        if not ENABLE_PERSISTENT_CONNECTIONS:
+            connection.close()
+        record_operation(device['name'], "device_total", time.perf_counter() - device_started)
+
 def update_all_devices():
     logger.info("開始 F5 Data Group 與 iRule 更新週期...")
+    cycle_start = time.time()
     devices = read_f5_devices()
     if not devices:
         logger.warning("未找到有效的 F5 設備資訊或無法讀取密碼。")
         return
 
+    cycle_started_at = datetime.now().isoformat(timespec='seconds')
+    close_device_connections(keep_names={device['name'] for device in devices}) # 已從設備列表移除的設備不再保留連線
+    with operation_timings_lock:
+        operation_timings.clear()
     datagroups_to_manage, irule_map_entries = generate_datagroup_management_list()
+    compute_datagroup_hashes(datagroups_to_manage)
+    device_states = load_device_state()
     overall_success_count = 0
     failed_devices_summary = {}
 
-    for device in devices:
-        device_all_ops_success = True 
-        ssh_client_for_dg = None
-        try:
-            if datagroups_to_manage:
-                logger.info(f"準備透過 SSH 連接 {device['name']} ({device['ip']}) 進行 Data Group 操作...")
-                ssh_client_for_dg = paramiko.SSHClient()
-                ssh_client_for_dg.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_client_for_dg.connect(
-                    hostname=device['ip'], username=device['username'],
-                    password=device['password'], timeout=20
-                )
-                logger.info(f"成功連接到 {device['name']} (SSH for Data Groups)。")
-                logger.info(f"開始處理 {len(datagroups_to_manage)} 個 Data Group for {device['name']}...")
-                for dg_info in datagroups_to_manage:
-                    if not ensure_datagroup_exists_on_f5(ssh_client_for_dg, device['name'], dg_info['name'], dg_info['type'], dg_info['file_url']):
-                        device_all_ops_success = False
-                if ssh_client_for_dg:
-                    ssh_client_for_dg.close()
-                    logger.info(f"已從 {device['name']} 斷開 SSH 連接 (Data Groups)。")
-            else:
-                logger.info(f"沒有 Data Group 需要管理 for {device['name']}。")
-
-            if ENABLE_IRULE_AUTO_UPDATE:
-                if device_all_ops_success: 
-                    if not update_irule_on_f5_api(
-                        device['ip'], device['username'], device['password'], device['name'],
-                        TARGET_IRULE_NAME_ON_F5, LOCAL_MASTER_IRULE_FILE, irule_map_entries):
-                        device_all_ops_success = False
-                else:
-                    logger.warning(f"由於 Data Group 更新時發生錯誤，跳過在 {device['name']} 上更新 iRule。")
-            else:
-                 logger.info(f"iRule 自動更新已停用，跳過在 {device['name']} 上更新 iRule。")
-
-            if device_all_ops_success:
+    # 各設備彼此獨立，以執行緒池同時更新，整體耗時取決於最慢的一台設備
+    max_workers = max(1, min(MAX_CONCURRENT_DEVICES, len(devices)))
+    logger.info(f"同時更新最多 {max_workers} 台設備 (共 {len(devices)} 台)。")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="f5-device") as executor:
+        futures = {
+            executor.submit(update_single_device, device, datagroups_to_manage, irule_map_entries,
+                            device_states.setdefault(device['name'], {})): device
+            for device in devices
+        }
+        for future in concurrent.futures.as_completed(futures):
+            device = futures[future]
+            try:
+                success, reason = future.result()
+            except Exception as e:
+                logger.error(f"處理設備 {device['name']} ({device['ip']}) 時發生未知錯誤: {e}", exc_info=True)
+                success, reason = False, f"未知錯誤: {e}"
+            if success:
                 overall_success_count += 1
             else:
-                failed_devices_summary[device['name']] = "部分或全部操作失敗"
-        except paramiko.AuthenticationException:
-            logger.error(f"連接 {device['name']} ({device['ip']}) 進行 Data Group 操作時身份驗證失敗！")
-            failed_devices_summary[device['name']] = "Data Group 操作 - 身份驗證失敗"
-        except paramiko.SSHException as sshEx:
-            logger.error(f"無法建立 SSH 連接到 {device['name']} ({device['ip']}) 進行 Data Group 操作: {sshEx}")
-            failed_devices_summary[device['name']] = "Data Group 操作 - SSH 連接失敗"
-        except Exception as e:
-            logger.error(f"處理設備 {device['name']} ({device['ip']}) 時發生未知錯誤: {e}", exc_info=True)
-            failed_devices_summary[device['name']] = f"未知錯誤: {e}"
-        finally:
-            if ssh_client_for_dg:
-                try:
-                    ssh_client_for_dg.close()
-                    logger.debug(f"確保 SSH client (Data Groups) for {device['name']} 已關閉。")
-                except:
-                    pass
-
-    logger.info(f"更新週期完成: {overall_success_count}/{len(devices)} 台設備完全更新成功。")
+                failed_devices_summary[device['name']] = reason
+
+    save_device_state(device_states)
+    report_operation_timings(cycle_started_at)
+    logger.info(f"更新週期完成: {overall_success_count}/{len(devices)} 台設備完全更新成功，用時 {time.time() - cycle_start:.2f} 秒。")
     if failed_devices_summary:
         logger.warning("更新失敗或部分失敗的設備詳情:")
         for dev_name, reason in failed_devices_summary.items():
             logger.warning(f"- {dev_name}: {reason}")
 
+def wait_for_generation(after, timeout):
+    """
+    向轉換器長輪詢輸出 generation: generation 不等於 after 時立即回應，否則最多等待 timeout 秒。
+    回傳轉換器目前的 generation，無法連線或回應格式錯誤時回傳 None。
+    """
+    params = {'timeout': timeout}
+    if after is not None:
+        params['after'] = after
+    try:
+        response = requests.get(CONVERTER_GENERATION_URL, params=params, timeout=timeout + 30)
+        response.raise_for_status()
+        return int(response.json()['generation'])
+    except Exception as e:
+        logger.warning(f"無法從 {CONVERTER_GENERATION_URL} 取得輸出 generation: {e}")
+        return None
+
+def run_subscribed_loop():
+    """
+    訂閱模式主循環: 轉換器發布新 generation (輸出檔案有變更) 時立即更新所有設備，其餘時間閒置等待。
+    每 FALLBACK_UPDATE_INTERVAL_SECONDS 仍會執行一次完整更新；無法連線轉換器時改為每 UPDATE_INTERVAL_SECONDS 更新。
+    """
+    last_generation = wait_for_generation(None, GENERATION_POLL_TIMEOUT)
+    update_all_devices()
+    last_run = time.monotonic()
+    logger.info(f"已訂閱 {CONVERTER_GENERATION_URL} (目前 generation {last_generation})，"
+                f"轉換器發布新檔案時立即更新，否則每 {FALLBACK_UPDATE_INTERVAL_SECONDS} 秒執行一次。按 Ctrl+C 可停止。")
+    while True:
+        generation = wait_for_generation(last_generation, GENERATION_POLL_TIMEOUT)
+        if generation is None:
+            fallback_interval = UPDATE_INTERVAL_SECONDS
+            # 避免轉換器停止時連續重試，等待一次長輪詢的時間後再試
+            time.sleep(min(GENERATION_POLL_TIMEOUT, max(0, fallback_interval - (time.monotonic() - last_run))))
+        else:
+            fallback_interval = FALLBACK_UPDATE_INTERVAL_SECONDS
+            if generation != last_generation:
+                logger.info(f"轉換器發布新的輸出 generation {generation} (上次 {last_generation})，開始更新。")
+                last_generation = generation
+                update_all_devices()
+                last_run = time.monotonic()
+                continue
+        if time.monotonic() - last_run >= fallback_interval:
+            logger.info(f"已 {fallback_interval} 秒未執行更新，執行定期更新。")
+            update_all_devices()
+            last_run = time.monotonic()
+
 def main():
     logger.info(f"F5 自動更新腳本 (Data Groups via SSH/TMSH, iRule via API) 已啟動。iRule 自動更新: {'啟用' if ENABLE_IRULE_AUTO_UPDATE else '停用'}")
     logger.info(f"rpzip_blacklist 管理: {'啟用' if MANAGE_RPZIP_BLACKLIST else '停用'}")
     create_f5_devices_file_example()
-    logger.info(f"請確保 {F5_DEVICES_FILE} 和 iRule 範本 ({LOCAL_MASTER_IRULE_FILE}) 已配置。")
+    logger.info(f"請確保 {F5_DEVICES_FILE} 和 iRule 範本 ({irule_template_path()}) 已配置。")
+    logger.info(f"iRule 查詢模式: {IRULE_LOOKUP_MODE}")
     logger.info(f"F5 密碼從環境變數讀取 (例如 F5_PASSWORD_F5_Device1)。")
     logger.info(f"目標 F5 iRule 名稱: {TARGET_IRULE_NAME_ON_F5}")
     logger.info(f"F5 API SSL 驗證: {'啟用' if F5_API_VERIFY_SSL else '停用 (不建議生產環境)'}")
     logger.info("-" * 30)
     try:
-        update_all_devices()
-        logger.info(f"腳本將每 {UPDATE_INTERVAL_SECONDS} 秒執行一次更新。按 Ctrl+C 可停止。")
-        while True:
-            next_run_time = datetime.fromtimestamp(time.time() + UPDATE_INTERVAL_SECONDS)
-            logger.info(f"下次執行時間: {next_run_time.strftime('%Y-%m-%d %H:%M:%S')} (約 {(UPDATE_INTERVAL_SECONDS / 60):.0f} 分鐘後)")
-            time.sleep(UPDATE_INTERVAL_SECONDS)
+        if ENABLE_GENERATION_SUBSCRIBE:
+            run_subscribed_loop()
+        else:
             update_all_devices()
+            logger.info(f"腳本將每 {UPDATE_INTERVAL_SECONDS} 秒執行一次更新。按 Ctrl+C 可停止。")
+            while True:
+                next_run_time = datetime.fromtimestamp(time.time() + UPDATE_INTERVAL_SECONDS)
+                logger.info(f"下次執行時間: {next_run_time.strftime('%Y-%m-%d %H:%M:%S')} (約 {(UPDATE_INTERVAL_SECONDS / 60):.0f} 分鐘後)")
+                time.sleep(UPDATE_INTERVAL_SECONDS)
+                update_all_devices()
     except KeyboardInterrupt:
         logger.info("接收到中斷信號，腳本已停止。")
     except Exception as e:
         logger.error(f"主循環執行過程中發生未預期的錯誤: {e}", exc_info=True)
+    finally:
+        close_device_connections()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+iRule 查詢比對模擬器
+載入 rpz_converter.py 產生的 f5_datagroups/*.txt，在本機模擬 dns_rpz_irule_template.tcl (dg_ip_map：逐一 class match ends_with)、
+dns_rpz_irule_lookup_template.tcl (suffix_lookup：依標籤後綴 class match -value equals) 與 irule_dns_response_filiter.tcl
+(回應 IP 以 class match equals 比對 IP Data Group) 的比對語意。
+指定 --device-state 時依 dynamic_f5_updater.py 的設備狀態檔模擬設備上的內容: 以覆蓋記錄更新的 Data Group 在設備上仍為 base_hash 版本，
+另加上 <名稱>_delta 覆蓋 Data Group (由 deltas/ 中的差異檔組出)，比對優先順序與範本相同。
+重播查詢記錄後輸出每個查詢的比對結果、每個查詢執行的 class 查詢次數與模擬的查詢吞吐量，用於推送到設備前比較不同的 Data Group 佈局。
+
+查詢記錄格式: 每行 "查詢名稱 [查詢類型] [回應 IP ...]"，# 開頭為註解；未提供時可用 --synthetic 產生合成查詢。
+用法: python3 irule_simulator.py [--datagroup-dir 目錄] [--layout dg_ip_map|suffix_lookup|both] [--results 檔案]
+      [--device-state f5_device_state.json [--device 設備名稱]] [查詢記錄檔]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import random
+import socket
+import bisect
+import argparse
+
+DEFAULT_DATAGROUP_DIR = "f5_datagroups"
+LOOKUP_DATAGROUP_FILE = "rpz_blacklist_fqdn_kv.txt"    # suffix_lookup 模式的合併 Key/Value Data Group
+RESPONSE_IP_DATAGROUP_FILE = "rpzip_blacklist.txt"    # 對應 irule_dns_response_filiter.tcl 的 rpz_ip Data Group
+WHITELIST_DATAGROUP_FILE = "white_Domains.txt"        # 兩個範本開頭的白名單 (設備上手動維護，目錄中沒有時視為空)
+BLACKLIST_DATAGROUP_FILE = "blacklist_Domains.txt"    # 兩個範本開頭的固定黑名單 (同上)
+# dg_ip_map 只包含 IPv4 Landing IP 的域名列表 Data Group (<zone>_<a_b_c_d>.txt，分片時為 <zone>_<a_b_c_d>_s<k>.txt)
+LANDING_IP_DATAGROUP_PATTERN = re.compile(r'^(.+)_(\d{1,3})_(\d{1,3})_(\d{1,3})_(\d{1,3})(?:_s\d+)?\.txt$')
+DELTA_DIR_NAME = "deltas"                             # rpz_converter.py 產生的差異檔目錄 (位於 Data Group 目錄下)
+OVERLAY_REMOVED_VALUE = "-"                           # 覆蓋 Data Group 中表示鍵已刪除的值 (suffix_lookup 視為不存在並繼續查詢上一層後綴)
+SYNTHETIC_SEED = 20240501
+
+def parse_datagroup_line(line):
+    """解析 F5 external data group 檔案的一行，回傳 (鍵, 值) 或 None；沒有值的條目值為空字串"""
+    line = line.strip().rstrip(',').strip()
+    if not line:
+        return None
+    key, _, value = line.partition(' := ')
+    return key.strip().strip('"'), value.strip().strip('"')
+
+def load_string_datagroup(path):
+    """載入字串類型 Data Group 為 {鍵: 值}，檔案不存在時回傳空 dict"""
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parsed = parse_datagroup_line(line)
+            if parsed:
+                entries.setdefault(parsed[0], parsed[1])
+    return entries
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_delta_changes(datagroup_dir, file_name, from_hash, to_hash):
+    """
+    與 dynamic_f5_updater.py 相同，依序讀取差異檔 (<檔名>.<SHA-256>.delta) 組出 from_hash 版本到 to_hash 版本的累積變更
+    {行: '+' 或 '-'}；差異檔鏈不完整時回傳 None。
+    """
+    changes = {}
+    current = from_hash
+    visited = set()
+    while current != to_hash:
+        if current in visited:
+            return None
+        visited.add(current)
+        delta_path = os.path.join(datagroup_dir, DELTA_DIR_NAME, f"{file_name}.{current}.delta")
+        try:
+            with open(delta_path, 'r', encoding='utf-8') as f:
+                header = f.readline().split()
+                if len(header) != 3 or header[1] != current:
+                    return None
+                for line in f:
+                    op, entry = line[0], line[1:].rstrip('\n')
+                    if changes.get(entry, op) != op:
+                        del changes[entry]
+                    else:
+                        changes[entry] = op
+        except OSError:
+            return None
+        current = header[2]
+    return changes
+
+def load_device_datagroup(datagroup_dir, file_name, pushed):
+    """
+    載入字串類型 Data Group 在設備上的內容，回傳 ({鍵: 值}, 覆蓋記錄 {鍵: 值})。
+    pushed 為設備狀態檔中此 Data Group 的記錄；含 base_hash 時設備上的 external Data Group 仍為 base_hash 版本
+    (由目前檔案反向套用差異檔得出)，覆蓋記錄則為 base_hash 到已推送版本 (content_hash) 的變更，刪除的鍵值為 "-"。
+    沒有 base_hash 或差異檔鏈不完整時回傳目前檔案內容與空的覆蓋記錄。
+    """
+    path = os.path.join(datagroup_dir, file_name)
+    entries = load_string_datagroup(path)
+    base_hash = (pushed or {}).get('base_hash')
+    if not base_hash or not os.path.exists(path):
+        return entries, {}
+    to_current = load_delta_changes(datagroup_dir, file_name, base_hash, file_sha256(path))
+    to_pushed = load_delta_changes(datagroup_dir, file_name, base_hash, pushed.get('content_hash'))
+    if to_current is None or to_pushed is None:
+        print(f"警告: {file_name} 的差異檔鏈不完整，以目前檔案內容模擬 (不含覆蓋記錄)", file=sys.stderr)
+        return entries, {}
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = {line.rstrip('\n') for line in f}
+    lines.difference_update(line for line, op in to_current.items() if op == '+')
+    lines.update(line for line, op in to_current.items() if op == '-')
+    base_entries = {}
+    for line in sorted(lines):
+        parsed = parse_datagroup_line(line)
+        if parsed:
+            base_entries.setdefault(parsed[0], parsed[1])
+    overlay = {}
+    removed = set()
+    for line, op in to_pushed.items():
+        parsed = parse_datagroup_line(line)
+        if not parsed:
+            continue
+        if op == '+':
+            overlay[parsed[0]] = parsed[1]
+        else:
+            removed.add(parsed[0])
+    for key in removed - overlay.keys():
+        overlay[key] = OVERLAY_REMOVED_VALUE
+    return base_entries, overlay
+
+def load_ip_datagroup(path):
+    """載入 IP 類型 Data Group (host/network 條目) 為各 IP 版本已合併的 (起始位址列表, 結束位址列表)"""
+    ranges = {4: [], 6: []}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parsed = parse_datagroup_line(line)
+                if not parsed:
+                    continue
+                kind, _, value = parsed[0].partition(' ')
+                address, _, prefix = value.partition('/')
+                bits = 128 if ':' in address else 32
+                try:
+                    start = int.from_bytes(socket.inet_pton(socket.AF_INET6 if bits == 128 else socket.AF_INET, address), 'big')
+                except (OSError, ValueError):
+                    continue
+                prefix_len = int(prefix) if kind == 'network' and prefix.isdigit() else bits
+                host_mask = (1 << (bits - prefix_len)) - 1
+                ranges[4 if bits == 32 else 6].append((start & ~host_mask, start | host_mask))
+    tables = {}
+    for version, items in ranges.items():
+        starts, ends = [], []
+        for start, end in sorted(items):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        tables[version] = (starts, ends)
+    return tables
+
+def ip_datagroup_match(tables, address):
+    """模擬 class match $ip equals <IP Data Group>: 位址落在任一 host/network 條目內即符合"""
+    bits = 128 if ':' in address else 32
+    try:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6 if bits == 128 else socket.AF_INET, address), 'big')
+    except (OSError, ValueError):
+        return False
+    starts, ends = tables[4 if bits == 32 else 6]
+    index = bisect.bisect_right(starts, value) - 1
+    return index >= 0 and value <= ends[index]
+
+def ends_with_match(name, keys):
+    """模擬 class match $name ends_with <Data Group>: 名稱以任一鍵結尾即符合 (逐字元比對，與 F5 相同，不以標籤為界)"""
+    for i in range(len(name)):
+        if name[i:] in keys:
+            return True
+    return False
+
+def datagroup_name(file_name):
+    """與 dynamic_f5_updater.py 相同，Data Group 名稱為檔名去掉 .txt 並將 - 換成 _"""
+    return file_name[:-len('.txt')].replace('-', '_')
+
+class Simulator:
+    """
+    保存已載入的 Data Group，依指定佈局模擬單一查詢並回傳 (結果, class 查詢次數)。
+    device_datagroups 為設備狀態檔中單一設備的 'datagroups'；指定時模擬範本也查詢 <名稱>_delta 覆蓋 Data Group。
+    """
+
+    def __init__(self, datagroup_dir, device_datagroups=None):
+        self.use_overlays = device_datagroups is not None
+        device_datagroups = device_datagroups or {}
+        self.whitelist = set(load_string_datagroup(os.path.join(datagroup_dir, WHITELIST_DATAGROUP_FILE)))
+        self.blacklist = set(load_string_datagroup(os.path.join(datagroup_dir, BLACKLIST_DATAGROUP_FILE)))
+        self.lookup, self.lookup_overlay = load_device_datagroup(
+            datagroup_dir, LOOKUP_DATAGROUP_FILE, device_datagroups.get(datagroup_name(LOOKUP_DATAGROUP_FILE)))
+        self.response_ips = load_ip_datagroup(os.path.join(datagroup_dir, RESPONSE_IP_DATAGROUP_FILE))
+        # 與 generate_irule_dg_map_tcl_block 相同，dg_ip_map 依 Data Group 名稱排序
+        self.dg_ip_map = []
+        for filename in sorted(os.listdir(datagroup_dir)):
+            match = LANDING_IP_DATAGROUP_PATTERN.match(filename)
+            if match:
+                dg_name = datagroup_name(filename)
+                entries, overlay = load_device_datagroup(datagroup_dir, filename, device_datagroups.get(dg_name))
+                # 域名列表的覆蓋記錄只含新增的域名 (有刪除時更新程式改為完整重新載入)
+                overlay_keys = {key for key, value in overlay.items() if value != OVERLAY_REMOVED_VALUE}
+                self.dg_ip_map.append((dg_name, '.'.join(match.groups()[1:]), set(entries), overlay_keys))
+        self.overlay_records = len(self.lookup_overlay) + sum(len(dg[3]) for dg in self.dg_ip_map)
+
+    def common_checks(self, name, qtype):
+        """兩個範本開頭相同的白名單與固定黑名單檢查，回傳 (結果或 None, class 查詢次數)"""
+        if ends_with_match(name, self.whitelist):
+            return 'whitelist', 1
+        if ends_with_match(name, self.blacklist) and qtype in ('A', 'AAAA'):
+            return 'blacklist', 2
+        return None, 2
+
+    def simulate_dg_ip_map(self, name, qtype):
+        result, lookups = self.common_checks(name, qtype)
+        if result:
+            return result, lookups
+        for dg_name, ip, keys, overlay_keys in self.dg_ip_map:
+            lookups += 1
+            matched = ends_with_match(name, keys)
+            if not matched and self.use_overlays:
+                # [class match ends_with $dg] || [class match ends_with $delta_dg]
+                lookups += 1
+                matched = ends_with_match(name, overlay_keys)
+            if matched:
+                return (f"answer {ip}" if qtype == 'A' else "nodata"), lookups
+        return 'miss', lookups
+
+    def simulate_suffix_lookup(self, name, qtype):
+        result, lookups = self.common_checks(name, qtype)
+        if result:
+            return result, lookups
+        lookup_name = name.lower()
+        candidate = lookup_name
+        pos = lookup_name.find('.')
+        while True:
+            # 覆蓋 Data Group 有此鍵時以其值為準 ("-" 表示已刪除)，否則查詢 external Data Group
+            if self.use_overlays:
+                lookups += 1
+            if candidate in self.lookup_overlay:
+                lookups += 1
+                action = self.lookup_overlay[candidate]
+                if action == OVERLAY_REMOVED_VALUE:
+                    action = ''
+            else:
+                lookups += 1
+                action = self.lookup.get(candidate, '')
+            if action or pos < 0:
+                break
+            candidate = lookup_name[pos:]
+            pos = lookup_name.find('.', pos + 1)
+        if not action:
+            return 'miss', lookups
+        if action in ('passthru', 'nxdomain'):
+            return action, lookups
+        is_ipv6 = ':' in action
+        if (qtype == 'A' and not is_ipv6 and action != 'nodata') or (qtype == 'AAAA' and is_ipv6):
+            return f"answer {action}", lookups
+        return 'nodata', lookups
+
+    def simulate_response(self, qtype, answers):
+        """模擬 irule_dns_response_filiter.tcl: A 查詢的回應逐筆以 class match equals 比對 IP Data Group"""
+        if qtype != 'A':
+            return None, 0
+        lookups = 0
+        for address in answers:
+            if ':' in address:
+                continue
+            lookups += 1
+            if ip_datagroup_match(self.response_ips, address):
+                return 'ip-blocked', lookups
+        return None, lookups
+
+    def simulate(self, layout, query):
+        name, qtype, answers = query
+        if layout == 'dg_ip_map':
+            result, lookups = self.simulate_dg_ip_map(name, qtype)
+        else:
+            result, lookups = self.simulate_suffix_lookup(name, qtype)
+        # DNS_REQUEST 階段未直接回應時，上游回應才會進入 DNS_RESPONSE
+        if result in ('miss', 'passthru') and answers:
+            response_result, response_lookups = self.simulate_response(qtype, answers)
+            lookups += response_lookups
+            if response_result:
+                result = response_result
+        return result, lookups
+
+def read_query_log(path):
+    """讀取查詢記錄，回傳 [(名稱, 類型, [回應 IP])]，名稱結尾的點會移除"""
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith('#'):
+                continue
+            qtype = parts[1].upper() if len(parts) > 1 else 'A'
+            queries.append((parts[0].rstrip('.'), qtype, parts[2:]))
+    return queries
+
+def synthetic_queries(simulator, count):
+    """由已載入的 Data Group 鍵產生合成查詢 (約一半命中完整名稱或通配符後綴，其餘為未列入的名稱)"""
+    rng = random.Random(SYNTHETIC_SEED)
+    keys = list(simulator.lookup) or [key for _, _, dg_keys, _ in simulator.dg_ip_map for key in dg_keys]
+    queries = []
+    for i in range(count):
+        roll = rng.random()
+        if keys and roll < 0.5:
+            key = rng.choice(keys)
+            name = f"www{i}{key}" if key.startswith('.') else key
+        else:
+            name = f"host{i}.clean{rng.randrange(100000)}.example"
+        queries.append((name, 'A' if roll < 0.9 else 'AAAA', []))
+    return queries
+
+def run_layout(simulator, layout, queries):
+    """以指定佈局模擬所有查詢，回傳 (結果列表, 摘要)"""
+    results = []
+    simulate = simulator.simulate
+    start = time.perf_counter()
+    for query in queries:
+        results.append(simulate(layout, query))
+    elapsed = time.perf_counter() - start
+    lookup_counts = [lookups for _, lookups in results]
+    outcome_counts = {}
+    for result, _ in results:
+        outcome = result.split(' ', 1)[0]
+        outcome_counts[outcome] = outcome_counts.get(outcome, 0) + 1
+    summary = {
+        'queries': len(queries),
+        'class_lookups': sum(lookup_counts),
+        'avg_lookups': sum(lookup_counts) / len(queries) if queries else 0,
+        'max_lookups': max(lookup_counts, default=0),
+        'outcomes': outcome_counts,
+        'elapsed': elapsed,
+        'queries_per_second': len(queries) / elapsed if elapsed else 0,
+    }
+    return results, summary
+
+def print_summary(layout, summary):
+    print(f"[{layout}] 查詢 {summary['queries']:,} 筆，class 查詢共 {summary['class_lookups']:,} 次 "
+          f"(平均 {summary['avg_lookups']:.2f} 次/查詢，最多 {summary['max_lookups']} 次)")
+    print(f"[{layout}] 比對結果: " + ", ".join(f"{k}={v:,}" for k, v in sorted(summary['outcomes'].items())))
+    print(f"[{layout}] 模擬吞吐量: {summary['queries_per_second']:,.0f} 查詢/秒 ({summary['elapsed']:.2f} 秒)")
+
+def main():
+    parser = argparse.ArgumentParser(description="模擬 RPZ iRule 對 Data Group 的比對結果與每個查詢的 class 查詢次數")
+    parser.add_argument('query_log', nargs='?', help="查詢記錄檔 (每行: 名稱 [類型] [回應 IP ...])")
+    parser.add_argument('--datagroup-dir', default=DEFAULT_DATAGROUP_DIR, help="Data Group 檔案目錄")
+    parser.add_argument('--layout', choices=['dg_ip_map', 'suffix_lookup', 'both'], default='both')
+    parser.add_argument('--synthetic', type=int, default=0, help="未提供查詢記錄時產生的合成查詢數")
+    parser.add_argument('--results', help="將每個查詢的結果與 class 查詢次數寫入此檔案 (TSV)")
+    parser.add_argument('--device-state', help="dynamic_f5_updater.py 的設備狀態檔，用於模擬設備上的 external Data Group 與 _delta 覆蓋記錄")
+    parser.add_argument('--device', help="設備狀態檔中的設備名稱 (狀態檔只有一台設備時可省略)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.datagroup_dir):
+        print(f"Data Group 目錄不存在: {args.datagroup_dir}", file=sys.stderr)
+        return 1
+    device_datagroups = None
+    if args.device_state:
+        try:
+            with open(args.device_state, 'r', encoding='utf-8') as f:
+                device_state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"讀取設備狀態檔 {args.device_state} 失敗: {e}", file=sys.stderr)
+            return 1
+        device = args.device or (next(iter(device_state)) if len(device_state) == 1 else None)
+        if device not in device_state:
+            print(f"請以 --device 指定設備狀態檔中的設備: {', '.join(sorted(device_state))}", file=sys.stderr)
+            return 1
+        device_datagroups = device_state[device].get('datagroups', {})
+    simulator = Simulator(args.datagroup_dir, device_datagroups)
+    print(f"已載入 {len(simulator.dg_ip_map)} 個 Landing IP 域名列表 Data Group、"
+          f"{len(simulator.lookup):,} 筆合併查詢條目 ({LOOKUP_DATAGROUP_FILE})")
+    if simulator.use_overlays:
+        print(f"設備 {device}: 覆蓋 Data Group 共 {simulator.overlay_records:,} 筆記錄")
+    if args.query_log:
+        queries = read_query_log(args.query_log)
+    elif args.synthetic:
+        queries = synthetic_queries(simulator, args.synthetic)
+    else:
+        parser.error("請提供查詢記錄檔或 --synthetic 查詢數")
+
+    layouts = ['dg_ip_map', 'suffix_lookup'] if args.layout == 'both' else [args.layout]
+    layout_results = {}
+    for layout in layouts:
+        results, summary = run_layout(simulator, layout, queries)
+        layout_results[layout] = results
+        print_summary(layout, summary)
+    if len(layouts) == 2:
+        # dg_ip_map 的 ends_with 不以標籤為界 (example.com 也會符合 badexample.com)，兩種佈局的結果可能不同
+        differences = [i for i, (a, b) in enumerate(zip(*layout_results.values())) if a[0] != b[0]]
+        print(f"兩種佈局結果不同的查詢: {len(differences):,} 筆")
+        for i in differences[:10]:
+            print(f"  {queries[i][0]} {queries[i][1]}: dg_ip_map={layout_results['dg_ip_map'][i][0]} "
+                  f"suffix_lookup={layout_results['suffix_lookup'][i][0]}")
+    if args.results:
+        with open(args.results, 'w', encoding='utf-8') as f:
+            f.write("name\ttype\t" + "\t".join(f"{layout}_result\t{layout}_lookups" for layout in layouts) + "\n")
+            for i, (name, qtype, _) in enumerate(queries):
+                columns = [f"{layout_results[layout][i][0]}\t{layout_results[layout][i][1]}" for layout in layouts]
+                f.write(f"{name}\t{qtype}\t" + "\t".join(columns) + "\n")
+        print(f"已將逐筆結果寫入 {args.results}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
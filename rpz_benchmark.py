@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+RPZ 轉換流程效能基準測試
+以可重現的合成 RPZ zone (FQDN zone 可設定通配符比例與 Landing IP 數量，IP zone 混合 /32 主機與網段)
+分別測量 parse_fqdn_records、parse_ip_records、reverse_ip_segment、write_datagroup_file 與 write_domains_file
+在不同記錄數 (預設 10k、1M、10M) 下的吞吐量與峰值 RSS，結果寫入 JSON 檔案；
+指定 --baseline 時與先前的結果比較，吞吐量下降超過 --max-regression 即以非零狀態結束，可在部署前攔截效能退步。
+每個測試項目在獨立的子行程中執行，峰值 RSS 不會互相影響；合成資料以產生器逐筆提供，產生資料本身的耗時會另外量測並扣除。
+
+用法: python3 rpz_benchmark.py [--sizes 10000,1000000,10000000] [--output 結果檔] [--baseline 基準結果檔]
+      python3 rpz_benchmark.py --compare-legacy [記錄數]   (比較舊版整行正規表示式解析與目前的 dig 文字解析，以及子域名標籤檢查方式)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import string
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import ipaddress
+import multiprocessing
+from datetime import datetime
+
+import rpz_converter
+
+BENCHMARK_ZONE = "rpztw."
+BENCHMARK_IP_ZONE = "rpzip."
+DEFAULT_RECORD_COUNT = 5000000
+DEFAULT_SIZES = "10000,1000000,10000000"
+DEFAULT_RESULTS_FILE = "rpz_benchmark_results.json"
+DEFAULT_WILDCARD_RATIO = 0.05       # FQDN zone 中通配符記錄 (*.example.com) 的比例
+DEFAULT_LANDING_IP_COUNT = 6        # FQDN zone 使用的 Landing IP 數量
+DEFAULT_HOST_RATIO = 0.8            # IP zone 中 /32 主機記錄的比例，其餘為 /8-/30 網段
+DEFAULT_MAX_REGRESSION = 0.15       # 與基準結果比較時允許的吞吐量下降比例
+SYNTHETIC_SEED = 20240501
+BENCHMARK_CASES = ['parse_fqdn_records', 'parse_ip_records', 'reverse_ip_segment', 'write_datagroup_file', 'write_domains_file']
+LANDING_IPS = ["34.102.218.71", "182.173.0.181", "112.121.114.76", "210.64.24.25", "210.69.155.3", "35.206.236.238"]
+
+# --- 合成資料 ---
+
+def landing_ip_list(count):
+    """回傳 count 個 Landing IP (先使用實際的 Landing IP，不足時以 198.18.0.0/15 測試位址補足)"""
+    ips = LANDING_IPS[:count]
+    for i in range(len(ips), count):
+        ips.append(f"198.18.{i // 256}.{i % 256}")
+    return ips
+
+def synthetic_domain(rng, i):
+    """產生第 i 個合成域名 (不含 zone)，標籤深度 2-4 層"""
+    depth = rng.randrange(3)
+    labels = [f"host{i}"] + [f"sub{rng.randrange(50)}" for _ in range(depth)] + [f"domain{rng.randrange(100000)}", "com"]
+    return ".".join(labels)
+
+def synthetic_fqdn_records(record_count, wildcard_ratio=DEFAULT_WILDCARD_RATIO, landing_ip_count=DEFAULT_LANDING_IP_COUNT, zone_name=BENCHMARK_ZONE):
+    """逐筆產生 FQDN zone 的 (名稱, TTL, 類型, 資料) 記錄 (A 記錄，依 wildcard_ratio 混合通配符名稱)"""
+    rng = random.Random(SYNTHETIC_SEED)
+    ips = landing_ip_list(landing_ip_count)
+    for i in range(record_count):
+        domain = synthetic_domain(rng, i)
+        if rng.random() < wildcard_ratio:
+            domain = "*." + domain
+        yield (f"{domain}.{zone_name}", 60, 'A', ips[i % len(ips)])
+
+def synthetic_ip_triggers(record_count, host_ratio=DEFAULT_HOST_RATIO):
+    """逐筆產生 rpz-ip 觸發名稱中的 IP 段 (例如 32.4.3.2.1 或 24.0.3.2.1)，依 host_ratio 混合 /32 與網段"""
+    rng = random.Random(SYNTHETIC_SEED)
+    for _ in range(record_count):
+        value = rng.getrandbits(32)
+        prefix_len = 32 if rng.random() < host_ratio else rng.randrange(8, 31)
+        value &= ~((1 << (32 - prefix_len)) - 1) & 0xFFFFFFFF
+        octets = [(value >> shift) & 0xFF for shift in (0, 8, 16, 24)]
+        yield f"{prefix_len}.{octets[0]}.{octets[1]}.{octets[2]}.{octets[3]}"
+
+def synthetic_ip_records(record_count, host_ratio=DEFAULT_HOST_RATIO, zone_name=BENCHMARK_IP_ZONE):
+    """逐筆產生 IP zone 的 (名稱, TTL, 類型, 資料) 記錄 (CNAME . 觸發)"""
+    for segment in synthetic_ip_triggers(record_count, host_ratio):
+        yield (f"{segment}.rpz-ip.{zone_name}", 60, 'CNAME', '.')
+
+def synthetic_kv_entries(record_count, landing_ip_count=DEFAULT_LANDING_IP_COUNT):
+    """逐筆產生 Key/Value Data Group 條目 (域名 := Landing IP)"""
+    for name, _, _, ip in synthetic_fqdn_records(record_count, 0, landing_ip_count):
+        yield f"{name[:-len(BENCHMARK_ZONE) - 1]} := {ip}"
+
+def synthetic_domains(record_count, wildcard_ratio=DEFAULT_WILDCARD_RATIO):
+    """逐筆產生域名列表條目 (通配符以 .example.com 表示)"""
+    for name, _, _, _ in synthetic_fqdn_records(record_count, wildcard_ratio):
+        domain = name[:-len(BENCHMARK_ZONE) - 1]
+        yield "." + domain[2:] if domain.startswith("*.") else domain
+
+def synthetic_dig_output(record_count, zone_name=BENCHMARK_ZONE):
+    """產生與 dig axfr 輸出格式相同的合成 zone 文字 (A 記錄為主，混合通配符、AAAA 與 CNAME 策略記錄)"""
+    lines = [
+        "; <<>> DiG 9.18 <<>> axfr " + zone_name,
+        f"{zone_name}\t\t3600\tIN\tSOA\tns.{zone_name} admin.{zone_name} 1 3600 600 86400 60",
+        f"{zone_name}\t\t3600\tIN\tNS\tns.{zone_name}",
+    ]
+    for i in range(record_count):
+        bucket = i % 20
+        if bucket == 0:
+            lines.append(f"*.wild{i}.example.com.{zone_name}\t60\tIN\tA\t{LANDING_IPS[i % len(LANDING_IPS)]}")
+        elif bucket == 1:
+            lines.append(f"nx{i}.example.net.{zone_name}\t60\tIN\tCNAME\t.")
+        elif bucket == 2:
+            lines.append(f"v6-{i}.example.org.{zone_name}\t60\tIN\tAAAA\t2600:1901:0:9b4c::")
+        elif bucket == 3:
+            lines.append(f"ok{i}.example.gov.{zone_name}\t60\tIN\tCNAME\trpz-passthru.")
+        else:
+            lines.append(f"host{i}.domain{i % 1000}.com.{zone_name}\t60\tIN\tA\t{LANDING_IPS[i % len(LANDING_IPS)]}")
+    lines.append(f"{zone_name}\t\t3600\tIN\tSOA\tns.{zone_name} admin.{zone_name} 1 3600 600 86400 60")
+    return "\n".join(lines) + "\n"
+
+def legacy_parse_fqdn_records(zone_data, zone_name):
+    """舊版解析方式 (對每一行執行整行正規表示式並以 ipaddress 驗證 IP)，僅供比較"""
+    ip_grouped_entries = {}
+    zone_pattern_part = re.escape(zone_name.rstrip('.'))
+    a_record_pattern = re.compile(
+       r'^((?:[a-zA-Z0-9*-](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)*)' +
+       zone_pattern_part + r'\.' +
+       r'\s+\d+\s+IN\s+A\s+' +
+       r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})$'
+    )
+    for line in zone_data.splitlines():
+        line = line.strip()
+        if not line or line.startswith(';') or ' SOA ' in line or ' NS ' in line:
+            continue
+        match = a_record_pattern.match(line)
+        if match:
+            subdomain_part = match.group(1).rstrip('.')
+            ip = match.group(2)
+            try:
+                ipaddress.ip_address(ip)
+            except ValueError:
+                continue
+            if subdomain_part.startswith('*'):
+                domain_to_store = "." + subdomain_part[2:] if len(subdomain_part) > 1 else "."
+            elif not subdomain_part:
+                continue
+            else:
+                domain_to_store = subdomain_part
+            ip_grouped_entries.setdefault(ip, set()).add(domain_to_store)
+    return ip_grouped_entries
+
+LABEL_FIRST_CHARS = frozenset(string.ascii_letters + string.digits + '*-')
+LABEL_LAST_CHARS = frozenset(string.ascii_letters + string.digits)
+LABEL_INNER_CHARS = string.ascii_letters + string.digits + '-'
+
+def split_subdomain_check(subdomain_with_dot):
+    """以 split 逐一檢查標籤 (與 FQDN_SUBDOMAIN_PATTERN 的判斷相同)，僅供比較"""
+    for label in subdomain_with_dot[:-1].split('.'):
+        if not label or len(label) > 63 or label[0] not in LABEL_FIRST_CHARS:
+            return False
+        if len(label) > 1 and (label[-1] not in LABEL_LAST_CHARS or label[1:-1].strip(LABEL_INNER_CHARS)):
+            return False
+    return True
+
+def count_items(iterable):
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+# --- 測試項目 ---
+
+def case_inputs(case, record_count, options):
+    """回傳 (產生輸入資料的函數, 以輸入資料執行測試項目並回傳產出筆數的函數)"""
+    wildcard_ratio = options['wildcard_ratio']
+    landing_ip_count = options['landing_ip_count']
+    host_ratio = options['host_ratio']
+    if case == 'parse_fqdn_records':
+        return (lambda: synthetic_fqdn_records(record_count, wildcard_ratio, landing_ip_count),
+                lambda records: count_items(rpz_converter.parse_fqdn_records(records, BENCHMARK_ZONE)))
+    if case == 'parse_ip_records':
+        return (lambda: synthetic_ip_records(record_count, host_ratio),
+                lambda records: count_items(rpz_converter.parse_ip_records(records, BENCHMARK_IP_ZONE)))
+    if case == 'reverse_ip_segment':
+        reverse_ip_segment = rpz_converter.reverse_ip_segment
+        return (lambda: synthetic_ip_triggers(record_count, host_ratio),
+                lambda segments: sum(1 for segment in segments if reverse_ip_segment(segment)))
+    output_file = os.path.join(rpz_converter.OUTPUT_DIR, f"benchmark_{case}.txt")
+    if case == 'write_datagroup_file':
+        return (lambda: synthetic_kv_entries(record_count, landing_ip_count),
+                lambda entries: rpz_converter.write_datagroup_file(entries, output_file) and record_count)
+    if case == 'write_domains_file':
+        return (lambda: synthetic_domains(record_count, wildcard_ratio),
+                lambda domains: rpz_converter.write_domains_file(domains, output_file) and record_count)
+    raise ValueError(f"未知的測試項目: {case}")
+
+def current_rss_mb():
+    """回傳目前行程的 RSS (MB)，無法取得時回傳 None"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def peak_rss_mb():
+    """回傳目前行程的峰值 RSS (MB)；Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_case_in_child(case, record_count, options):
+    """在子行程中執行單一測試項目，回傳結果 dict"""
+    logging.getLogger("RPZ_Converter").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix="rpz_benchmark_") as output_dir:
+        rpz_converter.OUTPUT_DIR = output_dir
+        make_input, run = case_inputs(case, record_count, options)
+        # 先單獨走訪一次輸入產生器，量測產生資料本身的耗時
+        start = time.perf_counter()
+        count_items(make_input())
+        input_seconds = time.perf_counter() - start
+        baseline_rss = current_rss_mb()
+        start = time.perf_counter()
+        produced = run(make_input())
+        seconds = time.perf_counter() - start
+    net_seconds = max(seconds - input_seconds, 1e-9)
+    return {
+        'case': case,
+        'records': record_count,
+        'produced': int(produced or 0),
+        'seconds': round(seconds, 4),
+        'input_seconds': round(input_seconds, 4),
+        'net_seconds': round(net_seconds, 4),
+        'records_per_second': round(record_count / net_seconds, 1),
+        'baseline_rss_mb': round(baseline_rss, 1) if baseline_rss is not None else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def run_benchmarks(cases, sizes, options):
+    """依序以獨立子行程 (spawn) 執行每個測試項目與記錄數的組合"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for record_count in sizes:
+        for case in cases:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case_in_child, (case, record_count, options))
+            results.append(result)
+            print(f"{case:<22} {record_count:>11,} 筆  {result['net_seconds']:9.2f} 秒  "
+                  f"{result['records_per_second']:12,.0f} 筆/秒  峰值 RSS {result['peak_rss_mb']:8.1f} MB", flush=True)
+    return results
+
+def compare_with_baseline(results, baseline_file, max_regression):
+    """與基準結果比較吞吐量，回傳退步超過 max_regression 的項目描述列表"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    baseline_rates = {(item['case'], item['records']): item['records_per_second'] for item in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        previous = baseline_rates.get((result['case'], result['records']))
+        if not previous:
+            continue
+        change = result['records_per_second'] / previous - 1
+        if change < -max_regression:
+            regressions.append(f"{result['case']} ({result['records']:,} 筆): "
+                               f"{previous:,.0f} → {result['records_per_second']:,.0f} 筆/秒 ({change:+.1%})")
+    return regressions
+
+def run_legacy_comparison(record_count):
+    """比較舊版以整行正規表示式解析 dig 輸出的做法與目前的解析流程"""
+    def run_case(label, func):
+        start = time.perf_counter()
+        parsed = func()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<40} {elapsed:8.2f} 秒  {record_count / elapsed:12,.0f} 筆/秒  (產出 {parsed:,} 筆)")
+        return elapsed
+
+    logging.getLogger("RPZ_Converter").setLevel(logging.WARNING)
+    print(f"產生 {record_count:,} 筆合成記錄...")
+    zone_data = synthetic_dig_output(record_count)
+    legacy = run_case("舊版: 整行正規表示式 + ipaddress",
+                      lambda: sum(len(domains) for domains in legacy_parse_fqdn_records(zone_data, BENCHMARK_ZONE).values()))
+    current = run_case("目前: iter_dig_records + parse_fqdn_records",
+                       lambda: count_items(rpz_converter.parse_fqdn_records(rpz_converter.iter_dig_records(zone_data), BENCHMARK_ZONE)))
+    records = list(rpz_converter.iter_dig_records(zone_data))
+    del zone_data
+    run_case("目前: parse_fqdn_records (內建 AXFR 記錄)",
+             lambda: count_items(rpz_converter.parse_fqdn_records(records, BENCHMARK_ZONE)))
+    print(f"dig 文字解析加速: {legacy / current:.2f} 倍 (舊版只解析 A 記錄，目前另外處理 AAAA 與 CNAME 策略記錄)")
+    suffix_length = len(BENCHMARK_ZONE)
+    subdomains = [record.name[:-suffix_length] for record in records if len(record.name) > suffix_length]
+    del records
+    match_subdomain = rpz_converter.FQDN_SUBDOMAIN_PATTERN.match
+    pattern_elapsed = run_case("標籤檢查: FQDN_SUBDOMAIN_PATTERN",
+                               lambda: sum(1 for subdomain in subdomains if match_subdomain(subdomain)))
+    split_elapsed = run_case("標籤檢查: split 逐一檢查標籤",
+                             lambda: sum(1 for subdomain in subdomains if split_subdomain_check(subdomain)))
+    print(f"split 標籤檢查相對正規表示式: {split_elapsed / pattern_elapsed:.2f} 倍耗時")
+
+def main():
+    parser = argparse.ArgumentParser(description="RPZ 轉換流程效能基準測試")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="以逗號分隔的記錄數")
+    parser.add_argument('--cases', default=",".join(BENCHMARK_CASES), help="以逗號分隔的測試項目")
+    parser.add_argument('--wildcard-ratio', type=float, default=DEFAULT_WILDCARD_RATIO)
+    parser.add_argument('--landing-ips', type=int, default=DEFAULT_LANDING_IP_COUNT, help="FQDN zone 使用的 Landing IP 數量")
+    parser.add_argument('--host-ratio', type=float, default=DEFAULT_HOST_RATIO, help="IP zone 中 /32 主機記錄的比例")
+    parser.add_argument('--output', default=DEFAULT_RESULTS_FILE, help="JSON 結果檔案")
+    parser.add_argument('--baseline', help="比較用的先前 JSON 結果檔案")
+    parser.add_argument('--max-regression', type=float, default=DEFAULT_MAX_REGRESSION)
+    parser.add_argument('--compare-legacy', nargs='?', type=int, const=DEFAULT_RECORD_COUNT, metavar='記錄數',
+                        help="改為比較舊版與目前的 dig 文字解析")
+    args = parser.parse_args()
+
+    if args.compare_legacy:
+        run_legacy_comparison(args.compare_legacy)
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    unknown = [case for case in cases if case not in BENCHMARK_CASES]
+    if unknown:
+        parser.error(f"未知的測試項目: {', '.join(unknown)}")
+    options = {'wildcard_ratio': args.wildcard_ratio, 'landing_ip_count': max(1, args.landing_ips), 'host_ratio': args.host_ratio}
+    results = run_benchmarks(cases, sizes, options)
+
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"結果已寫入 {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        if regressions:
+            print(f"吞吐量下降超過 {args.max_regression:.0%} 的項目:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"與基準結果 {args.baseline} 比較，沒有項目的吞吐量下降超過 {args.max_regression:.0%}。")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,30 +3,97 @@
 
 import os
 import re
+import json
 import time
+import hmac
+import base64
+import random
+import socket
+import struct
+import heapq
+import signal
+import hashlib
+import gzip
+import zlib
+import shutil
+import tempfile
+import io
+import itertools
+import contextlib
+from array import array
 import subprocess
 import logging
 import ipaddress
 import threading
+import concurrent.futures
+import multiprocessing
+import socketserver
 import smtplib
+from collections import namedtuple, OrderedDict
 from email.mime.text import MIMEText
-from datetime import datetime
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # --- 基本設定 ---
 DNS_SERVER = "10.8.38.225"  # 更新為您的 DNS 伺服器 IP
+DNS_PORT = 53               # DNS 伺服器端口 (AXFR/IXFR 使用 TCP)
+DNS_TRANSFER_TIMEOUT = 300  # Zone 傳輸的網路逾時 (秒)
+ZONE_TRANSFER_CLIENT = "native" # "native" 使用內建 AXFR/IXFR 客戶端，"dig" 改用 dig 指令
 # *** TSIG Key 設定 ***
 # LAB Key 範例，客戶需更改為適用於其環境的正式 Key
 # 如果 DNS 伺服器不需要 TSIG Key 進行 AXFR，請將此變數設為 None 或空字串 ""
+# 格式與 dig -y 相同: [演算法:]金鑰名稱:Base64 金鑰 (未指定演算法時為 hmac-md5)
 TSIG_KEY_STRING = "hmac-sha256:rpztw:jXt2Kt0bZevOXrl9GKfGPw=="
 # TSIG_KEY_STRING = None # 如果不需要 TSIG Key，取消註解此行並註解掉上面那行
 
 UPDATE_INTERVAL = 5 * 60  # 更新間隔 (秒)，例如 5 * 60 = 5 分鐘
+ENABLE_NOTIFY_LISTENER = True # 接收 DNS_SERVER 的 DNS NOTIFY，收到後立即只同步被通知的 zone
+NOTIFY_LISTEN_ADDRESS = "0.0.0.0" # NOTIFY 監聽位址 (UDP 與 TCP)
+NOTIFY_LISTEN_PORT = 10053 # NOTIFY 監聽端口；上游需設定 also-notify { <本機 IP> port 10053; } (使用 53 需 root 權限)
+NOTIFY_ALLOWED_SOURCES = [DNS_SERVER] # 接受 NOTIFY 的來源 IP
+NOTIFY_REQUIRE_TSIG = False # True 時只接受以 TSIG_KEY_STRING 簽章的 NOTIFY
+NOTIFY_DEBOUNCE_SECONDS = 2 # 收到 NOTIFY 後等待的秒數，合併短時間內多個 zone 的通知為一次轉換
+NOTIFY_SAFETY_POLL_INTERVAL = 60 * 60 # 已收到 NOTIFY 的 zone 的最短輪詢間隔 (秒)，輪詢只作為漏收 NOTIFY 的安全網；未收到 NOTIFY 的 zone 仍依 SOA refresh 輪詢
+ZONE_REFRESH_OVERRIDES = {} # zone 名稱 -> 固定的輪詢間隔 (秒)，覆蓋 SOA refresh，例如 {"phishtw.": 120}
+ZONE_SCHEDULE_MIN_INTERVAL = 60 # 依 SOA refresh 排程時的最短間隔 (秒)
+ZONE_SCHEDULE_MAX_INTERVAL = 6 * 60 * 60 # 依 SOA refresh 排程時的最長間隔 (秒)
+ZONE_RETRY_BACKOFF_MAX = 60 * 60 # 同步失敗時依 SOA retry 指數退避的最長間隔 (秒)
+ZONE_SCHEDULE_COALESCE_SECONDS = 30 # 在此秒數內相繼到期的 zone 合併為一次轉換
 FQDN_ZONE_LIST_FILE = "rpz_fqdn_zone.txt" # FQDN Zone 列表檔案
 IP_ZONE_LIST_FILE = "rpz_ip_zone.txt"     # IP Zone 列表檔案
 OUTPUT_DIR = "f5_datagroups"              # 輸出 Data Group 檔案的目錄
+OUTPUT_MANIFEST_FILE = "manifest.json"    # 輸出目錄中記錄各檔案雜湊、大小、記錄數與產生時間的清單檔
 HTTP_PORT = 8080                          # 提供 Data Group 檔案的 HTTP 服務端口
+ENABLE_GZIP_VARIANTS = True               # 為每個輸出檔案另存預先壓縮的 .gz 版本，用戶端支援 gzip 時直接提供
+ENABLE_DELTA_FILES = True                 # 域名列表與合併查詢檔案內容變更時，另存相對於前一版本的差異檔，供 dynamic_f5_updater.py 以記錄層級更新 F5
+DELTA_DIR_NAME = "deltas"                 # 差異檔目錄 (位於 OUTPUT_DIR 下)，檔名為 <檔名>.<前一版本 SHA-256>.delta
+DELTA_MAX_LINES = 20000                   # 差異超過此行數時不產生差異檔 (F5 端改為完整重新載入)
+DELTA_HISTORY_PER_FILE = 48               # 每個輸出檔案保留的差異檔數量 (較舊的刪除)
+HTTP_CACHE_MAX_FILE_SIZE = 256 * 1024     # 不超過此大小 (bytes) 的檔案內容快取於記憶體，較大的檔案以 os.sendfile 直接傳送
+HTTP_CACHE_MAX_TOTAL_SIZE = 64 * 1024 * 1024 # 記憶體快取的總大小上限 (bytes)，超過時淘汰最久未使用的檔案
 CHUNK_SIZE = 10000                        # 處理大量 IP 記錄時的分塊大小
+AGGREGATE_IP_NETWORKS = True              # 輸出 IP Data Group 前將相鄰/重疊的位址合併為最少的 CIDR 網段
+PRUNE_WILDCARD_COVERED_DOMAINS = True     # 域名列表 (ends_with) 中移除已被同一 Landing IP 的通配符條目 (.example.com) 涵蓋的域名
+DATAGROUP_SHARD_COUNT = 1                 # 每個 Landing IP 域名列表拆分的分片數 (<zone>_<ip>_s<k>.txt)，需與 dynamic_f5_updater.py 相同；1 表示不拆分
+SECOND_LEVEL_LABELS = {'com', 'net', 'org', 'edu', 'gov', 'mil', 'idv', 'co', 'ac', 'or', 'ne', 'go'} # 國碼頂級域名下的常見第二層標籤 (example.com.tw 的可註冊域名為三層)
+ENABLE_INCREMENTAL_SYNC = True            # 啟用 SOA 序號檢查與 IXFR 增量同步 (False 則每次都完整 AXFR)
+ZONE_STATE_DIR = "zone_state"             # 儲存各 zone 同步狀態 (SOA 序號與已解析記錄) 的目錄，外部排序暫存檔也放在此處
+ZONE_STATE_VERSION = 4                    # zone 同步狀態檔案格式版本，格式不符時重新完整傳輸
+SORT_BUFFER_LINES = 500000                # 外部排序每個記憶體區段的最大行數，超過時寫入暫存檔
+SORT_BUFFER_BYTES = 32 * 1024 * 1024      # 外部排序每個記憶體區段的大約記憶體上限 (bytes)，超過時寫入暫存檔
+ZONE_WORKERS = 4                          # 同時處理的 zone 數量 (每個 zone 在獨立的工作行程中傳輸與解析)，設為 1 則依序處理
+METRICS_PATH = "/metrics"                 # HTTP 伺服器提供 Prometheus 格式指標的路徑，設為 None 則停用
+GENERATION_PATH = "/_generation"          # 輸出清單 generation 的長輪詢路徑 (?after=N 時等到 generation 不等於 N 才回應)，設為 None 則停用
+GENERATION_POLL_MAX_WAIT = 300            # 長輪詢單次請求最長等待秒數
+CYCLE_SUMMARY_FILE = "rpz_cycle_metrics.jsonl" # 每個轉換週期的 JSON 指標摘要 (每行一個週期)，設為 None 則只寫入日誌
+ZONE_TIMEOUT = 600                        # 單一 zone 傳輸與解析的時間上限 (秒)，逾時則本週期沿用上次同步的記錄 (寫入記錄檔與輸出檔案不受此限)
 
 # --- Landing IP 監控設定 ---
 MONITORED_ZONE = "rpztw." # 要監控 Landing IP 的 Zone 名稱 (注意結尾的點)
@@ -80,9 +147,41 @@ else:
 
 # --- 全域變數 ---
 known_landing_ips = set()
+zone_states = {} # (zone 類型, zone 名稱) -> {'serial': SOA 序號, 'record_count': 記錄數, 'landing_ips': {IP: 記錄數}}
+output_manifest = {'generation': 0, 'files': {}} # 上次儲存的輸出檔案清單 (OUTPUT_MANIFEST_FILE)
+output_manifest_updates = {} # 本週期寫出的輸出檔案: 檔名 -> 清單條目
+zone_timeout_armed = False # 目前處理中的 zone 是否設定了 ZONE_TIMEOUT 的 SIGALRM 計時 (見 disarm_zone_timeout)
+zone_metrics = {} # 目前處理中 zone 的各階段指標 (每個 zone 各自一份，隨 sync_zone_job 的結果傳回主行程)
+cycle_metrics = {'stages': {}} # 目前轉換週期的各階段耗時
+last_cycle_summary = None # 最近一次轉換週期的指標摘要 (供 /metrics 使用)
+cycle_counters = {'total': 0, 'failed': 0}
+generation_changed = threading.Condition() # generation 遞增時通知等待中的長輪詢請求
+notified_zones = set() # 收到 NOTIFY 尚未處理的 (zone 類型, zone 名稱)
+notify_capable_zones = set() # 曾收到有效 NOTIFY 的 (zone 類型, zone 名稱)，輪詢間隔才套用 NOTIFY_SAFETY_POLL_INTERVAL
+notify_condition = threading.Condition() # 收到 NOTIFY 時喚醒主循環
 
 # --- 函數定義 ---
 
+@contextlib.contextmanager
+def timed_stage(metrics, key):
+    """將 with 區塊的耗時 (秒) 累加到 metrics[key]"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics[key] = metrics.get(key, 0) + time.perf_counter() - started
+
+def add_zone_metric(key, value):
+    """累加目前處理中 zone 的指標"""
+    zone_metrics[key] = zone_metrics.get(key, 0) + value
+
+def peak_rss_bytes(who=None):
+    """回傳行程的峰值 RSS (bytes)，who 為 resource.RUSAGE_SELF (預設) 或 RUSAGE_CHILDREN；無法取得時回傳 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return peak * 1024 if peak and os.uname().sysname != 'Darwin' else peak
+
 def load_known_landing_ips():
     """從檔案載入已知的 Landing IP 清單到全域變數 known_landing_ips"""
     global known_landing_ips
@@ -202,25 +301,390 @@ def read_zone_list(file_path):
         logger.error(f"讀取 zone 列表時發生錯誤: {e}")
         return []
 
-def query_zone_data(zone_name):
+def read_zone_names(file_path):
+    """讀取 zone 列表檔案，並補上缺少的結尾點"""
+    zones = []
+    for zone in read_zone_list(file_path):
+        if not zone.endswith('.'):
+            logger.warning(f"Zone '{zone}' 在 {file_path} 中缺少結尾的點，已自動添加。")
+            zone = zone + "."
+        zones.append(zone)
+    return zones
+
+class ZoneTransferError(Exception):
+    """Zone 傳輸失敗 (連線中斷、DNS 錯誤回應碼或 TSIG 驗證失敗)"""
+    pass
+
+class ZoneTimeoutError(ZoneTransferError):
+    """單一 zone 的處理時間超過 ZONE_TIMEOUT"""
+    pass
+
+# 單筆 zone 記錄: 擁有者名稱 (含結尾的點)、TTL、記錄類型 (如 'A')、資料 (表示格式)
+ZoneRecord = namedtuple('ZoneRecord', ['name', 'ttl', 'rtype', 'rdata'])
+
+DNS_TYPE_A = 1
+DNS_TYPE_NS = 2
+DNS_TYPE_CNAME = 5
+DNS_TYPE_SOA = 6
+DNS_TYPE_PTR = 12
+DNS_TYPE_AAAA = 28
+DNS_TYPE_DNAME = 39
+DNS_TYPE_TSIG = 250
+DNS_TYPE_IXFR = 251
+DNS_TYPE_AXFR = 252
+DNS_CLASS_IN = 1
+DNS_OPCODE_NOTIFY = 4
+DNS_RCODE_REFUSED = 5
+DNS_RCODE_NOTAUTH = 9
+DNS_CLASS_ANY = 255
+DNS_TYPE_NAMES = {
+    DNS_TYPE_A: 'A', DNS_TYPE_NS: 'NS', DNS_TYPE_CNAME: 'CNAME', DNS_TYPE_SOA: 'SOA',
+    DNS_TYPE_PTR: 'PTR', 16: 'TXT', DNS_TYPE_AAAA: 'AAAA', DNS_TYPE_DNAME: 'DNAME',
+}
+DNS_NAME_RDATA_TYPES = {DNS_TYPE_NS, DNS_TYPE_CNAME, DNS_TYPE_PTR, DNS_TYPE_DNAME}
+DNS_RCODE_NAMES = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED', 9: 'NOTAUTH'}
+TSIG_ERROR_NAMES = {16: 'BADSIG', 17: 'BADKEY', 18: 'BADTIME', 22: 'BADTRUNC'}
+TSIG_FUDGE = 300
+# dig -y 格式的演算法名稱 -> (TSIG 演算法網域名稱, hashlib 函數)
+TSIG_ALGORITHMS = {
+    'hmac-md5': ('hmac-md5.sig-alg.reg.int.', hashlib.md5),
+    'hmac-sha1': ('hmac-sha1.', hashlib.sha1),
+    'hmac-sha224': ('hmac-sha224.', hashlib.sha224),
+    'hmac-sha256': ('hmac-sha256.', hashlib.sha256),
+    'hmac-sha384': ('hmac-sha384.', hashlib.sha384),
+    'hmac-sha512': ('hmac-sha512.', hashlib.sha512),
+}
+
+def parse_tsig_key(key_string):
+    """解析 dig -y 格式的 TSIG Key 字串 ([演算法:]名稱:Base64 金鑰)，未設定時回傳 None"""
+    if not key_string:
+        return None
+    parts = key_string.split(':')
+    if len(parts) == 2:
+        algorithm, key_name, secret = 'hmac-md5', parts[0], parts[1]
+    elif len(parts) == 3:
+        algorithm, key_name, secret = parts[0].lower(), parts[1], parts[2]
+    else:
+        raise ValueError("TSIG_KEY_STRING 格式應為 [演算法:]名稱:金鑰")
+    if algorithm not in TSIG_ALGORITHMS:
+        raise ValueError(f"不支援的 TSIG 演算法: {algorithm}")
+    algorithm_name, digestmod = TSIG_ALGORITHMS[algorithm]
+    return {
+        'name': key_name if key_name.endswith('.') else key_name + '.',
+        'algorithm_name': algorithm_name,
+        'digestmod': digestmod,
+        'secret': base64.b64decode(secret),
+    }
+
+def encode_dns_name(name):
+    """將網域名稱編碼為 DNS wire 格式 (不壓縮)"""
+    wire = bytearray()
+    for label in name.rstrip('.').split('.'):
+        if not label:
+            continue
+        encoded = label.encode('ascii')
+        if len(encoded) > 63:
+            raise ValueError(f"DNS label 過長: {label}")
+        wire.append(len(encoded))
+        wire += encoded
+    wire.append(0)
+    return bytes(wire)
+
+DNS_PLAIN_LABEL_BYTES = frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_*/')
+
+def decode_dns_name(message, offset):
+    """從 DNS 訊息中解碼網域名稱 (支援壓縮指標)，回傳 (名稱, 名稱之後的位移)"""
+    labels = []
+    end_offset = None
+    jumps = 0
+    while True:
+        length = message[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0 == 0xC0:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            jumps += 1
+            if jumps > 127:
+                raise ZoneTransferError("DNS 名稱壓縮指標形成迴圈")
+            continue
+        label = message[offset + 1:offset + 1 + length]
+        offset += 1 + length
+        if label.isalnum() or all(c in DNS_PLAIN_LABEL_BYTES for c in label):
+            labels.append(label.decode('ascii'))
+        else:
+            labels.append(''.join(
+                chr(c) if c in DNS_PLAIN_LABEL_BYTES else (f"\\{chr(c)}" if c in b'.\\' else f"\\{c:03d}")
+                for c in label))
+    name = '.'.join(labels) + '.' if labels else '.'
+    return name, end_offset if end_offset is not None else offset
+
+def decode_rdata(message, rtype, offset, rdlength):
+    """將 rdata 轉為與 dig 相同的表示格式字串"""
+    if rtype == DNS_TYPE_A and rdlength == 4:
+        return socket.inet_ntop(socket.AF_INET, message[offset:offset + 4])
+    if rtype == DNS_TYPE_AAAA and rdlength == 16:
+        return socket.inet_ntop(socket.AF_INET6, message[offset:offset + 16])
+    if rtype in DNS_NAME_RDATA_TYPES:
+        return decode_dns_name(message, offset)[0]
+    if rtype == DNS_TYPE_SOA:
+        mname, pos = decode_dns_name(message, offset)
+        rname, pos = decode_dns_name(message, pos)
+        timers = struct.unpack('!IIIII', message[pos:pos + 20])
+        return ' '.join([mname, rname] + [str(value) for value in timers])
+    rdata = message[offset:offset + rdlength]
+    return f"\\# {rdlength} {rdata.hex()}"
+
+def parse_dns_message(message):
     """
-    使用 dig axfr 查詢 zone 資料。
+    解析 DNS 回應訊息。
+    回傳 (標頭 dict, answer 區段的 ZoneRecord 列表, TSIG 資訊 dict 或 None)。
+    """
+    if len(message) < 12:
+        raise ZoneTransferError("DNS 回應過短")
+    msg_id, flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHHH', message[:12])
+    header = {'id': msg_id, 'flags': flags, 'rcode': flags & 0x000F, 'tc': bool(flags & 0x0200), 'arcount': arcount}
+    offset = 12
+    for _ in range(qdcount):
+        offset = decode_dns_name(message, offset)[1] + 4
+    answers = []
+    tsig = None
+    for index in range(ancount + nscount + arcount):
+        rr_start = offset
+        name, offset = decode_dns_name(message, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        if index < ancount:
+            answers.append(ZoneRecord(name, ttl, DNS_TYPE_NAMES.get(rtype, f"TYPE{rtype}"),
+                                      decode_rdata(message, rtype, offset, rdlength)))
+        elif rtype == DNS_TYPE_TSIG and index == ancount + nscount + arcount - 1:
+            algorithm_name, pos = decode_dns_name(message, offset)
+            time_high, time_low, fudge, mac_size = struct.unpack('!HIHH', message[pos:pos + 10])
+            pos += 10
+            mac = message[pos:pos + mac_size]
+            pos += mac_size
+            original_id, error, other_len = struct.unpack('!HHH', message[pos:pos + 6])
+            tsig = {
+                'name': name, 'algorithm_name': algorithm_name, 'time_signed': (time_high << 32) | time_low,
+                'fudge': fudge, 'mac': mac, 'original_id': original_id, 'error': error,
+                'other': message[pos + 6:pos + 6 + other_len], 'offset': rr_start,
+            }
+        offset += rdlength
+    return header, answers, tsig
+
+def tsig_variables(key, time_signed, fudge, error=0, other=b'', timers_only=False):
+    """組出計算 TSIG MAC 所需的 TSIG 變數 (RFC 8945 4.3.3)"""
+    timers = struct.pack('!HIH', time_signed >> 32, time_signed & 0xFFFFFFFF, fudge)
+    if timers_only:
+        return timers
+    return (encode_dns_name(key['name'].lower()) + struct.pack('!HI', DNS_CLASS_ANY, 0)
+            + encode_dns_name(key['algorithm_name']) + timers
+            + struct.pack('!HH', error, len(other)) + other)
+
+def tsig_sign_message(message, key, request_mac=None):
+    """為 DNS 訊息附加 TSIG 記錄，回傳 (簽章後的訊息, MAC)；簽署回應時 request_mac 為請求的 MAC"""
+    msg_id = struct.unpack('!H', message[:2])[0]
+    time_signed = int(time.time())
+    prefix = struct.pack('!H', len(request_mac)) + request_mac if request_mac is not None else b''
+    mac = hmac.new(key['secret'], prefix + message + tsig_variables(key, time_signed, TSIG_FUDGE), key['digestmod']).digest()
+    rdata = (encode_dns_name(key['algorithm_name'])
+             + struct.pack('!HIHH', time_signed >> 32, time_signed & 0xFFFFFFFF, TSIG_FUDGE, len(mac)) + mac
+             + struct.pack('!HHH', msg_id, 0, 0))
+    tsig_rr = encode_dns_name(key['name']) + struct.pack('!HHIH', DNS_TYPE_TSIG, DNS_CLASS_ANY, 0, len(rdata)) + rdata
+    arcount = struct.unpack('!H', message[10:12])[0]
+    return message[:10] + struct.pack('!H', arcount + 1) + message[12:] + tsig_rr, mac
+
+class TsigVerifier:
+    """依序驗證同一次傳輸中各個回應訊息的 TSIG (RFC 8945 5.3.1)"""
+    def __init__(self, key, request_mac):
+        self.key = key
+        self.prior_mac = request_mac
+        self.pending = b''
+        self.first = True
+
+    def verify(self, message, header, tsig):
+        if tsig is None:
+            if self.first:
+                raise ZoneTransferError("DNS 回應缺少 TSIG 簽章")
+            # 多訊息傳輸中允許部分訊息不簽章，由下一個簽章訊息一併涵蓋
+            self.pending += message
+            return
+        if tsig['name'].lower() != self.key['name'].lower() or tsig['algorithm_name'].lower() != self.key['algorithm_name']:
+            raise ZoneTransferError(f"TSIG 金鑰名稱或演算法不符: {tsig['name']} / {tsig['algorithm_name']}")
+        if tsig['error']:
+            raise ZoneTransferError(f"伺服器回報 TSIG 錯誤: {TSIG_ERROR_NAMES.get(tsig['error'], tsig['error'])}")
+        stripped = (struct.pack('!H', tsig['original_id']) + message[2:10]
+                    + struct.pack('!H', header['arcount'] - 1) + message[12:tsig['offset']])
+        digest_input = struct.pack('!H', len(self.prior_mac)) + self.prior_mac + self.pending + stripped
+        digest_input += tsig_variables(self.key, tsig['time_signed'], tsig['fudge'], tsig['error'], tsig['other'],
+                                       timers_only=not self.first)
+        expected = hmac.new(self.key['secret'], digest_input, self.key['digestmod']).digest()
+        if not hmac.compare_digest(expected, tsig['mac']):
+            raise ZoneTransferError("TSIG 簽章驗證失敗 (BADSIG)，請檢查 TSIG_KEY_STRING 是否與伺服器一致")
+        if abs(time.time() - tsig['time_signed']) > tsig['fudge']:
+            raise ZoneTransferError("TSIG 時間超出允許範圍 (BADTIME)，請檢查主機時間同步")
+        self.prior_mac = tsig['mac']
+        self.pending = b''
+        self.first = False
+
+    def finish(self):
+        if self.pending:
+            raise ZoneTransferError("傳輸的最後一則訊息未簽章")
+
+def build_dns_query(zone_name, qtype, serial=None):
+    """建立 DNS 查詢訊息；IXFR 查詢會在 authority 區段附上目前的 SOA 序號"""
+    msg_id = random.randint(0, 0xFFFF)
+    nscount = 1 if serial is not None else 0
+    message = struct.pack('!HHHHHH', msg_id, 0, 1, 0, nscount, 0)
+    message += encode_dns_name(zone_name) + struct.pack('!HH', qtype, DNS_CLASS_IN)
+    if serial is not None:
+        soa_rdata = encode_dns_name('.') + encode_dns_name('.') + struct.pack('!IIIII', serial, 0, 0, 0, 0)
+        message += encode_dns_name(zone_name) + struct.pack('!HHIH', DNS_TYPE_SOA, DNS_CLASS_IN, 0, len(soa_rdata)) + soa_rdata
+    return msg_id, message
+
+def recv_exact(sock, length):
+    """從 TCP 連線讀取指定長度的資料"""
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            raise ZoneTransferError("DNS 伺服器在傳輸途中關閉連線")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+def check_response(header, msg_id, zone_name):
+    """檢查回應的 ID 與回應碼"""
+    if header['id'] != msg_id:
+        raise ZoneTransferError(f"DNS 回應 ID 不符 (zone {zone_name})")
+    if header['rcode']:
+        rcode = DNS_RCODE_NAMES.get(header['rcode'], str(header['rcode']))
+        raise ZoneTransferError(f"DNS 伺服器拒絕 zone {zone_name} 的請求 (rcode={rcode})")
+
+def soa_serial(record):
+    """取出 SOA 記錄的序號"""
+    return int(record.rdata.split()[2])
+
+def serial_is_newer(serial, other):
+    """依 RFC 1982 序號算術判斷 serial 是否比 other 新"""
+    return 0 < (serial - other) % 2 ** 32 < 2 ** 31
+
+def native_zone_transfer(zone_name, serial=None):
+    """
+    透過 DNS over TCP 對 DNS_SERVER 進行 AXFR (或指定序號時的 IXFR)。
+    以產生器逐筆回傳 answer 區段的 ZoneRecord，不經過文字輸出與重新解析。
+    """
+    key = parse_tsig_key(TSIG_KEY_STRING)
+    qtype = DNS_TYPE_IXFR if serial is not None else DNS_TYPE_AXFR
+    msg_id, query = build_dns_query(zone_name, qtype, serial)
+    verifier = None
+    if key:
+        query, request_mac = tsig_sign_message(query, key)
+        verifier = TsigVerifier(key, request_mac)
+    transfer_type = 'IXFR' if serial is not None else 'AXFR'
+    logger.info(f"開始 {transfer_type} 傳輸: @{DNS_SERVER}:{DNS_PORT} {zone_name}{' (TSIG)' if key else ''}")
+
+    record_count = 0
+    message_count = 0
+    byte_count = 0
+    try:
+        with socket.create_connection((DNS_SERVER, DNS_PORT), timeout=DNS_TRANSFER_TIMEOUT) as sock:
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            first_serial = None
+            incremental = False
+            first_serial_seen = 0
+            done = False
+            while not done:
+                started = time.perf_counter()
+                length = struct.unpack('!H', recv_exact(sock, 2))[0]
+                message = recv_exact(sock, length)
+                message_count += 1
+                byte_count += length + 2
+                header, answers, tsig = parse_dns_message(message)
+                check_response(header, msg_id, zone_name)
+                if verifier:
+                    verifier.verify(message, header, tsig)
+                # 傳輸耗時只計算等待與解碼 DNS 訊息的時間，不含下游解析記錄的時間
+                add_zone_metric('transfer_seconds', time.perf_counter() - started)
+                add_zone_metric('transfer_bytes', length + 2)
+                for record in answers:
+                    record_count += 1
+                    if record_count == 1:
+                        if record.rtype != 'SOA':
+                            raise ZoneTransferError(f"{transfer_type} 回應的第一筆記錄不是 SOA (zone {zone_name})")
+                        first_serial = soa_serial(record)
+                    elif record.rtype == 'SOA':
+                        if record_count == 2:
+                            incremental = True
+                        # AXFR 以第二次出現的 SOA 結束；IXFR 增量回應則以第三次出現的新序號 SOA 結束
+                        if soa_serial(record) == first_serial:
+                            first_serial_seen += 1
+                            if first_serial_seen == (2 if incremental else 1):
+                                done = True
+                    yield record
+                # IXFR 時伺服器若已是最新版本，第一則訊息只有一筆序號不比請求新的 SOA，不會再傳送第二筆 SOA；
+                # 序號較新時則是增量或完整傳輸的開頭 (第一則訊息可能只含一筆記錄)，需繼續讀取
+                if (serial is not None and message_count == 1 and len(answers) == 1
+                        and not serial_is_newer(first_serial, serial)):
+                    done = True
+            if verifier:
+                verifier.finish()
+    except socket.timeout:
+        raise ZoneTransferError(f"{transfer_type} zone {zone_name} 超時 (超過 {DNS_TRANSFER_TIMEOUT} 秒)")
+    except OSError as e:
+        raise ZoneTransferError(f"{transfer_type} zone {zone_name} 時連線失敗: {e}")
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ZoneTransferError(f"{transfer_type} zone {zone_name} 的回應格式錯誤: {e}")
+    logger.info(f"從區域 {zone_name} 獲取了 {record_count} 筆記錄 ({message_count} 則訊息，{byte_count} bytes)")
+
+def soa_timers(record):
+    """取出 SOA 記錄的 refresh 與 retry 計時 (秒)"""
+    fields = record.rdata.split()
+    return {'refresh': int(fields[3]), 'retry': int(fields[4])}
+
+def native_query_soa(zone_name):
+    """以 UDP 查詢 SOA 記錄 (回應被截斷時改用 TCP)"""
+    key = parse_tsig_key(TSIG_KEY_STRING)
+    msg_id, query = build_dns_query(zone_name, DNS_TYPE_SOA)
+    request_mac = b''
+    if key:
+        query, request_mac = tsig_sign_message(query, key)
+    with socket.socket(socket.AF_INET6 if ':' in DNS_SERVER else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(10)
+        sock.sendto(query, (DNS_SERVER, DNS_PORT))
+        message = sock.recv(65535)
+    header = parse_dns_message(message)[0]
+    if header['tc']:
+        with socket.create_connection((DNS_SERVER, DNS_PORT), timeout=10) as sock:
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            message = recv_exact(sock, struct.unpack('!H', recv_exact(sock, 2))[0])
+    header, answers, tsig = parse_dns_message(message)
+    check_response(header, msg_id, zone_name)
+    if key:
+        TsigVerifier(key, request_mac).verify(message, header, tsig)
+    for record in answers:
+        if record.rtype == 'SOA':
+            return record
+    raise ZoneTransferError(f"SOA 查詢 zone {zone_name} 的回應中沒有 SOA 記錄")
+
+def run_dig_query(query_args, zone_name, query_desc):
+    """
+    執行 dig 查詢並回傳標準輸出文字，失敗時回傳空字串。
     如果設定了 TSIG_KEY_STRING，則使用 TSIG Key 進行驗證。
     """
     try:
-        cmd = ["dig", f"@{DNS_SERVER}", "axfr", zone_name]
+        cmd = ["dig", f"@{DNS_SERVER}", "-p", str(DNS_PORT)] + list(query_args)
         if TSIG_KEY_STRING: 
             cmd.extend(["-y", TSIG_KEY_STRING])
-            logger.info(f"執行命令: dig @{DNS_SERVER} axfr {zone_name} -y <TSIG_KEY_HIDDEN>")
+            logger.info(f"執行命令: {' '.join(cmd[:-2])} -y <TSIG_KEY_HIDDEN>")
         else:
             logger.info(f"執行命令: {' '.join(cmd)}")
 
         env = os.environ.copy()
         env['LANG'] = 'C'
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=300, env=env, encoding='utf-8', errors='ignore')
-        
-        lines = result.stdout.splitlines()
-        logger.info(f"從區域 {zone_name} 獲取了 {len(lines)} 行數據")
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=DNS_TRANSFER_TIMEOUT, env=env, encoding='utf-8', errors='ignore')
         return result.stdout
     except FileNotFoundError:
         logger.error(f"找不到 'dig' 命令。請確保已安裝 dig 工具並且其路徑在系統的 PATH 環境變數中。")
@@ -228,185 +692,1220 @@ def query_zone_data(zone_name):
     except subprocess.CalledProcessError as e:
         stderr_output = e.stderr.lower() if e.stderr else ""
         if "tsig" in stderr_output and ("failed" in stderr_output or "bad key" in stderr_output or "bad time" in stderr_output):
-             logger.error(f"查詢 zone {zone_name} 時發生 TSIG 驗證失敗。請檢查 DNS 伺服器設定以及腳本中的 TSIG_KEY_STRING 是否正確且與伺服器同步。")
+             logger.error(f"{query_desc} zone {zone_name} 時發生 TSIG 驗證失敗。請檢查 DNS 伺服器設定以及腳本中的 TSIG_KEY_STRING 是否正確且與伺服器同步。")
         else:
-             logger.error(f"查詢 zone {zone_name} 時發生錯誤 (命令返回非零值): {e}")
+             logger.error(f"{query_desc} zone {zone_name} 時發生錯誤 (命令返回非零值): {e}")
         logger.error(f"錯誤輸出: {e.stderr.strip() if e.stderr else 'N/A'}")
         return ""
     except subprocess.TimeoutExpired:
-        logger.error(f"查詢 zone {zone_name} 超時 (超過 300 秒)")
+        logger.error(f"{query_desc} zone {zone_name} 超時 (超過 {DNS_TRANSFER_TIMEOUT} 秒)")
         return ""
     except Exception as e:
         logger.error(f"執行 dig 命令時發生未知錯誤: {e}", exc_info=True)
         return ""
 
-def parse_fqdn_records(zone_data, zone_name):
-    """解析 FQDN 類型的 zone 資料"""
-    ip_grouped_entries = {}
-    current_landing_ips = set()
-    zone_pattern_part = re.escape(zone_name.rstrip('.'))
-    a_record_pattern = re.compile(
-       r'^((?:[a-zA-Z0-9*-](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)*)' + 
-       zone_pattern_part + r'\.' +
-       r'\s+\d+\s+IN\s+A\s+' +
-       r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})$'
-    )
+def iter_dig_records(zone_data):
+    """將 dig 的文字輸出轉換為 ZoneRecord (每行只以空白切分一次，直接檢查 TTL/class 欄位)"""
+    for line in zone_data.splitlines():
+        fields = line.split(None, 4)
+        if len(fields) < 5 or fields[0][0] == ';' or fields[2] != 'IN' or not fields[1].isdigit():
+            continue
+        rdata = fields[4].rstrip()
+        if ' ' in rdata or '\t' in rdata:
+            rdata = ' '.join(rdata.split())
+        yield ZoneRecord(fields[0], int(fields[1]), fields[3], rdata)
+
+def dig_zone_transfer(zone_name, serial=None):
+    """使用 dig 進行 AXFR/IXFR，並將輸出轉換為 ZoneRecord"""
+    with timed_stage(zone_metrics, 'transfer_seconds'):
+        if serial is not None:
+            zone_data = run_dig_query(["+tcp", f"ixfr={serial}", zone_name], zone_name, "IXFR 查詢")
+        else:
+            zone_data = run_dig_query(["axfr", zone_name], zone_name, "AXFR 查詢")
+    add_zone_metric('transfer_bytes', len(zone_data))
+    if not zone_data:
+        raise ZoneTransferError(f"dig 無法取得 zone {zone_name} 的資料")
+    logger.info(f"從區域 {zone_name} 獲取了 {len(zone_data.splitlines())} 行數據")
+    yield from iter_dig_records(zone_data)
+
+def query_zone_data(zone_name, serial=None):
+    """
+    取得 zone 資料，以產生器逐筆回傳 ZoneRecord。
+    指定 serial 時進行 IXFR，否則進行完整 AXFR。傳輸失敗時拋出 ZoneTransferError。
+    """
+    if ZONE_TRANSFER_CLIENT == "dig":
+        return dig_zone_transfer(zone_name, serial)
+    return native_zone_transfer(zone_name, serial)
+
+def query_zone_soa(zone_name):
+    """查詢 zone 目前的 SOA，回傳 (序號, {'refresh', 'retry'})，失敗時回傳 (None, None)"""
+    try:
+        if ZONE_TRANSFER_CLIENT != "dig":
+            record = native_query_soa(zone_name)
+            return soa_serial(record), soa_timers(record)
+        output = run_dig_query(["+short", zone_name, "SOA"], zone_name, "SOA 查詢")
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) >= 5 and not line.startswith(';'):
+                return int(fields[2]), {'refresh': int(fields[3]), 'retry': int(fields[4])}
+    except (ZoneTransferError, OSError, ValueError, struct.error, IndexError) as e:
+        logger.warning(f"查詢 zone {zone_name} 的 SOA 序號時發生錯誤: {e}")
+        return None, None
+    logger.warning(f"無法取得 zone {zone_name} 的 SOA 序號")
+    return None, None
+
+def read_ixfr_response(records):
+    """
+    解析 IXFR 回應。
+    回傳 (新序號, [(刪除的記錄, 新增的記錄), ...], None)；
+    如果伺服器改以完整 AXFR 格式回應，回傳 (新序號, None, 完整記錄串流)。
+    """
+    records = iter(records)
+    head = list(itertools.islice(records, 2))
+    if not head or head[0].rtype != 'SOA':
+        raise ZoneTransferError("IXFR 回應的第一筆記錄不是 SOA")
+    new_serial = soa_serial(head[0])
+    if len(head) == 2 and head[1].rtype != 'SOA':
+        return new_serial, None, itertools.chain(head, records)
+    deltas = []
+    section = None
+    for record in itertools.chain(head[1:], records):
+        if section == 'done':
+            raise ZoneTransferError("IXFR 回應在結尾 SOA 之後仍有記錄")
+        if record.rtype == 'SOA':
+            if section == 'del':
+                section = 'add'
+            elif soa_serial(record) == new_serial:
+                section = 'done'
+            else:
+                deltas.append(([], []))
+                section = 'del'
+            continue
+        if section is None:
+            raise ZoneTransferError("IXFR 回應格式錯誤")
+        deltas[-1][0 if section == 'del' else 1].append(record)
+    return new_serial, deltas, None
+
+def track_soa_serial(records, soa_info):
+    """在記錄串流經過時記下第一筆 SOA 的序號與計時"""
+    for record in records:
+        if record.rtype == 'SOA' and 'serial' not in soa_info:
+            soa_info['serial'] = soa_serial(record)
+            soa_info['soa_timers'] = soa_timers(record)
+        yield record
+
+class ExternalSorter:
+    """
+    以有限記憶體排序大量文字行。
+    緩衝區內的行以 UTF-8 bytes 保存 (位元組順序與字串排序一致，比 str 物件精簡)；指定 key_separator 時，
+    行首的分組鍵 (例如 FQDN 記錄的 Landing IP) 只保存一份，各行只保留分隔符之後的部分。
+    緩衝區滿 SORT_BUFFER_LINES 行或約 SORT_BUFFER_BYTES 時先排序並寫入暫存檔，最後以多路合併依序輸出 (去除重複)。
+    分隔符必須排在分組鍵中其他字元之前 (例如 TAB 或空白)，分組排序才會與整行排序一致。
+    """
+    LINE_OVERHEAD = 41  # 每行 bytes 物件與串列指標的大約額外記憶體 (bytes)
+
+    def __init__(self, buffer_lines=None, temp_dir=None, key_separator=None, buffer_bytes=None):
+        self.buffer_lines = buffer_lines or SORT_BUFFER_LINES
+        self.buffer_bytes = buffer_bytes or SORT_BUFFER_BYTES
+        self.temp_dir = temp_dir or ZONE_STATE_DIR
+        self.key_separator = key_separator
+        self.groups = {}  # 分組鍵 -> 以分隔符開頭的行尾 (bytes) 列表
+        self.buffered_lines = 0
+        self.buffered_size = 0
+        self.run_files = []
+
+    def add(self, line):
+        if self.key_separator:
+            key, separator, rest = line.partition(self.key_separator)
+            data = (separator + rest).encode('utf-8')
+        else:
+            key, data = '', line.encode('utf-8')
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = []
+            self.buffered_size += len(key) + self.LINE_OVERHEAD
+        group.append(data)
+        self.buffered_lines += 1
+        self.buffered_size += len(data) + self.LINE_OVERHEAD
+        if self.buffered_lines >= self.buffer_lines or self.buffered_size >= self.buffer_bytes:
+            self._spill()
+
+    def _sorted_buffer(self):
+        """依序產生緩衝區內排序後且去除重複的行 (UTF-8 bytes，不含換行)，並逐組釋放記憶體"""
+        groups = self.groups
+        self.groups = {}
+        self.buffered_lines = 0
+        self.buffered_size = 0
+        for key in sorted(groups):
+            prefix = key.encode('utf-8')
+            rests = groups.pop(key)
+            rests.sort()
+            for rest in unique_sorted(rests):
+                yield prefix + rest
+
+    def _spill(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        run_file = tempfile.TemporaryFile(mode='w+b', dir=self.temp_dir)
+        run_file.writelines(line + b"\n" for line in self._sorted_buffer())
+        run_file.seek(0)
+        self.run_files.append(run_file)
+
+    def iter_sorted(self):
+        """依序產生排序後且去除重複的行，結束後清除暫存檔"""
+        streams = [(line[:-1] for line in run_file) for run_file in self.run_files]
+        streams.append(self._sorted_buffer())
+        try:
+            for line in unique_sorted(heapq.merge(*streams)):
+                yield line.decode('utf-8')
+        finally:
+            self.close()
+
+    def close(self):
+        for run_file in self.run_files:
+            run_file.close()
+        self.run_files = []
+        self.groups = {}
+        self.buffered_lines = 0
+        self.buffered_size = 0
+
+def unique_sorted(lines):
+    """移除已排序串流中相鄰的重複行"""
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+            previous = line
+
+def zone_state_path(kind, zone_name):
+    """回傳 zone 同步狀態檔案路徑"""
+    zone_prefix = zone_name.rstrip('.').replace('.', '_')
+    return os.path.join(ZONE_STATE_DIR, f"{kind}_{zone_prefix}.json")
+
+def zone_records_path(kind, zone_name):
+    """回傳 zone 已解析記錄檔路徑 (每行一筆，已排序)"""
+    zone_prefix = zone_name.rstrip('.').replace('.', '_')
+    return os.path.join(ZONE_STATE_DIR, f"{kind}_{zone_prefix}.records")
+
+def iter_record_lines(records_path):
+    """逐行讀取已排序的記錄檔"""
+    with open(records_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+def write_record_lines(lines, records_path):
+    """將已排序的記錄行寫入暫存檔後原子替換記錄檔，回傳寫入行數"""
+    os.makedirs(os.path.dirname(records_path), exist_ok=True)
+    tmp_file = records_path + ".tmp"
+    count = 0
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(f"{line}\n")
+            count += 1
+    os.replace(tmp_file, records_path)
+    return count
+
+def count_landing_ips(lines, landing_ip_counts):
+    """在 FQDN 記錄行 (ip<TAB>domain) 經過時統計每個動作鍵 (Landing IP 或 CNAME 策略) 的記錄數"""
+    for line in lines:
+        ip = line.split('\t', 1)[0]
+        landing_ip_counts[ip] = landing_ip_counts.get(ip, 0) + 1
+        yield line
+
+def zone_record_lines(kind, records, zone_name):
+    """將 zone 記錄串流解析為記錄檔使用的文字行"""
+    if kind == 'fqdn':
+        return (f"{ip}\t{domain}" for ip, domain in parse_fqdn_records(records, zone_name))
+    return parse_ip_records(records, zone_name)
+
+def load_zone_state(kind, zone_name):
+    """取得 zone 的同步狀態 (SOA 序號、記錄數與 Landing IP 統計)，優先使用記憶體中的狀態"""
+    key = (kind, zone_name)
+    if key in zone_states:
+        return zone_states[key]
+    state_file = zone_state_path(kind, zone_name)
+    if not os.path.exists(state_file) or not os.path.exists(zone_records_path(kind, zone_name)):
+        return None
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != ZONE_STATE_VERSION:
+            logger.info(f"Zone 同步狀態檔案 {state_file} 為舊格式，將重新進行完整傳輸。")
+            return None
+        state = {
+            'serial': data['serial'],
+            'record_count': int(data['record_count']),
+            'landing_ips': data.get('landing_ips', {}),
+            'soa_timers': data.get('soa_timers'),
+            'render_config': data.get('render_config'),
+        }
+        zone_states[key] = state
+        logger.info(f"從 {state_file} 載入 zone {zone_name} 的同步狀態 (SOA 序號: {state['serial']})")
+        return state
+    except Exception as e:
+        logger.warning(f"讀取 zone 同步狀態檔案 {state_file} 時發生錯誤，將重新進行完整傳輸: {e}")
+        return None
+
+def save_zone_state(kind, zone_name, state):
+    """將 zone 的同步狀態存入記憶體並寫入狀態檔案"""
+    zone_states[(kind, zone_name)] = state
+    state_file = zone_state_path(kind, zone_name)
+    try:
+        os.makedirs(ZONE_STATE_DIR, exist_ok=True)
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': ZONE_STATE_VERSION, 'zone': zone_name, **state}, f)
+        os.replace(tmp_file, state_file)
+    except Exception as e:
+        logger.error(f"寫入 zone 同步狀態檔案 {state_file} 時發生錯誤: {e}")
+
+def store_full_zone(kind, zone_name, records, serial_source):
+    """
+    將完整的 zone 記錄串流解析、以外部排序寫入記錄檔並更新同步狀態。
+    serial_source 為 SOA 序號，或是含 'serial' (與選用的 'soa_timers') 的 dict，例如由 track_soa_serial 填入的 dict。
+    """
+    # FQDN 記錄行以 Landing IP 分組，IP 記錄行以 host/network 分組，分組鍵在緩衝區中只保存一份
+    sorter = ExternalSorter(key_separator='\t' if kind == 'fqdn' else ' ')
+    started = time.perf_counter()
+    transfer_seconds_before = zone_metrics.get('transfer_seconds', 0)
+    try:
+        for line in zone_record_lines(kind, records, zone_name):
+            sorter.add(line)
+        # 傳輸與解析已完成，之後寫入記錄檔與同步狀態不可被逾時中斷
+        disarm_zone_timeout()
+        landing_ip_counts = {}
+        lines = sorter.iter_sorted()
+        if kind == 'fqdn':
+            lines = count_landing_ips(lines, landing_ip_counts)
+        record_count = write_record_lines(lines, zone_records_path(kind, zone_name))
+    finally:
+        sorter.close()
+    # 記錄串流邊傳輸邊解析，解析耗時需扣除期間的傳輸耗時
+    transfer_seconds = zone_metrics.get('transfer_seconds', 0) - transfer_seconds_before
+    add_zone_metric('parse_seconds', max(time.perf_counter() - started - transfer_seconds, 0))
+    add_zone_metric('records_parsed', record_count)
+    if not isinstance(serial_source, dict):
+        serial_source = {'serial': serial_source}
+    state = {'serial': serial_source.get('serial'), 'record_count': record_count, 'landing_ips': landing_ip_counts,
+             'soa_timers': serial_source.get('soa_timers')}
+    save_zone_state(kind, zone_name, state)
+    return state
+
+def apply_ixfr_deltas(kind, zone_name, state, deltas):
+    """將 IXFR 增量以串流合併的方式套用到 zone 的已排序記錄檔"""
+    removed = set()
+    added = set()
+    for deleted_records, added_records in deltas:
+        for line in zone_record_lines(kind, deleted_records, zone_name):
+            added.discard(line)
+            removed.add(line)
+        for line in zone_record_lines(kind, added_records, zone_name):
+            removed.discard(line)
+            added.add(line)
+
+    records_path = zone_records_path(kind, zone_name)
+    removed_hits = [0]
+    def kept_lines():
+        for line in iter_record_lines(records_path):
+            if line in removed:
+                removed_hits[0] += 1
+            else:
+                yield line
+    landing_ip_counts = {}
+    lines = unique_sorted(heapq.merge(kept_lines(), sorted(added)))
+    if kind == 'fqdn':
+        lines = count_landing_ips(lines, landing_ip_counts)
+    record_count = write_record_lines(lines, records_path)
+    added_count = record_count - (state['record_count'] - removed_hits[0])
+    state['record_count'] = record_count
+    state['landing_ips'] = landing_ip_counts
+    logger.info(f"已將 {len(deltas)} 段 IXFR 增量套用到 zone {zone_name}: 新增 {added_count} 條，移除 {removed_hits[0]} 條記錄")
+
+def sync_zone(kind, zone_name):
+    """
+    同步單一 zone 的已排序記錄檔。
+    先比對 SOA 序號，未變更的 zone 直接沿用上次的結果；序號變更時優先使用 IXFR 增量，
+    失敗或伺服器不支援時才回退為完整 AXFR。
+    回傳 (同步狀態, 是否有變更)；無法取得任何資料時回傳 (None, False)。
+    """
+    state = load_zone_state(kind, zone_name)
+    serial = timers = None
+    if ENABLE_INCREMENTAL_SYNC and state and state['serial'] is not None:
+        with timed_stage(zone_metrics, 'soa_query_seconds'):
+            serial, timers = query_zone_soa(zone_name)
+
+    if serial is not None:
+        if serial == state['serial']:
+            logger.info(f"Zone {zone_name} 的 SOA 序號 ({serial}) 未變更，跳過傳輸與解析。")
+            zone_metrics['sync_mode'] = 'unchanged'
+            if timers != state.get('soa_timers'):
+                disarm_zone_timeout()
+                state['soa_timers'] = timers
+                save_zone_state(kind, zone_name, state)
+            return state, False
+        logger.info(f"Zone {zone_name} 的 SOA 序號由 {state['serial']} 變更為 {serial}，嘗試 IXFR 增量同步...")
+        try:
+            new_serial, deltas, full_records = read_ixfr_response(query_zone_data(zone_name, serial=state['serial']))
+            if deltas is not None:
+                zone_metrics['sync_mode'] = 'ixfr'
+                disarm_zone_timeout()
+                with timed_stage(zone_metrics, 'parse_seconds'):
+                    apply_ixfr_deltas(kind, zone_name, state, deltas)
+                add_zone_metric('records_parsed', sum(len(deleted) + len(added) for deleted, added in deltas))
+                state['serial'] = new_serial
+                state['soa_timers'] = timers
+                save_zone_state(kind, zone_name, state)
+                return state, True
+            logger.info(f"DNS 伺服器以完整傳輸回應 zone {zone_name} 的 IXFR 請求，直接解析完整資料。")
+            zone_metrics['sync_mode'] = 'axfr'
+            return store_full_zone(kind, zone_name, full_records, {'serial': new_serial, 'soa_timers': timers}), True
+        except ZoneTimeoutError:
+            raise
+        except ZoneTransferError as e:
+            logger.warning(f"Zone {zone_name} 無法使用 IXFR 增量同步 ({e})，回退為完整 AXFR。")
+
+    soa_info = {}
+    zone_metrics['sync_mode'] = 'axfr'
+    try:
+        return store_full_zone(kind, zone_name, track_soa_serial(query_zone_data(zone_name), soa_info), soa_info), True
+    except ZoneTimeoutError:
+        raise
+    except ZoneTransferError as e:
+        logger.error(f"查詢 zone {zone_name} 時發生錯誤: {e}")
+        zone_metrics['sync_mode'] = 'failed'
+        if state:
+            logger.warning(f"無法獲取 zone 資料: {zone_name}，將沿用上次同步的記錄 (SOA 序號: {state['serial']})")
+            return state, False
+        return None, False
+
+# RPZ CNAME 策略 (RFC 草案 draft-vixie-dnsop-dns-rpz) 的目標名稱 -> 記錄檔中使用的動作鍵
+RPZ_CNAME_ACTIONS = {'.': 'nxdomain', '*.': 'nodata', 'rpz-passthru.': 'passthru'}
+RPZ_ACTION_KEYS = frozenset(RPZ_CNAME_ACTIONS.values())
+# 合併查詢 Data Group 中同一 zone 同一鍵有多個動作時的優先順序 (數字小者優先，其後為 IPv4 與 IPv6 Landing IP)
+LOOKUP_ACTION_RANKS = {'passthru': 0, 'nxdomain': 1, 'nodata': 2}
+FQDN_SUBDOMAIN_PATTERN = re.compile(r'^(?:[a-zA-Z0-9*-](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)*$')
+IPV6_TRIGGER_WORD_PATTERN = re.compile(r'[0-9a-fA-F]{1,4}') # rpz-ip 觸發名稱中的 IPv6 16 位元字組 (int(x, 16) 也接受 -1、+f、1_0，需先檢查)
+
+def is_ipv4_address(ip):
+    """以 inet_pton 檢查 IPv4 位址 (不接受前導零等非標準寫法，比 ipaddress 快一個數量級)"""
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def normalize_ipv6_address(ip):
+    """將 IPv6 位址轉為標準壓縮格式，無效時回傳 None"""
+    try:
+        return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, ip))
+    except (OSError, ValueError):
+        return None
+
+def datagroup_key_part(key):
+    """將動作鍵 (Landing IP 或 nxdomain 等) 轉為檔名與 Data Group 名稱可用的形式"""
+    return key.replace('.', '_').replace(':', '_')
+
+def parse_fqdn_records(records, zone_name):
+    """
+    解析 FQDN 類型 zone 的記錄串流 (ZoneRecord)，逐筆產生 (動作鍵, 域名)。
+    動作鍵為 A/AAAA 記錄的 Landing IP，或 CNAME 策略對應的 nxdomain (CNAME .)、nodata (CNAME *.)、
+    passthru (CNAME rpz-passthru.)；其他 CNAME (本地資料改寫) 與記錄類型會略過。
+    """
+    zone_suffix = zone_name.rstrip('.') + '.'
+    suffix_length = len(zone_suffix)
+    match_subdomain = FQDN_SUBDOMAIN_PATTERN.match
     normal_count = 0
     wildcard_count = 0
-    for line in zone_data.splitlines():
-        line = line.strip()
-        if not line or line.startswith(';') or ' SOA ' in line or ' NS ' in line:
-             continue
-        match = a_record_pattern.match(line)
-        if match:
-            full_domain_part = match.group(1) + zone_pattern_part
-            subdomain_part = match.group(1).rstrip('.')
-            ip = match.group(2)
-            try:
-                ipaddress.ip_address(ip)
-            except ValueError:
-                logger.warning(f"在 zone {zone_name} 中發現無效的 A 記錄 IP 地址: {ip} (行: {line})")
+    type_counts = {'A': 0, 'AAAA': 0, 'CNAME': 0}
+    # Landing IP 種類很少，快取驗證結果以避免每筆記錄重複檢查
+    address_keys = {'A': {}, 'AAAA': {}}
+    for name, _, rtype, rdata in records:
+        if rtype == 'A' or rtype == 'AAAA':
+            cache = address_keys[rtype]
+            key = cache.get(rdata, False)
+            if key is False:
+                key = (rdata if is_ipv4_address(rdata) else None) if rtype == 'A' else normalize_ipv6_address(rdata)
+                if len(cache) < 4096:
+                    cache[rdata] = key
+        elif rtype == 'CNAME':
+            key = RPZ_CNAME_ACTIONS.get(rdata)
+            if key is None:
                 continue
-            current_landing_ips.add(ip)
-            if ip not in ip_grouped_entries:
-                ip_grouped_entries[ip] = set()
-            if subdomain_part.startswith('*'):
-                domain_to_store = "." + subdomain_part[2:] if len(subdomain_part) > 1 else "."
-                wildcard_count += 1
-            elif not subdomain_part:
-                 logger.debug(f"跳過根域名記錄: {full_domain_part} -> {ip}")
-                 continue
-            else:
-                domain_to_store = subdomain_part
-                normal_count += 1
-            ip_grouped_entries[ip].add(domain_to_store)
-    logger.info(f"從區域 {zone_name} 解析了 {normal_count} 條普通 FQDN A 記錄和 {wildcard_count} 條通配符 FQDN A 記錄")
-    return ip_grouped_entries, current_landing_ips
+        else:
+            continue
+        if not name.endswith(zone_suffix):
+            continue
+        subdomain_with_dot = name[:-suffix_length]
+        if not subdomain_with_dot:
+            logger.debug(f"跳過根域名記錄: {name} -> {rdata}")
+            continue
+        if subdomain_with_dot[-1] != '.' or not match_subdomain(subdomain_with_dot):
+            continue
+        if key is None:
+            logger.warning(f"在 zone {zone_name} 中發現無效的 {rtype} 記錄 IP 地址: {rdata} (記錄: {name})")
+            continue
+        if subdomain_with_dot[0] == '*':
+            domain_to_store = "." + subdomain_with_dot[2:-1] if len(subdomain_with_dot) > 2 else "."
+            wildcard_count += 1
+        else:
+            domain_to_store = subdomain_with_dot[:-1]
+            normal_count += 1
+        type_counts[rtype] += 1
+        yield key, domain_to_store
+    logger.info(f"從區域 {zone_name} 解析了 {normal_count} 條普通 FQDN 記錄和 {wildcard_count} 條通配符 FQDN 記錄 "
+                f"(A: {type_counts['A']}，AAAA: {type_counts['AAAA']}，CNAME 策略: {type_counts['CNAME']})")
+
+def decode_ip_trigger(ip_segment):
+    """
+    將 rpz-ip 觸發名稱 (不含 .rpz-ip.<zone>) 解碼為 (IP 版本, 網段起始位址整數, 前綴長度)，無效時回傳 None。
+    IPv4 格式為 "前綴.d.c.b.a"；IPv6 格式為 "前綴.w8.w7...w1" (16 進位，反序)，連續的 0 以一個 "zz" 表示。
+    主機位元不為 0 時視同 strict=False 直接清除。
+    """
+    labels = ip_segment.split('.')
+    if len(labels) < 2 or not (labels[0].isdigit() and labels[0].isascii()):
+        return None
+    prefix_len = int(labels[0])
+    words = labels[:0:-1]
+    if len(words) == 4 and 'zz' not in words:
+        if prefix_len > 32:
+            return None
+        value = 0
+        for octet in words:
+            if not (octet.isdigit() and octet.isascii()) or len(octet) > 3:
+                return None
+            octet_value = int(octet)
+            if octet_value > 255:
+                return None
+            value = (value << 8) | octet_value
+        return 4, value & ~((1 << (32 - prefix_len)) - 1) & 0xFFFFFFFF, prefix_len
+    if prefix_len > 128:
+        return None
+    if 'zz' in words:
+        if words.count('zz') != 1:
+            return None
+        position = words.index('zz')
+        zero_words = 8 - (len(words) - 1)
+        if zero_words < 1:
+            return None
+        words = words[:position] + ['0'] * zero_words + words[position + 1:]
+    if len(words) != 8:
+        return None
+    value = 0
+    for word in words:
+        if not IPV6_TRIGGER_WORD_PATTERN.fullmatch(word):
+            return None
+        value = (value << 16) | int(word, 16)
+    return 6, value & ~((1 << (128 - prefix_len)) - 1), prefix_len
+
+def format_ip_address(version, value):
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+def format_ip_entry(version, value, prefix_len):
+    """產生 IP Data Group 條目 (單一位址為 host，其餘為 network)"""
+    address = format_ip_address(version, value)
+    if prefix_len == (32 if version == 4 else 128):
+        return f"host {address}"
+    return f"network {address}/{prefix_len}"
 
 def reverse_ip_segment(ip_segment):
-    """反轉 IP 段的順序"""
-    parts = ip_segment.split('.')
-    if len(parts) != 5:
+    """反轉 IP 段的順序，回傳 "位址/前綴長度" (支援 IPv4 與 IPv6 的 zz 寫法)"""
+    trigger = decode_ip_trigger(ip_segment)
+    if trigger is None:
         logger.warning(f"試圖反轉無效的 IP segment: {ip_segment}")
         return None
+    version, value, prefix_len = trigger
+    return f"{format_ip_address(version, value)}/{prefix_len}"
+
+def parse_ip_records(records, zone_name):
+    """解析 IP 類型 zone 的記錄串流 (ZoneRecord)，逐筆產生 host/network 格式的條目 (IPv4 與 IPv6)"""
+    trigger_suffix = '.rpz-ip.' + zone_name.rstrip('.') + '.'
+    suffix_length = len(trigger_suffix)
+    count = 0
+    for name, _, rtype, rdata in records:
+        if rtype != 'CNAME' or rdata != '.' or not name.endswith(trigger_suffix):
+            continue
+        ip_segment = name[:-suffix_length]
+        trigger = decode_ip_trigger(ip_segment)
+        if trigger is None:
+            logger.warning(f"無效的 rpz-ip 觸發名稱: {name}")
+            continue
+        count += 1
+        yield format_ip_entry(*trigger)
+    logger.info(f"從區域 {zone_name} 解析了 {count} 條有效的 IP 記錄")
+
+def parse_ip_entry(entry):
+    """將 host/network 條目轉回 (IP 版本, 起始位址整數, 結束位址整數)，無法解析時回傳 None"""
+    kind, _, value = entry.partition(' ')
+    address, _, prefix = value.partition('/')
+    family, bits = (socket.AF_INET6, 128) if ':' in address else (socket.AF_INET, 32)
     try:
-        prefix_len = int(parts[0])
-        reversed_ip_parts = reversed(parts[1:])
-        valid_parts = []
-        for part in reversed_ip_parts:
-            p_int = int(part)
-            if 0 <= p_int <= 255:
-                valid_parts.append(str(p_int))
-            else:
-                raise ValueError("IP part out of range")
-        if len(valid_parts) != 4:
-             raise ValueError("Incorrect number of IP parts")
-        reversed_ip = '.'.join(valid_parts)
-        ipaddress.ip_network(f"{reversed_ip}/{prefix_len}", strict=False)
-        return f"{reversed_ip}/{prefix_len}"
-    except (ValueError, IndexError) as e:
-        logger.warning(f"反轉或驗證 IP segment '{ip_segment}' 時出錯: {e}")
+        start = int.from_bytes(socket.inet_pton(family, address), 'big')
+    except (OSError, ValueError):
+        return None
+    prefix_len = int(prefix) if kind == 'network' and prefix.isdigit() else bits
+    if prefix_len > bits:
         return None
+    host_mask = (1 << (bits - prefix_len)) - 1
+    start &= ~host_mask
+    return (4 if bits == 32 else 6), start, start | host_mask
 
-def parse_ip_records(zone_data, zone_name):
-    """解析 IP 類型的 zone 資料"""
-    datagroup_entries = set()
-    zone_pattern_part = re.escape(zone_name.rstrip('.'))
-    pattern = re.compile(r'^([0-9.]+)\.rpz-ip\.' + zone_pattern_part + r'\.\s+\d+\s+IN\s+CNAME\s+\.$')
-    count = 0
-    for line in zone_data.splitlines():
-        line = line.strip()
-        if not line or line.startswith(';'):
-             continue
-        match = pattern.match(line)
-        if match:
-            ip_segment = match.group(1)
-            cidr = reverse_ip_segment(ip_segment)
-            if cidr:
+def collapse_ranges(ranges):
+    """合併已依起始位址排序的 (起始, 結束) 區間中重疊或相鄰的部分"""
+    merged_start = merged_end = None
+    for start, end in ranges:
+        if merged_end is not None and start <= merged_end + 1:
+            if end > merged_end:
+                merged_end = end
+            continue
+        if merged_end is not None:
+            yield merged_start, merged_end
+        merged_start, merged_end = start, end
+    if merged_end is not None:
+        yield merged_start, merged_end
+
+def range_to_prefixes(start, end, bits):
+    """將位址區間拆成最少的 CIDR 網段，產生 (網段起始位址, 前綴長度)"""
+    while start <= end:
+        block = start & -start if start else 1 << bits
+        while block > end - start + 1:
+            block >>= 1
+        yield start, bits - block.bit_length() + 1
+        start += block
+
+def aggregate_ip_entries(entries):
+    """
+    將 host/network 條目合併為涵蓋相同位址的最少 CIDR 網段 (與 ipaddress.collapse_addresses 結果相同)。
+    IPv4 區間以 (起始 << 32 | 結束) 打包在 array('Q') 中排序，IPv6 區間數量通常很少，以一般整數處理。
+    依位址順序產生條目，IPv4 在前。
+    """
+    ipv4_ranges = array('Q')
+    ipv6_ranges = []
+    input_count = 0
+    for entry in entries:
+        parsed = parse_ip_entry(entry)
+        if parsed is None:
+            logger.warning(f"略過無法解析的 IP 條目: {entry}")
+            continue
+        input_count += 1
+        version, start, end = parsed
+        if version == 4:
+            ipv4_ranges.append((start << 32) | end)
+        else:
+            ipv6_ranges.append((start, end))
+    output_count = 0
+    sorted_ipv4 = ((packed >> 32, packed & 0xFFFFFFFF) for packed in sorted(ipv4_ranges))
+    for version, bits, ranges in ((4, 32, sorted_ipv4), (6, 128, sorted(ipv6_ranges))):
+        for start, end in collapse_ranges(ranges):
+            for network, prefix_len in range_to_prefixes(start, end, bits):
+                output_count += 1
+                yield format_ip_entry(version, network, prefix_len)
+    logger.info(f"IP 條目彙整: {input_count} 筆合併為 {output_count} 筆 CIDR 網段")
+
+def ip_output_entries(lines):
+    """IP Data Group 檔案的輸出條目；AGGREGATE_IP_NETWORKS 啟用時先彙整為最少的 CIDR 網段"""
+    if AGGREGATE_IP_NETWORKS:
+        return aggregate_ip_entries(lines)
+    return lines
+
+def format_datagroup_entry(entry):
+    """將單筆條目轉為 F5 external data group 檔案的格式 (不含結尾逗號)"""
+    entry_str = str(entry).strip()
+    if ' := ' in entry_str:
+        parts = entry_str.split(' := ', 1)
+        key = parts[0].strip()
+        value = parts[1].strip()
+        if not (key.startswith('"') and key.endswith('"')) and (' ' in key or '.' in key or '*' in key):
+            key = f'"{key}"'
+        if not (value.startswith('"') and value.endswith('"')) and ' ' in value:
+            value = f'"{value}"'
+        return f"{key} := {value}"
+    if ' ' in entry_str and not (entry_str.startswith("host ") or entry_str.startswith("network ")):
+        if not (entry_str.startswith('"') and entry_str.endswith('"')):
+            entry_str = f'"{entry_str}"'
+    return entry_str
+
+def file_sha256(file_path):
+    """計算檔案內容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def sorted_file_diff(old_file, new_file, max_lines, sort_key=None):
+    """
+    以合併比對找出兩個依相同順序排序的檔案的差異，回傳 (刪除的行, 新增的行) (bytes，不含換行)。
+    sort_key 為檔案排序所依據的鍵 (作用於含換行的 bytes 行)，未指定時為整行。
+    差異超過 max_lines 行或任一檔案不是依 sort_key 遞增排序時回傳 None。
+    """
+    sort_key = sort_key or (lambda line: line)
+    removed = []
+    added = []
+    with open(old_file, 'rb') as old_f, open(new_file, 'rb') as new_f:
+        old_line = old_f.readline()
+        new_line = new_f.readline()
+        previous_old_key = previous_new_key = None
+        while old_line or new_line:
+            old_key = sort_key(old_line) if old_line else None
+            new_key = sort_key(new_line) if new_line else None
+            if ((old_key is not None and previous_old_key is not None and old_key < previous_old_key)
+                    or (new_key is not None and previous_new_key is not None and new_key < previous_new_key)):
+                return None
+            if new_key is None or (old_key is not None and old_key < new_key):
+                removed.append(old_line.rstrip(b'\n'))
+                previous_old_key, old_line = old_key, old_f.readline()
+            elif old_key is None or new_key < old_key:
+                added.append(new_line.rstrip(b'\n'))
+                previous_new_key, new_line = new_key, new_f.readline()
+            else:
+                if old_line != new_line:
+                    removed.append(old_line.rstrip(b'\n'))
+                    added.append(new_line.rstrip(b'\n'))
+                previous_old_key, old_line = old_key, old_f.readline()
+                previous_new_key, new_line = new_key, new_f.readline()
+            if len(removed) + len(added) > max_lines:
+                return None
+    return removed, added
+
+def domain_line_sort_key(line):
+    """域名列表檔案各行的排序鍵: 啟用 PRUNE_WILDCARD_COVERED_DOMAINS 時為反轉的域名，否則為域名本身"""
+    domain = line.rstrip(b',\n').strip(b'"')
+    return domain[::-1] if PRUNE_WILDCARD_COVERED_DOMAINS else domain
+
+def write_delta_file(name, old_file, new_file, old_hash, new_hash, sort_key=None):
+    """
+    產生輸出檔案由 old_hash 版本變為 new_hash 版本的差異檔 (OUTPUT_DIR/DELTA_DIR_NAME/<檔名>.<old_hash>.delta)，
+    第一行為 "# <old_hash> <new_hash>"，其後每行為 "-<刪除的行>" 或 "+<新增的行>"。
+    差異過大或檔案未排序時不產生，每個檔案只保留最近 DELTA_HISTORY_PER_FILE 個差異檔。
+    """
+    diff = sorted_file_diff(old_file, new_file, DELTA_MAX_LINES, sort_key)
+    if diff is None:
+        logger.info(f"{name} 的差異超過 {DELTA_MAX_LINES} 行或檔案未排序，不產生差異檔。")
+        return
+    removed, added = diff
+    delta_dir = os.path.join(OUTPUT_DIR, DELTA_DIR_NAME)
+    os.makedirs(delta_dir, exist_ok=True)
+    delta_file = os.path.join(delta_dir, f"{name}.{old_hash}.delta")
+    tmp_file = os.path.join(delta_dir, f".{name}.{os.getpid()}.tmp")
+    with open(tmp_file, 'wb') as f:
+        f.write(f"# {old_hash} {new_hash}\n".encode('ascii'))
+        for line in removed:
+            f.write(b'-' + line + b'\n')
+        for line in added:
+            f.write(b'+' + line + b'\n')
+    os.replace(tmp_file, delta_file)
+    logger.info(f"已產生 {name} 的差異檔: 刪除 {len(removed)} 行，新增 {len(added)} 行")
+    pattern = re.compile(rf"^{re.escape(name)}\.[0-9a-f]{{64}}\.delta$")
+    history = sorted((entry for entry in os.scandir(delta_dir) if pattern.match(entry.name)),
+                     key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in history[DELTA_HISTORY_PER_FILE:]:
+        os.remove(entry.path)
+
+def write_output_file(lines, output_file, delta=False, delta_sort_key=None):
+    """
+    將文字行寫入同目錄的暫存檔並同時計算 SHA-256。內容與現有檔案相同時刪除暫存檔、保留原檔不動，
+    否則以 os.replace 原子替換，HTTP 伺服器不會提供寫到一半的檔案。
+    ENABLE_GZIP_VARIANTS 啟用時同時維護預先壓縮的 <檔名>.gz；delta 為 True 且 ENABLE_DELTA_FILES 啟用時，
+    替換前另存相對於原檔的差異檔 (見 write_delta_file，delta_sort_key 為檔案的排序鍵)。
+    回傳清單條目 {'name', 'sha256', 'size', 'records', 'generated_at', 'mtime_ns', 'changed'}，並記錄於 output_manifest_updates。
+    """
+    output_dir = os.path.dirname(output_file)
+    name = os.path.basename(output_file)
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_file = os.path.join(output_dir, f".{name}.{os.getpid()}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    records = 0
+    try:
+        with open(tmp_file, 'wb') as f:
+            for line in lines:
+                data = line.encode('utf-8')
+                digest.update(data)
+                f.write(data)
+                size += len(data)
+                records += 1
+        new_hash = digest.hexdigest()
+
+        previous = output_manifest['files'].get(name)
+        old_hash = None
+        if os.path.exists(output_file):
+            if previous and os.path.getsize(output_file) == previous['size']:
+                old_hash = previous['sha256']
+            else:
+                old_hash = file_sha256(output_file)
+        changed = new_hash != old_hash
+        if changed:
+            if delta and ENABLE_DELTA_FILES and old_hash:
                 try:
-                    network = ipaddress.ip_network(cidr, strict=False)
-                    if network.prefixlen == 32:
-                        host_ip = str(network.network_address)
-                        datagroup_entries.add(f"host {host_ip}")
-                    else:
-                        datagroup_entries.add(f"network {str(network)}")
-                    count += 1
-                except ValueError as e:
-                    logger.warning(f"無效的 CIDR 格式 {cidr} (來自 {ip_segment}): {e}")
-    logger.info(f"從區域 {zone_name} 解析了 {count} 條有效的 IP 記錄")
-    return list(datagroup_entries)
+                    write_delta_file(name, output_file, tmp_file, old_hash, new_hash, delta_sort_key)
+                except Exception as e:
+                    logger.warning(f"產生 {name} 的差異檔時發生錯誤，F5 端將完整重新載入: {e}")
+            os.replace(tmp_file, output_file)
+            http_file_cache.invalidate(output_file)
+            if ENABLE_GZIP_VARIANTS:
+                write_gzip_variant(output_file)
+            generated_at = datetime.now().isoformat(timespec='seconds')
+        else:
+            os.remove(tmp_file)
+            if previous:
+                generated_at = previous['generated_at']
+            else:
+                generated_at = datetime.fromtimestamp(os.path.getmtime(output_file)).isoformat(timespec='seconds')
+            gzip_file = output_file + ".gz"
+            if ENABLE_GZIP_VARIANTS and (not os.path.exists(gzip_file) or os.path.getmtime(gzip_file) < os.path.getmtime(output_file)):
+                write_gzip_variant(output_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    entry = {'name': name, 'sha256': new_hash, 'size': size, 'records': records,
+             'generated_at': generated_at, 'mtime_ns': os.stat(output_file).st_mtime_ns, 'changed': changed}
+    output_manifest_updates[name] = entry
+    return entry
+
+def write_gzip_variant(output_file):
+    """產生輸出檔案的預先壓縮版本 (<檔名>.gz)，寫入暫存檔後原子替換"""
+    gzip_file = output_file + ".gz"
+    tmp_file = os.path.join(os.path.dirname(gzip_file), f".{os.path.basename(gzip_file)}.{os.getpid()}.tmp")
+    try:
+        with open(output_file, 'rb') as src, open(tmp_file, 'wb') as raw:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_file, gzip_file)
+        http_file_cache.invalidate(gzip_file)
+    except Exception as e:
+        logger.warning(f"產生壓縮檔 {gzip_file} 時發生錯誤，將只提供未壓縮版本: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def load_output_manifest():
+    """讀取輸出目錄中的清單檔 (OUTPUT_MANIFEST_FILE)"""
+    global output_manifest
+    manifest_path = os.path.join(OUTPUT_DIR, OUTPUT_MANIFEST_FILE)
+    output_manifest = {'generation': 0, 'files': {}}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                output_manifest = json.load(f)
+        except Exception as e:
+            logger.warning(f"讀取輸出清單 {manifest_path} 失敗，將重新計算檔案雜湊: {e}")
+    output_manifest_updates.clear()
+    return output_manifest
+
+def save_output_manifest():
+    """
+    將本週期寫出的檔案合併進輸出清單並原子替換清單檔。有任何檔案內容變更時遞增 generation，
+    已不存在於輸出目錄的檔案會從清單移除。回傳本週期內容有變更的檔案數。
+    """
+    files = dict(output_manifest['files'])
+    changed_count = 0
+    for name, entry in output_manifest_updates.items():
+        entry = dict(entry)
+        if entry.pop('changed'):
+            changed_count += 1
+        files[name] = entry
+    files = {name: entry for name, entry in files.items() if os.path.exists(os.path.join(OUTPUT_DIR, name))}
+    removed_count = len(output_manifest['files'].keys() - files.keys())
+    generation = output_manifest['generation']
+    if changed_count or removed_count or not os.path.exists(os.path.join(OUTPUT_DIR, OUTPUT_MANIFEST_FILE)):
+        generation += 1
+        new_manifest = {'generation': generation, 'updated_at': datetime.now().isoformat(timespec='seconds'),
+                        'files': dict(sorted(files.items()))}
+        try:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            manifest_path = os.path.join(OUTPUT_DIR, OUTPUT_MANIFEST_FILE)
+            tmp_file = os.path.join(OUTPUT_DIR, f".{OUTPUT_MANIFEST_FILE}.tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(new_manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, manifest_path)
+            output_manifest.update(new_manifest)
+            with generation_changed:
+                generation_changed.notify_all()
+        except Exception as e:
+            logger.error(f"寫入輸出清單時發生錯誤: {e}", exc_info=True)
+    logger.info(f"輸出檔案: {len(output_manifest_updates)} 個已產生，其中 {changed_count} 個內容變更並已替換，"
+                f"其餘保留不動 (generation {generation})")
+    output_manifest_updates.clear()
+    return changed_count
 
-def write_datagroup_file(entries, output_file):
-    """將數據寫入 F5 datagroup 格式的檔案，每行末尾添加逗號"""
+def write_datagroup_file(entries, output_file, delta=False):
+    """
+    將數據寫入 F5 datagroup 格式的檔案，每行末尾添加逗號。
+    entries 可為任意可迭代物件 (包含產生器)，依傳入順序逐筆寫出，呼叫端需自行提供已排序的資料。
+    內容未變更時不會改動現有檔案 (見 write_output_file)；delta 為 True 時另存差異檔。
+    """
     try:
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for entry in sorted(entries):
-                entry_str = str(entry).strip()
-                if ' ' in entry_str and not (entry_str.startswith("host ") or entry_str.startswith("network ")):
-                     if not (entry_str.startswith('"') and entry_str.endswith('"')):
-                          entry_str = f'"{entry_str}"'
-                if ' := ' in entry_str:
-                     parts = entry_str.split(' := ', 1)
-                     key = parts[0].strip()
-                     value = parts[1].strip()
-                     if not (key.startswith('"') and key.endswith('"')) and (' ' in key or '.' in key or '*' in key):
-                          key = f'"{key}"'
-                     if not (value.startswith('"') and value.endswith('"')) and ' ' in value:
-                          value = f'"{value}"'
-                     entry_str = f"{key} := {value}"
-                f.write(f"{entry_str},\n")
-        logger.info(f"成功寫入 datagroup 檔案: {output_file}，包含 {len(entries)} 條記錄")
+        entry = write_output_file((f"{format_datagroup_entry(item)},\n" for item in entries), output_file, delta)
+        if entry['changed']:
+            logger.info(f"成功寫入 datagroup 檔案: {output_file}，包含 {entry['records']} 條記錄")
+        else:
+            logger.info(f"datagroup 檔案內容未變更: {output_file}，包含 {entry['records']} 條記錄")
         return True
     except Exception as e:
         logger.error(f"寫入 datagroup 檔案 {output_file} 時發生錯誤: {e}", exc_info=True)
         return False
 
+def format_domain_entry(domain):
+    """將單一域名轉為 ends_with 域名列表檔案的格式 (不含結尾逗號)"""
+    domain_str = str(domain).strip()
+    if not (domain_str.startswith('"') and domain_str.endswith('"')):
+        if ' ' in domain_str or domain_str.startswith('.') or '*' in domain_str:
+            domain_str = f'"{domain_str}"'
+    return domain_str
+
 def write_domains_file(domains, output_file):
-    """將域名列表寫入檔案，每行一個域名並添加逗號 (適用於 class match ends_with)"""
+    """
+    將域名列表寫入檔案，每行一個域名並添加逗號 (適用於 class match ends_with)。
+    domains 依傳入順序逐筆寫出，呼叫端需自行提供已排序的資料。
+    內容未變更時不會改動現有檔案 (見 write_output_file)；內容變更時另存差異檔供記錄層級更新。
+    """
     try:
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for domain in sorted(list(domains)):
-                domain_str = str(domain).strip()
-                if not (domain_str.startswith('"') and domain_str.endswith('"')):
-                    if ' ' in domain_str or domain_str.startswith('.') or '*' in domain_str:
-                        domain_str = f'"{domain_str}"'
-                f.write(f"{domain_str},\n")
-        logger.info(f"成功寫入域名列表檔案: {output_file}，包含 {len(domains)} 條記錄")
+        entry = write_output_file((f"{format_domain_entry(domain)},\n" for domain in domains), output_file,
+                                   delta=True, delta_sort_key=domain_line_sort_key)
+        if entry['changed']:
+            logger.info(f"成功寫入域名列表檔案: {output_file}，包含 {entry['records']} 條記錄")
+        else:
+            logger.info(f"域名列表檔案內容未變更: {output_file}，包含 {entry['records']} 條記錄")
         return True
     except Exception as e:
         logger.error(f"寫入域名列表檔案 {output_file} 時發生錯誤: {e}", exc_info=True)
         return False
 
-def process_fqdn_zones():
+def fqdn_kv_entries(lines):
+    """
+    將 FQDN 記錄行 (ip<TAB>domain) 轉為 Key/Value 條目。
+    AAAA 記錄的 IPv6 Landing IP 不寫入 (同一域名常同時有 A 與 AAAA，寫入會造成 Data Group 重複鍵)。
+    """
+    for line in lines:
+        ip, domain = line.split('\t', 1)
+        if ':' in ip:
+            continue
+        yield f"{domain} := {ip}"
+
+def fqdn_lookup_entries(records_paths, stats):
+    """
+    將多個 zone 的已排序記錄檔合併為單一查詢用 Key/Value 條目 (rpz_blacklist_fqdn_kv)，每個鍵只出現一次。
+    鍵正規化為小寫：完整域名 (example.com) 或通配符後綴 (.example.com)，供 iRule 以 class match -value equals
+    依序查詢完整名稱與各層後綴；值為動作鍵 (passthru/nxdomain/nodata 或 Landing IP)。
+    同一鍵出現多次時，依 zone 列表順序由第一個 zone 決定 (RPZ 優先順序)；同一 zone 內依 LOOKUP_ACTION_RANKS 選擇，
+    其次 IPv4 Landing IP，最後 IPv6 Landing IP。涵蓋整個 zone 的通配符 (*.zone) 無法以後綴鍵表示，會略過。
+    stats 累計 'shadowed' (被較高優先順序覆蓋的條目) 與 'skipped' (略過的條目) 數量。
+    """
+    sorter = ExternalSorter()
+    try:
+        for zone_rank, records_path in enumerate(records_paths):
+            for line in iter_record_lines(records_path):
+                key, domain = line.split('\t', 1)
+                domain = domain.lower()
+                if domain == '.':
+                    stats['skipped'] += 1
+                    continue
+                action_rank = LOOKUP_ACTION_RANKS.get(key, 4 if ':' in key else 3)
+                sorter.add(f"{domain}\t{zone_rank:04d}{action_rank}\t{key}")
+        previous = None
+        # 同一鍵的條目排序後相鄰，且優先順序最高者在最前面
+        for line in sorter.iter_sorted():
+            domain, _, key = line.split('\t')
+            if domain == previous:
+                stats['shadowed'] += 1
+                continue
+            previous = domain
+            yield f"{domain} := {key}"
+    finally:
+        sorter.close()
+
+def registrable_domain(domain):
+    """
+    取得域名的可註冊域名 (a.example.com → example.com，a.example.com.tw → example.com.tw)，通配符條目 (.example.com) 相同。
+    不使用公共後綴列表，只以 SECOND_LEVEL_LABELS 判斷國碼頂級域名下的第二層。
+    """
+    labels = domain.strip('.').lower().split('.')
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+def domain_shard(domain, shard_count):
+    """
+    依可註冊域名的 CRC32 決定域名所屬的分片 (0 到 shard_count - 1)。
+    同一可註冊域名下的域名與通配符條目固定在同一分片，分片成員不會因其他域名的增減而變動。
+    """
+    return zlib.crc32(registrable_domain(domain).encode('utf-8')) % shard_count
+
+def prune_wildcard_covered(domains, stats):
+    """
+    移除已被同一列表中通配符條目涵蓋的域名 (class match ends_with 下 .example.com 已涵蓋 a.example.com)。
+    域名反轉後排序，被涵蓋的域名會緊接在通配符條目之後，單次掃描即可找出；排序使用 ExternalSorter，記憶體用量有上限。
+    依反轉字串順序產生保留的域名，並在 stats['pruned'] 累計移除的數量。
+    """
+    sorter = ExternalSorter()
+    try:
+        for domain in domains:
+            sorter.add(domain[::-1])
+        covering = None
+        for reversed_domain in sorter.iter_sorted():
+            if covering is not None and reversed_domain.startswith(covering):
+                stats['pruned'] += 1
+                continue
+            covering = reversed_domain if len(reversed_domain) > 1 and reversed_domain.endswith('.') else None
+            yield reversed_domain[::-1]
+    finally:
+        sorter.close()
+
+def write_domain_list(domains, output_file):
+    """寫出單一 Landing IP 域名列表檔案 (依設定移除被通配符涵蓋的域名)，回傳移除的域名數"""
+    if not PRUNE_WILDCARD_COVERED_DOMAINS:
+        write_domains_file(domains, output_file)
+        return 0
+    stats = {'pruned': 0}
+    write_domains_file(prune_wildcard_covered(domains, stats), output_file)
+    if stats['pruned']:
+        logger.info(f"{output_file}: 移除 {stats['pruned']} 筆已被通配符條目涵蓋的域名")
+    return stats['pruned']
+
+def write_sharded_domain_files(domains, name_base):
+    """
+    依 domain_shard 將一個 Landing IP 的域名列表拆分為 DATAGROUP_SHARD_COUNT 個檔案 (<name_base>_s<k>.txt)。
+    域名先依原順序分流到各分片的暫存檔 (位於 ZONE_STATE_DIR)，再逐一寫出，記憶體用量不隨列表大小增加；
+    沒有域名的分片也會寫出空檔案，F5 上的分片 Data Group 數量固定。回傳移除的域名數。
+    """
+    pruned = 0
+    os.makedirs(ZONE_STATE_DIR, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        shard_files = [stack.enter_context(tempfile.TemporaryFile(mode='w+', encoding='utf-8', dir=ZONE_STATE_DIR))
+                       for _ in range(DATAGROUP_SHARD_COUNT)]
+        for domain in domains:
+            shard_files[domain_shard(domain, DATAGROUP_SHARD_COUNT)].write(domain + '\n')
+        for shard, shard_file in enumerate(shard_files):
+            shard_file.seek(0)
+            pruned += write_domain_list((line[:-1] for line in shard_file),
+                                        os.path.join(OUTPUT_DIR, f"{name_base}_s{shard}.txt"))
+    return pruned
+
+def render_fqdn_zone_files(zone, records_path, output_file_kv):
+    """從已排序的記錄檔串流產生此 zone 的各 IPv4 Landing IP 域名列表檔案與 Key/Value 檔案"""
+    zone_prefix = zone.rstrip('.').replace('.', '_')
+    zone_pruned = 0
+    # 為每個 IP 地址創建一個單獨的域名列表檔案 (ends_with 格式)
+    # 記錄檔依 Landing IP 排序，同一 IP 的域名是連續的，可逐組寫出
+    for ip, group in itertools.groupby(iter_record_lines(records_path), key=lambda line: line.split('\t', 1)[0]):
+        if not is_ipv4_address(ip):
+            # nxdomain/nodata/passthru 與 IPv6 Landing IP 沒有對應的 dg_ip_map 條目 (iRule 只以 IPv4 Landing IP 回應)，
+            # 只寫入 Key/Value 檔案，不產生域名列表檔案
+            continue
+        ip_filename = datagroup_key_part(ip)
+        domains = (line.split('\t', 1)[1] for line in group)
+        if DATAGROUP_SHARD_COUNT > 1:
+            zone_pruned += write_sharded_domain_files(domains, f"{zone_prefix}_{ip_filename}")
+        else:
+            zone_pruned += write_domain_list(domains, os.path.join(OUTPUT_DIR, f"{zone_prefix}_{ip_filename}.txt"))
+    if PRUNE_WILDCARD_COVERED_DOMAINS:
+        logger.info(f"Zone {zone} 的域名列表共移除 {zone_pruned} 筆已被通配符條目涵蓋的域名")
+    write_datagroup_file(fqdn_kv_entries(iter_record_lines(records_path)), output_file_kv)
+
+def merged_record_lines(records_paths):
+    """以多路合併讀取多個已排序記錄檔，並移除重複的記錄"""
+    return unique_sorted(heapq.merge(*(iter_record_lines(path) for path in records_paths)))
+
+def zone_render_config(kind):
+    """影響 zone 輸出檔案組成與內容的設定，記錄於 zone 同步狀態的 'render_config'，與上次產生輸出時不同則重新產生"""
+    if kind == 'fqdn':
+        return {'version': ZONE_STATE_VERSION, 'shard_count': DATAGROUP_SHARD_COUNT, 'prune': PRUNE_WILDCARD_COVERED_DOMAINS}
+    return {'version': ZONE_STATE_VERSION, 'aggregate': AGGREGATE_IP_NETWORKS}
+
+def zone_output_files(kind, zone_name, state):
+    """zone 應有的輸出檔案: Key/Value (或 IP) 檔案，以及各 IPv4 Landing IP 的域名列表 (或其分片)"""
+    zone_prefix = zone_name.rstrip('.').replace('.', '_')
+    if kind != 'fqdn':
+        return [os.path.join(OUTPUT_DIR, f"{zone_prefix}_ip.txt")]
+    output_files = [os.path.join(OUTPUT_DIR, f"{zone_prefix}_fqdn_kv.txt")]
+    for ip in sorted(state.get('landing_ips') or {}):
+        if not is_ipv4_address(ip):
+            continue
+        name_base = f"{zone_prefix}_{datagroup_key_part(ip)}"
+        if DATAGROUP_SHARD_COUNT > 1:
+            output_files.extend(os.path.join(OUTPUT_DIR, f"{name_base}_s{shard}.txt") for shard in range(DATAGROUP_SHARD_COUNT))
+        else:
+            output_files.append(os.path.join(OUTPUT_DIR, f"{name_base}.txt"))
+    return output_files
+
+def is_ipv6_key_part(key_part):
+    """判斷 datagroup_key_part 轉換後的字串是否來自 IPv6 位址"""
+    try:
+        ipaddress.IPv6Address(key_part.replace('_', ':'))
+        return True
+    except ValueError:
+        return False
+
+def remove_stale_domain_lists(zone_name):
+    """
+    刪除此 zone 不符合目前設定的域名列表檔案 (連同 .gz 與差異檔)，避免繼續被提供與列入輸出清單：
+    啟用分片後的未分片檔案、停用分片或減少分片數後多餘的分片，以及非 IPv4 動作鍵的舊檔案 (nxdomain、IPv6 Landing IP 等)。
+    """
+    zone_prefix = zone_name.rstrip('.').replace('.', '_')
+    pattern = re.compile(rf"^{re.escape(zone_prefix)}_(.+?)(?:_s(\d+))?\.txt$")
+    delta_dir = os.path.join(OUTPUT_DIR, DELTA_DIR_NAME)
+    for entry in os.scandir(OUTPUT_DIR):
+        match = pattern.match(entry.name)
+        if not match:
+            continue
+        key, shard = match.groups()
+        if is_ipv4_address(key.replace('_', '.')):
+            if DATAGROUP_SHARD_COUNT > 1 and shard is not None and int(shard) < DATAGROUP_SHARD_COUNT:
+                continue
+            if DATAGROUP_SHARD_COUNT <= 1 and shard is None:
+                continue
+        elif key not in ('nxdomain', 'nodata', 'passthru') and not is_ipv6_key_part(key):
+            continue
+        for path in (entry.path, entry.path + ".gz"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            http_file_cache.invalidate(path)
+        if os.path.isdir(delta_dir):
+            for delta_entry in os.scandir(delta_dir):
+                if delta_entry.name.startswith(entry.name + "."):
+                    os.remove(delta_entry.path)
+        logger.info(f"已刪除不再使用的域名列表檔案: {entry.path}")
+
+def render_zone_files(kind, zone_name, zone_changed, state):
+    """
+    產生單一 zone 自己的輸出檔案。SOA 序號未變更、輸出設定 (zone_render_config) 與上次相同且應有的輸出檔案都在時略過。
+    回傳是否重新產生了輸出。
+    """
+    records_path = zone_records_path(kind, zone_name)
+    output_files = zone_output_files(kind, zone_name, state)
+    if (not zone_changed and state.get('render_config') == zone_render_config(kind)
+            and all(os.path.exists(output_file) for output_file in output_files)):
+        return False
+    if kind == 'fqdn':
+        render_fqdn_zone_files(zone_name, records_path, output_files[0])
+        remove_stale_domain_lists(zone_name)
+    else:
+        write_datagroup_file(ip_output_entries(iter_record_lines(records_path)), output_files[0])
+    return True
+
+def _zone_timeout_handler(signum, frame):
+    raise ZoneTimeoutError(f"處理時間超過 {ZONE_TIMEOUT} 秒")
+
+def disarm_zone_timeout():
+    """
+    取消目前 zone 的 ZONE_TIMEOUT 計時。逾時只用於中斷傳輸與解析，寫入記錄檔、同步狀態或輸出檔案前須先呼叫，
+    避免寫到一半時被中斷而留下半套用的 zone 或暫存檔。
+    """
+    global zone_timeout_armed
+    if zone_timeout_armed:
+        signal.alarm(0)
+        zone_timeout_armed = False
+
+def sync_zone_job(kind, zone_name):
+    """
+    在工作行程中同步單一 zone (傳輸、解析、排序) 並產生該 zone 自己的輸出檔案。
+    每個 zone 只寫入自己的記錄檔與輸出檔，合併檔案由主行程在所有 zone 完成後產生。
+    回傳 {'state': 同步狀態或 None, 'changed': 是否有變更, 'outputs': 本 zone 寫出的輸出清單條目, 'metrics': 各階段指標}。
+    """
+    global output_manifest_updates, zone_metrics, zone_timeout_armed
+    parent_updates = output_manifest_updates
+    parent_metrics = zone_metrics
+    output_manifest_updates = {}
+    zone_metrics = {}
+    started = time.perf_counter()
+    use_alarm = bool(ZONE_TIMEOUT) and hasattr(signal, 'SIGALRM') and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _zone_timeout_handler)
+        signal.alarm(int(ZONE_TIMEOUT))
+        zone_timeout_armed = True
+    try:
+        logger.info(f"處理 {'FQDN' if kind == 'fqdn' else 'IP'} zone: {zone_name}")
+        zone_state, zone_changed = sync_zone(kind, zone_name)
+        disarm_zone_timeout()
+        if zone_state and zone_state['record_count']:
+            with timed_stage(zone_metrics, 'write_seconds'):
+                rendered = render_zone_files(kind, zone_name, zone_changed, zone_state)
+            if rendered and zone_state.get('render_config') != zone_render_config(kind):
+                zone_state['render_config'] = zone_render_config(kind)
+                save_zone_state(kind, zone_name, zone_state)
+        zone_metrics['files_changed'] = sum(1 for entry in output_manifest_updates.values() if entry['changed'])
+        zone_metrics['total_seconds'] = time.perf_counter() - started
+        zone_metrics['peak_rss_bytes'] = peak_rss_bytes()
+        return {'state': zone_state, 'changed': zone_changed, 'outputs': output_manifest_updates, 'metrics': zone_metrics}
+    finally:
+        if use_alarm:
+            disarm_zone_timeout()
+            signal.signal(signal.SIGALRM, previous_handler)
+        output_manifest_updates = parent_updates
+        zone_metrics = parent_metrics
+
+def sync_zones(jobs):
+    """
+    同步多個 zone。jobs 為 (zone 類型, zone 名稱) 列表。
+    ZONE_WORKERS 大於 1 時以行程池並行處理 (傳輸與解析可同時使用多個 CPU 核心)，
+    回傳 {(zone 類型, zone 名稱): 同步結果}；處理失敗的 zone 沿用上次同步的記錄。
+    """
+    results = {}
+    if ZONE_WORKERS > 1 and len(jobs) > 1:
+        workers = min(ZONE_WORKERS, len(jobs))
+        logger.info(f"以 {workers} 個工作行程並行處理 {len(jobs)} 個 zone...")
+        # 主行程此時已有 HTTP 伺服器、長輪詢與 NOTIFY 等執行緒，fork 可能把它們持有的鎖 (包含 logging 的鎖) 複製到工作行程，
+        # 因此改由乾淨的 forkserver 行程建立工作行程
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as executor:
+            futures = {executor.submit(sync_zone_job, kind, zone_name): (kind, zone_name) for kind, zone_name in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                kind, zone_name = futures[future]
+                try:
+                    results[(kind, zone_name)] = future.result()
+                except Exception as e:
+                    logger.error(f"處理 zone {zone_name} 時發生錯誤: {e}", exc_info=not isinstance(e, ZoneTransferError))
+    else:
+        for kind, zone_name in jobs:
+            try:
+                results[(kind, zone_name)] = sync_zone_job(kind, zone_name)
+            except Exception as e:
+                logger.error(f"處理 zone {zone_name} 時發生錯誤: {e}", exc_info=not isinstance(e, ZoneTransferError))
+
+    for kind, zone_name in jobs:
+        result = results.get((kind, zone_name))
+        if result is None:
+            zone_states.pop((kind, zone_name), None)
+            state = load_zone_state(kind, zone_name)
+            if state:
+                logger.warning(f"Zone {zone_name} 本週期處理失敗，將沿用上次同步的記錄 (SOA 序號: {state['serial']})")
+            results[(kind, zone_name)] = {'state': state, 'changed': False, 'metrics': {'sync_mode': 'failed'}}
+        else:
+            # 工作行程中的狀態更新與寫出的輸出檔案不會反映到主行程，需在此同步
+            if result['state'] is not None:
+                zone_states[(kind, zone_name)] = result['state']
+            output_manifest_updates.update(result.get('outputs', {}))
+    return results
+
+def process_fqdn_zones(zones=None, zone_results=None):
     """
     處理 FQDN 類型的 RPZ zones
     按 IP 地址分組創建域名列表，並保持 zone 信息
     同時監控指定 zone 的 Landing IP 變化，並可選擇自動更新 known_landing_ips.txt
+    zone_results 為 sync_zones 的結果；未提供時自行同步 zones。
     """
     global known_landing_ips # 允許修改全域變數
-    zones = read_zone_list(FQDN_ZONE_LIST_FILE)
+    if zones is None:
+        zones = read_zone_names(FQDN_ZONE_LIST_FILE)
     if not zones:
         logger.warning(f"沒有在 {FQDN_ZONE_LIST_FILE} 中找到 zones")
         return
+    if zone_results is None:
+        zone_results = sync_zones([('fqdn', zone) for zone in zones])
 
-    all_kv_entries = []
-    # 在處理所有 FQDN zone 之前，先載入一次 known_landing_ips
-    # 這樣可以確保在比較時，known_landing_ips 是最新的（如果上個週期有更新）
-    # 但更重要的是，run_conversion_cycle 每次開始時會呼叫 load_known_landing_ips()
+    zone_records_paths = []
+    # run_conversion_cycle 每次開始時會呼叫 load_known_landing_ips()
     # 所以這裡的 known_landing_ips 應該是當前週期的初始狀態
 
+    # 依 zone 列表順序處理各 zone 的同步結果 (各 zone 的輸出檔案已在 sync_zone_job 中產生)
+    diff_started = time.perf_counter()
     for zone in zones:
-        if not zone.endswith('.'):
-            logger.warning(f"Zone '{zone}' 在 {FQDN_ZONE_LIST_FILE} 中缺少結尾的點，已自動添加。")
-            zone = zone + "."
-        logger.info(f"處理 FQDN zone: {zone}")
-        zone_data = query_zone_data(zone)
-        if not zone_data:
+        zone_state = zone_results[('fqdn', zone)]['state']
+        if zone_state is None:
             logger.warning(f"無法獲取 zone 資料: {zone}")
             continue
-        ip_grouped_entries, current_zone_landing_ips = parse_fqdn_records(zone_data, zone)
+        # 只有 IPv4 Landing IP 需要監控 (iRule 以 A 記錄回應)，nxdomain 等 CNAME 策略動作鍵與 IPv6 位址不列入
+        current_zone_landing_ips = {ip for ip in zone_state['landing_ips'] if is_ipv4_address(ip)}
 
         if zone == MONITORED_ZONE:
             logger.info(f"開始檢查監控的 Zone '{MONITORED_ZONE}' 的 Landing IP...")
@@ -443,86 +1942,340 @@ def process_fqdn_zones():
             if not newly_found_ips and not disappeared_ips:
                 logger.info(f"Zone '{MONITORED_ZONE}' 的 Landing IP 與已知清單一致，無需操作。")
 
-        if ip_grouped_entries:
-            zone_kv_entries = []
-            # 為每個 IP 地址創建一個單獨的域名列表檔案 (ends_with 格式)
-            # 這裡的 ip_grouped_entries 是基於 *當前*從 DNS 拉取的資料，所以只會包含有效的 Landing IP
-            for ip, domains in ip_grouped_entries.items():
-                if not domains: continue
-                ip_filename = ip.replace(".", "_")
-                zone_prefix = zone.rstrip('.').replace('.', '_')
-                output_file_domain_list = os.path.join(OUTPUT_DIR, f"{zone_prefix}_{ip_filename}.txt")
-                write_domains_file(domains, output_file_domain_list)
-                for domain in domains:
-                    key = str(domain).strip()
-                    value = str(ip).strip()
-                    if not (key.startswith('"') and key.endswith('"')) and (' ' in key or key.startswith('.') or '*' in key):
-                         key = f'"{key}"'
-                    zone_kv_entries.append(f"{key} := {value}")
-            output_file_kv = os.path.join(OUTPUT_DIR, f"{zone.rstrip('.').replace('.', '_')}_fqdn_kv.txt")
-            write_datagroup_file(zone_kv_entries, output_file_kv)
-            all_kv_entries.extend(zone_kv_entries)
+        if zone_state['record_count']:
+            zone_records_paths.append(zone_records_path('fqdn', zone))
         else:
              logger.info(f"Zone {zone} 沒有解析到任何有效的 A 記錄，跳過檔案生成。")
 
-    if all_kv_entries:
+    stages = cycle_metrics['stages']
+    stages['landing_ip_diff'] = stages.get('landing_ip_diff', 0) + time.perf_counter() - diff_started
+
+    if zone_records_paths:
         merged_output_file_kv = os.path.join(OUTPUT_DIR, "rpz_blacklist_fqdn_kv.txt")
-        write_datagroup_file(list(set(all_kv_entries)), merged_output_file_kv)
+        stats = {'shadowed': 0, 'skipped': 0}
+        with timed_stage(stages, 'fqdn_merged_write'):
+            write_datagroup_file(fqdn_lookup_entries(zone_records_paths, stats), merged_output_file_kv, delta=True)
+        logger.info(f"{merged_output_file_kv}: {stats['shadowed']} 筆條目被較高優先順序的 zone 或動作覆蓋，"
+                    f"{stats['skipped']} 筆涵蓋整個 zone 的通配符條目略過")
     else:
         logger.info("沒有找到任何 FQDN 記錄來創建合併的 Key/Value 檔案。")
 
-def process_ip_zones():
-    """處理 IP 類型的 RPZ zones，並將所有記錄合併到一個檔案"""
-    zones = read_zone_list(IP_ZONE_LIST_FILE)
+def process_ip_zones(zones=None, zone_results=None):
+    """
+    處理 IP 類型的 RPZ zones，並將所有記錄合併到一個檔案
+    zone_results 為 sync_zones 的結果；未提供時自行同步 zones。
+    """
+    if zones is None:
+        zones = read_zone_names(IP_ZONE_LIST_FILE)
     if not zones:
         logger.warning(f"沒有在 {IP_ZONE_LIST_FILE} 中找到 zones")
         return
-    all_entries = set()
+    if zone_results is None:
+        zone_results = sync_zones([('ip', zone) for zone in zones])
+    zone_records_paths = []
     for zone in zones:
-        if not zone.endswith('.'):
-            logger.warning(f"Zone '{zone}' 在 {IP_ZONE_LIST_FILE} 中缺少結尾的點，已自動添加。")
-            zone = zone + "."
-        logger.info(f"處理 IP zone: {zone}")
-        zone_data = query_zone_data(zone)
-        if not zone_data:
+        zone_state = zone_results[('ip', zone)]['state']
+        if zone_state is None:
             logger.warning(f"無法獲取 zone 資料: {zone}")
             continue
-        entries = parse_ip_records(zone_data, zone)
-        if not entries:
+        if not zone_state['record_count']:
             logger.warning(f"在 zone {zone} 中沒有找到有效的 IP 記錄")
             continue
-        all_entries.update(entries)
-        output_file = os.path.join(OUTPUT_DIR, f"{zone.rstrip('.').replace('.', '_')}_ip.txt")
-        write_datagroup_file(entries, output_file)
-    if all_entries:
+        zone_records_paths.append(zone_records_path('ip', zone))
+    if zone_records_paths:
         merged_output_file = os.path.join(OUTPUT_DIR, "rpzip_blacklist.txt")
-        write_datagroup_file(list(all_entries), merged_output_file)
+        write_datagroup_file(ip_output_entries(merged_record_lines(zone_records_paths)), merged_output_file)
     else:
         logger.info("沒有找到任何 IP 記錄來創建合併的 IP 黑名單檔案。")
 
+class FileBytesCache:
+    """
+    HTTP 伺服器使用的小檔案記憶體快取 (LRU)。以 (inode, 修改時間, 大小) 判斷快取是否仍有效，
+    輸出檔案以 os.replace 替換後 inode 必定改變，即使寫入發生在工作行程中也不會提供舊內容；
+    同一行程內的寫入另外透過 invalidate() 立即釋放舊內容。
+    """
+    def __init__(self, max_file_size, max_total_size):
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self.entries = OrderedDict() # 路徑 -> ((inode, 修改時間, 大小), 內容)
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, f, stat_result):
+        """回傳檔案內容 (bytes)，檔案超過單檔上限時回傳 None；未命中時從已開啟的檔案 f 讀取並放入快取"""
+        if stat_result.st_size > self.max_file_size:
+            return None
+        key = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        path = os.path.abspath(path)
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached and cached[0] == key:
+                self.entries.move_to_end(path)
+                return cached[1]
+        f.seek(0)
+        data = f.read()
+        if len(data) != stat_result.st_size:
+            return data
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = (key, data)
+            self.total_size += len(data)
+            while self.total_size > self.max_total_size and self.entries:
+                self._remove(next(iter(self.entries)))
+        return data
+
+    def invalidate(self, path):
+        with self.lock:
+            self._remove(os.path.abspath(path))
+
+    def _remove(self, path):
+        cached = self.entries.pop(path, None)
+        if cached:
+            self.total_size -= len(cached[1])
+
+http_file_cache = FileBytesCache(HTTP_CACHE_MAX_FILE_SIZE, HTTP_CACHE_MAX_TOTAL_SIZE)
+
+def parse_byte_range(range_header, size):
+    """
+    解析單一範圍的 Range 標頭 (bytes=a-b、bytes=a-、bytes=-n)。
+    回傳 (start, end)；無法解析或多重範圍時回傳 None (忽略 Range 提供完整內容)；範圍無法滿足時回傳 'unsatisfiable'。
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        suffix_length = int(match.group(2))
+        if suffix_length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(0, size - suffix_length), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else None
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    if end is None:
+        end = size - 1
+    return start, min(end, size - 1)
+
+def accepts_gzip(accept_encoding):
+    """判斷 Accept-Encoding 是否接受 gzip (q=0 視為不接受)"""
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            q = re.search(r'q\s*=\s*([0-9.]+)', params)
+            if not q or float(q.group(1) or 0) > 0:
+                return True
+    return False
+
+def file_etag(name, stat_result):
+    """輸出檔案的 ETag：清單中的 SHA-256 與檔案相符時使用內容雜湊，否則使用修改時間與大小的弱 ETag"""
+    entry = output_manifest['files'].get(name)
+    if entry and entry.get('size') == stat_result.st_size and entry.get('mtime_ns') == stat_result.st_mtime_ns:
+        return entry['sha256'], False
+    return f"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}", True
+
+def etag_matches(header_value, etag):
+    """比對 If-None-Match / If-Range 標頭與 ETag (弱比較)"""
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag.removeprefix('W/'):
+            return True
+    return False
+
 class CustomHTTPRequestHandler(SimpleHTTPRequestHandler):
-    """自定義 HTTP 請求處理器，用於提供特定目錄下的檔案"""
+    """
+    自定義 HTTP 請求處理器，用於提供特定目錄下的檔案。
+    METRICS_PATH 提供 Prometheus 格式的轉換週期指標。
+    一般檔案支援 ETag/If-None-Match、Last-Modified/If-Modified-Since (未變更時回應 304)、
+    預先壓縮的 .gz 版本 (Accept-Encoding: gzip) 與單一範圍的 Range 請求。
+    小檔案由記憶體快取提供，大檔案以 os.sendfile 由核心直接從檔案複製到 socket。
+    """
+    extensions_map = {**SimpleHTTPRequestHandler.extensions_map, '.txt': 'text/plain; charset=utf-8'}
+
     def __init__(self, *args, **kwargs):
+        self.remaining_bytes = None
         super().__init__(*args, directory=OUTPUT_DIR, **kwargs)
     def log_message(self, format, *args):
         pass 
-    def end_headers(self):
+
+    def send_head(self):
+        if METRICS_PATH and self.path.split('?', 1)[0] == METRICS_PATH:
+            return self.send_metrics()
+        if GENERATION_PATH and self.path.split('?', 1)[0] == GENERATION_PATH:
+            return self.send_generation()
         path = self.translate_path(self.path)
-        if path.endswith(".txt") and os.path.isfile(path):
+        if os.path.basename(path).startswith('.'):
+            # 寫入中的暫存檔不對外提供
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        if not os.path.isfile(path):
+            return super().send_head()
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            stat_result = os.fstat(f.fileno())
+            opaque_tag, weak = file_etag(os.path.basename(path), stat_result)
+            content_encoding = None
+            if ENABLE_GZIP_VARIANTS and accepts_gzip(self.headers.get('Accept-Encoding', '')):
+                try:
+                    gzip_f = open(path + ".gz", 'rb')
+                    gzip_stat = os.fstat(gzip_f.fileno())
+                    if gzip_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+                        f.close()
+                        f, content_encoding = gzip_f, 'gzip'
+                        opaque_tag += "-gzip"
+                    else:
+                        gzip_f.close()
+                except OSError:
+                    pass
+            etag = f'{"W/" if weak else ""}"{opaque_tag}"'
+            last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+            served_stat = os.fstat(f.fileno())
+            size = served_stat.st_size
+
+            if self.is_not_modified(etag, stat_result.st_mtime):
+                f.close()
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                if ENABLE_GZIP_VARIANTS:
+                    self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return None
+
+            byte_range = None
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and (not if_range or etag_matches(if_range, etag) or if_range.strip() == last_modified):
+                byte_range = parse_byte_range(range_header, size)
+            if byte_range == 'unsatisfiable':
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            start, end = byte_range if byte_range else (0, size - 1)
+            self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+            self.send_header("Content-type", self.guess_type(path))
+            if content_encoding:
+                self.send_header("Content-Encoding", content_encoding)
+            if ENABLE_GZIP_VARIANTS:
+                self.send_header("Vary", "Accept-Encoding")
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            if self.command == 'HEAD':
+                return f
+            cached = http_file_cache.get(f.name, f, served_stat)
+            if cached is not None:
+                f.close()
+                f = io.BytesIO(cached)
+            f.seek(start)
+            self.remaining_bytes = end - start + 1
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def send_metrics(self):
+        """以 Prometheus 文字格式回應最近一次轉換週期的指標"""
+        body = render_prometheus_metrics(last_cycle_summary).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.remaining_bytes = len(body)
+        return io.BytesIO(body)
+
+    def send_generation(self):
+        """
+        回應目前的輸出清單 generation。帶 ?after=N 時為長輪詢: generation 仍為 N 就等待，
+        直到清單更新或等待 timeout 秒 (上限 GENERATION_POLL_MAX_WAIT) 後回應當時的 generation。
+        """
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            after = int(query['after'][0]) if 'after' in query else None
+            wait = min(float(query.get('timeout', [GENERATION_POLL_MAX_WAIT])[0]), GENERATION_POLL_MAX_WAIT)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Invalid after/timeout")
+            return None
+        if after is not None:
+            with generation_changed:
+                generation_changed.wait_for(lambda: output_manifest.get('generation', 0) != after, timeout=max(wait, 0))
+        body = json.dumps({'generation': output_manifest.get('generation', 0),
+                           'updated_at': output_manifest.get('updated_at')}).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.remaining_bytes = len(body)
+        return io.BytesIO(body)
+
+    def is_not_modified(self, etag, mtime):
+        """依 If-None-Match (優先) 或 If-Modified-Since 判斷用戶端的快取是否仍有效"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
             try:
-                self.send_header('Content-type', 'text/plain; charset=utf-8')
-            except ConnectionAbortedError:
-                 pass
-            except Exception as e:
-                 logger.warning(f"設置 Content-Type for {self.path} 時出錯: {e}")
-        super().end_headers()
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def copyfile(self, source, outputfile):
+        if self.remaining_bytes is None:
+            return super().copyfile(source, outputfile)
+        if isinstance(source, io.BytesIO):
+            start = source.tell()
+            outputfile.write(source.getbuffer()[start:start + self.remaining_bytes])
+            return
+        offset = source.tell()
+        remaining = self.remaining_bytes
+        if hasattr(os, 'sendfile'):
+            outputfile.flush()
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(self.connection.fileno(), source.fileno(), offset, remaining)
+                    if sent == 0:
+                        return
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError as e:
+                if remaining != self.remaining_bytes:
+                    raise
+                logger.debug(f"os.sendfile 無法使用 ({e})，改為一般複製")
+        source.seek(offset)
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
 
 def start_http_server():
-    """啟動 HTTP 伺服器"""
+    """啟動 HTTP 伺服器 (每個連線由獨立執行緒處理，多台 F5 同時下載時不會互相排隊)"""
     server_address = ('0.0.0.0', HTTP_PORT)
     try:
-        HTTPServer.allow_reuse_address = True
-        httpd = HTTPServer(server_address, CustomHTTPRequestHandler)
+        ThreadingHTTPServer.allow_reuse_address = True
+        httpd = ThreadingHTTPServer(server_address, CustomHTTPRequestHandler)
         logger.info(f"啟動 HTTP 伺服器在端口 {HTTP_PORT}，提供來自 '{OUTPUT_DIR}' 目錄的檔案")
         httpd.serve_forever()
     except OSError as e:
@@ -533,18 +2286,353 @@ def start_http_server():
     except Exception as e:
         logger.error(f"HTTP 伺服器發生錯誤: {e}", exc_info=True)
 
-def run_conversion_cycle():
-    """執行一次完整的轉換流程"""
+def verify_request_tsig(message, header, tsig, key):
+    """驗證 DNS 請求 (例如 NOTIFY) 的 TSIG 簽章，失敗時拋出 ZoneTransferError"""
+    if tsig is None:
+        raise ZoneTransferError("請求缺少 TSIG 簽章")
+    if tsig['name'].lower() != key['name'].lower() or tsig['algorithm_name'].lower() != key['algorithm_name']:
+        raise ZoneTransferError(f"TSIG 金鑰名稱或演算法不符: {tsig['name']} / {tsig['algorithm_name']}")
+    stripped = (struct.pack('!H', tsig['original_id']) + message[2:10]
+                + struct.pack('!H', header['arcount'] - 1) + message[12:tsig['offset']])
+    expected = hmac.new(key['secret'], stripped + tsig_variables(key, tsig['time_signed'], tsig['fudge'],
+                                                                  tsig['error'], tsig['other']), key['digestmod']).digest()
+    if not hmac.compare_digest(expected, tsig['mac']):
+        raise ZoneTransferError("TSIG 簽章驗證失敗 (BADSIG)")
+    if abs(time.time() - tsig['time_signed']) > tsig['fudge']:
+        raise ZoneTransferError("TSIG 時間超出允許範圍 (BADTIME)")
+
+def notify_zone_jobs(zone_name):
+    """回傳被通知的 zone 對應的 (zone 類型, zone 名稱) 列表，不在 zone 列表中時為空列表"""
+    zone_name = zone_name.lower()
+    jobs = []
+    for kind, list_file in (('fqdn', FQDN_ZONE_LIST_FILE), ('ip', IP_ZONE_LIST_FILE)):
+        for zone in read_zone_names(list_file):
+            if zone.lower() == zone_name:
+                jobs.append((kind, zone))
+    return jobs
+
+def handle_notify_message(message, source_ip):
+    """
+    處理一則 DNS NOTIFY 請求 (RFC 1996)，將被通知的 zone 加入待同步集合。
+    回傳要送回的 NOTIFY 回應 (不是 NOTIFY 請求或格式錯誤時回傳 None)。
+    """
+    try:
+        header, _, tsig = parse_dns_message(message)
+        flags = header['flags']
+        if flags & 0x8000 or (flags >> 11) & 0xF != DNS_OPCODE_NOTIFY or struct.unpack('!H', message[4:6])[0] != 1:
+            return None
+        zone_name, question_end = decode_dns_name(message, 12)
+        question_end += 4
+    except (ZoneTransferError, struct.error, IndexError, UnicodeDecodeError):
+        logger.warning(f"收到來自 {source_ip} 的無效 DNS 訊息，忽略。")
+        return None
+
+    key = parse_tsig_key(TSIG_KEY_STRING)
+    rcode = 0
+    if source_ip not in NOTIFY_ALLOWED_SOURCES:
+        logger.warning(f"拒絕來自未授權來源 {source_ip} 的 NOTIFY (zone {zone_name})")
+        rcode = DNS_RCODE_REFUSED
+    elif key and (tsig is not None or NOTIFY_REQUIRE_TSIG):
+        try:
+            verify_request_tsig(message, header, tsig, key)
+        except ZoneTransferError as e:
+            logger.warning(f"拒絕來自 {source_ip} 的 NOTIFY (zone {zone_name}): {e}")
+            rcode = DNS_RCODE_NOTAUTH
+    elif NOTIFY_REQUIRE_TSIG:
+        logger.warning(f"NOTIFY_REQUIRE_TSIG 已啟用但未設定 TSIG_KEY_STRING，拒絕 zone {zone_name} 的 NOTIFY")
+        rcode = DNS_RCODE_REFUSED
+
+    if rcode == 0:
+        jobs = notify_zone_jobs(zone_name)
+        if jobs:
+            logger.info(f"收到來自 {source_ip} 的 NOTIFY: zone {zone_name}，排入立即同步。")
+            with notify_condition:
+                notified_zones.update(jobs)
+                notify_capable_zones.update(jobs)
+                notify_condition.notify_all()
+        else:
+            logger.info(f"收到來自 {source_ip} 的 NOTIFY: zone {zone_name} 不在 zone 列表中，忽略。")
+
+    # 回應: 相同 ID、QR=1、opcode NOTIFY、AA=1，附上原問題區段
+    response_flags = 0x8000 | (DNS_OPCODE_NOTIFY << 11) | 0x0400 | rcode
+    response = struct.pack('!HHHHHH', header['id'], response_flags, 1, 0, 0, 0) + message[12:question_end]
+    if key and tsig is not None and rcode == 0:
+        response = tsig_sign_message(response, key, tsig['mac'])[0]
+    return response
+
+class NotifyUDPHandler(socketserver.BaseRequestHandler):
+    """以 UDP 接收 DNS NOTIFY"""
+    def handle(self):
+        message, sock = self.request
+        response = handle_notify_message(message, self.client_address[0])
+        if response:
+            sock.sendto(response, self.client_address)
+
+class NotifyTCPHandler(socketserver.BaseRequestHandler):
+    """以 TCP 接收 DNS NOTIFY (每則訊息前有 2 bytes 長度)"""
+    def handle(self):
+        self.request.settimeout(30)
+        try:
+            while True:
+                length = struct.unpack('!H', recv_exact(self.request, 2))[0]
+                response = handle_notify_message(recv_exact(self.request, length), self.client_address[0])
+                if response:
+                    self.request.sendall(struct.pack('!H', len(response)) + response)
+        except (ZoneTransferError, OSError):
+            pass
+
+def start_notify_listener():
+    """在背景執行緒啟動 UDP 與 TCP 的 NOTIFY 監聽，回傳是否成功 (失敗時由定期輪詢取代)"""
+    servers = []
+    try:
+        socketserver.ThreadingUDPServer.allow_reuse_address = True
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        servers.append(socketserver.ThreadingUDPServer((NOTIFY_LISTEN_ADDRESS, NOTIFY_LISTEN_PORT), NotifyUDPHandler))
+        servers.append(socketserver.ThreadingTCPServer((NOTIFY_LISTEN_ADDRESS, NOTIFY_LISTEN_PORT), NotifyTCPHandler))
+    except OSError as e:
+        logger.error(f"NOTIFY 監聽啟動失敗 ({NOTIFY_LISTEN_ADDRESS}:{NOTIFY_LISTEN_PORT}): {e}，改為每 {UPDATE_INTERVAL} 秒輪詢。")
+        for server in servers:
+            server.server_close()
+        return False
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"NOTIFY 監聽已啟動於 {NOTIFY_LISTEN_ADDRESS}:{NOTIFY_LISTEN_PORT} (UDP/TCP)，"
+                f"接受來源: {', '.join(NOTIFY_ALLOWED_SOURCES)}")
+    return True
+
+def wait_for_notified_zones(timeout):
+    """等待 NOTIFY 最多 timeout 秒，回傳待同步的 (zone 類型, zone 名稱) 集合 (逾時時為空集合)"""
+    with notify_condition:
+        if not notify_condition.wait_for(lambda: notified_zones, timeout=max(timeout, 0)):
+            return set()
+    # 稍候片刻，讓同一次上游更新的多個 NOTIFY 合併為一次轉換
+    time.sleep(NOTIFY_DEBOUNCE_SECONDS)
+    with notify_condition:
+        jobs = set(notified_zones)
+        notified_zones.clear()
+    return jobs
+
+def build_cycle_summary(started_at, duration, success, files_changed, zone_results):
+    """彙整本週期的各階段耗時與各 zone 的指標為可序列化為 JSON 的 dict"""
+    zones = []
+    for (kind, zone_name), result in sorted((zone_results or {}).items()):
+        metrics = result.get('metrics') or {}
+        parse_seconds = metrics.get('parse_seconds', 0)
+        records_parsed = metrics.get('records_parsed', 0)
+        zones.append({
+            'zone': zone_name,
+            'kind': kind,
+            'sync_mode': metrics.get('sync_mode', 'unknown'),
+            'record_count': (result.get('state') or {}).get('record_count', 0),
+            'soa_query_seconds': round(metrics.get('soa_query_seconds', 0), 4),
+            'transfer_bytes': metrics.get('transfer_bytes', 0),
+            'transfer_seconds': round(metrics.get('transfer_seconds', 0), 4),
+            'records_parsed': records_parsed,
+            'parse_seconds': round(parse_seconds, 4),
+            'records_per_second': round(records_parsed / parse_seconds, 1) if parse_seconds else 0,
+            'write_seconds': round(metrics.get('write_seconds', 0), 4),
+            'files_changed': metrics.get('files_changed', 0),
+            'total_seconds': round(metrics.get('total_seconds', 0), 4),
+            'peak_rss_bytes': metrics.get('peak_rss_bytes'),
+        })
+    return {
+        'started_at': started_at,
+        'duration_seconds': round(duration, 4),
+        'success': success,
+        'generation': output_manifest.get('generation', 0),
+        'files_changed': files_changed,
+        'stages': {stage: round(seconds, 4) for stage, seconds in cycle_metrics['stages'].items()},
+        'peak_rss_bytes': {'main': peak_rss_bytes(),
+                           'workers': peak_rss_bytes(resource.RUSAGE_CHILDREN) if resource else None},
+        'zones': zones,
+    }
+
+def record_cycle_summary(summary):
+    """保存最近一次週期的指標供 /metrics 使用，並寫入日誌與 CYCLE_SUMMARY_FILE"""
+    global last_cycle_summary
+    last_cycle_summary = summary
+    cycle_counters['total'] += 1
+    if not summary['success']:
+        cycle_counters['failed'] += 1
+    summary_json = json.dumps(summary, ensure_ascii=False)
+    logger.info(f"週期指標: {summary_json}")
+    if summary['duration_seconds'] > UPDATE_INTERVAL:
+        slowest = max(summary['stages'].items(), key=lambda item: item[1], default=('N/A', 0))
+        logger.warning(f"轉換週期用時 {summary['duration_seconds']:.2f} 秒，超過更新間隔 {UPDATE_INTERVAL} 秒 "
+                       f"(最耗時的階段: {slowest[0]} {slowest[1]:.2f} 秒)")
+    if CYCLE_SUMMARY_FILE:
+        try:
+            with open(CYCLE_SUMMARY_FILE, 'a', encoding='utf-8') as f:
+                f.write(summary_json + "\n")
+        except Exception as e:
+            logger.error(f"寫入週期指標檔案 {CYCLE_SUMMARY_FILE} 時發生錯誤: {e}")
+
+def prometheus_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus_metrics(summary):
+    """將週期指標摘要轉為 Prometheus 文字格式"""
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f'{key}="{prometheus_label_value(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric("rpz_cycles_total", "counter", "Conversion cycles completed.", [({}, cycle_counters['total'])])
+    metric("rpz_cycles_failed_total", "counter", "Conversion cycles that raised an error.", [({}, cycle_counters['failed'])])
+    if summary:
+        metric("rpz_cycle_duration_seconds", "gauge", "Duration of the last conversion cycle.", [({}, summary['duration_seconds'])])
+        metric("rpz_cycle_stage_duration_seconds", "gauge", "Duration of each stage of the last conversion cycle.",
+               [({'stage': stage}, seconds) for stage, seconds in summary['stages'].items()])
+        metric("rpz_cycle_files_changed", "gauge", "Output files replaced in the last conversion cycle.", [({}, summary['files_changed'])])
+        metric("rpz_output_generation", "gauge", "Output manifest generation.", [({}, summary['generation'])])
+        metric("rpz_cycle_success", "gauge", "Whether the last conversion cycle completed without error.", [({}, int(summary['success']))])
+        metric("rpz_peak_rss_bytes", "gauge", "Peak resident set size.",
+               [({'process': process}, value) for process, value in summary['peak_rss_bytes'].items()])
+        zones = summary['zones']
+        zone_labels = lambda zone: {'zone': zone['zone'], 'kind': zone['kind']}
+        metric("rpz_zone_sync_mode", "gauge", "How the zone was synchronised in the last cycle.",
+               [({**zone_labels(zone), 'mode': zone['sync_mode']}, 1) for zone in zones])
+        metric("rpz_zone_stage_duration_seconds", "gauge", "Per-zone stage duration in the last cycle.",
+               [({**zone_labels(zone), 'stage': stage}, zone[f"{stage}_seconds"])
+                for zone in zones for stage in ('soa_query', 'transfer', 'parse', 'write', 'total')])
+        metric("rpz_zone_transfer_bytes", "gauge", "Bytes received by the zone transfer in the last cycle.",
+               [(zone_labels(zone), zone['transfer_bytes']) for zone in zones])
+        metric("rpz_zone_records_parsed", "gauge", "Records parsed in the last cycle.",
+               [(zone_labels(zone), zone['records_parsed']) for zone in zones])
+        metric("rpz_zone_parse_records_per_second", "gauge", "Parse throughput in the last cycle.",
+               [(zone_labels(zone), zone['records_per_second']) for zone in zones])
+        metric("rpz_zone_records", "gauge", "Records currently stored for the zone.",
+               [(zone_labels(zone), zone['record_count']) for zone in zones])
+        metric("rpz_zone_files_changed", "gauge", "Output files of the zone replaced in the last cycle.",
+               [(zone_labels(zone), zone['files_changed']) for zone in zones])
+        metric("rpz_zone_peak_rss_bytes", "gauge", "Peak RSS of the process that handled the zone.",
+               [(zone_labels(zone), zone['peak_rss_bytes']) for zone in zones])
+    return "\n".join(lines) + "\n"
+
+class ZoneScheduler:
+    """
+    各 zone 獨立排程。成功同步後依 ZONE_REFRESH_OVERRIDES 或 SOA refresh 決定下次同步時間，
+    失敗時依 SOA retry 指數退避；相繼到期 (ZONE_SCHEDULE_COALESCE_SECONDS 內) 的 zone 合併為一次轉換。
+    min_interval 為 NOTIFY 監聽啟用時的最短輪詢間隔，只套用於曾收到 NOTIFY 的 zone (ZONE_REFRESH_OVERRIDES 不受限制)；
+    上游未設定 also-notify 時各 zone 維持依 SOA refresh 輪詢。
+    """
+    def __init__(self, min_interval=0):
+        self.min_interval = min_interval
+        self.next_due = {} # (zone 類型, zone 名稱) -> 下次同步的 time.monotonic()
+        self.failures = {} # (zone 類型, zone 名稱) -> 連續失敗次數
+
+    def update_jobs(self, jobs):
+        """依目前的 zone 列表加入新的 zone (立即到期) 並移除已不在列表中的 zone"""
+        now = time.monotonic()
+        for job in jobs:
+            self.next_due.setdefault(job, now)
+        for job in set(self.next_due) - set(jobs):
+            del self.next_due[job]
+            self.failures.pop(job, None)
+
+    def seconds_until_due(self):
+        if not self.next_due:
+            return UPDATE_INTERVAL
+        return max(0, min(self.next_due.values()) - time.monotonic())
+
+    def due_jobs(self):
+        """回傳已到期的 zone，並一併帶入即將到期的 zone 以合併為一次轉換"""
+        horizon = time.monotonic() + ZONE_SCHEDULE_COALESCE_SECONDS
+        if self.seconds_until_due() > 0:
+            return set()
+        return {job for job, due in self.next_due.items() if due <= horizon}
+
+    def refresh_interval(self, job, state):
+        override = ZONE_REFRESH_OVERRIDES.get(job[1])
+        if override:
+            return override
+        timers = (state or {}).get('soa_timers') or {}
+        interval = min(max(timers.get('refresh', UPDATE_INTERVAL), ZONE_SCHEDULE_MIN_INTERVAL), ZONE_SCHEDULE_MAX_INTERVAL)
+        with notify_condition:
+            notify_capable = job in notify_capable_zones
+        return max(interval, self.min_interval) if notify_capable else interval
+
+    def record_result(self, job, result, notified=False):
+        """
+        依同步結果排定下次同步時間；result 為 None (整個週期失敗) 或同步模式為 failed 時視為失敗。
+        notified 表示此次同步由 NOTIFY 觸發；輪詢時才發現 zone 已變更代表 NOTIFY 未送達，該 zone 恢復依 SOA refresh 輪詢。
+        """
+        if job not in self.next_due:
+            return
+        sync_mode = ((result or {}).get('metrics') or {}).get('sync_mode')
+        if self.min_interval and not notified and sync_mode in ('ixfr', 'axfr'):
+            with notify_condition:
+                missed = job in notify_capable_zones
+                notify_capable_zones.discard(job)
+            if missed:
+                logger.warning(f"Zone {job[1]} 已變更但未收到 NOTIFY，恢復依 SOA refresh 輪詢 (請確認上游 also-notify 設定)。")
+        state = (result or {}).get('state')
+        if result is None or state is None or sync_mode == 'failed':
+            failures = self.failures[job] = self.failures.get(job, 0) + 1
+            retry = ((state or {}).get('soa_timers') or {}).get('retry', ZONE_SCHEDULE_MIN_INTERVAL)
+            delay = min(retry * 2 ** (failures - 1), ZONE_RETRY_BACKOFF_MAX)
+            logger.warning(f"Zone {job[1]} 同步失敗 (連續 {failures} 次)，{delay} 秒後重試。")
+        else:
+            self.failures.pop(job, None)
+            delay = self.refresh_interval(job, state)
+            logger.info(f"Zone {job[1]} 下次同步於 {delay} 秒後。")
+        self.next_due[job] = time.monotonic() + delay
+
+def run_conversion_cycle(zone_jobs=None):
+    """
+    執行一次轉換流程，並記錄各階段耗時與各 zone 的指標，回傳各 zone 的同步結果 (發生錯誤時回傳 None)。
+    zone_jobs 為要同步的 (zone 類型, zone 名稱) 集合 (排程到期或收到 NOTIFY)，指定時只同步這些 zone，
+    其餘 zone 直接沿用上次同步的記錄，且只重新產生有 zone 同步的類型的合併檔案。
+    """
     start_time = time.time()
-    logger.info(f"開始轉換流程，時間: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    started_at = datetime.now()
+    logger.info(f"開始轉換流程，時間: {started_at.strftime('%Y-%m-%d %H:%M:%S')}")
+    cycle_metrics['stages'] = stages = {}
+    zone_results = None
+    files_changed = 0
+    success = False
     try:
-        load_known_landing_ips() # 確保每次循環開始時載入最新的已知 IP
-        process_fqdn_zones()
-        process_ip_zones()
+        with timed_stage(stages, 'load_state'):
+            load_known_landing_ips() # 確保每次循環開始時載入最新的已知 IP
+            load_output_manifest()
+        fqdn_zones = read_zone_names(FQDN_ZONE_LIST_FILE)
+        ip_zones = read_zone_names(IP_ZONE_LIST_FILE)
+        jobs = [('fqdn', zone) for zone in fqdn_zones] + [('ip', zone) for zone in ip_zones]
+        if zone_jobs is not None:
+            sync_jobs = [job for job in jobs if job in zone_jobs]
+            if len(sync_jobs) < len(jobs):
+                logger.info(f"本次只同步 {len(sync_jobs)}/{len(jobs)} 個 zone: {', '.join(zone for _, zone in sync_jobs)}")
+        else:
+            sync_jobs = jobs
+        # FQDN 與 IP zones 一起放入工作池並行同步，全部完成後再依序產生合併檔案
+        with timed_stage(stages, 'zone_sync'):
+            zone_results = sync_zones(sync_jobs)
+        for kind, zone in jobs:
+            if (kind, zone) not in zone_results:
+                zone_results[(kind, zone)] = {'state': load_zone_state(kind, zone), 'changed': False,
+                                              'metrics': {'sync_mode': 'skipped'}}
+        synced_kinds = {kind for kind, _ in sync_jobs}
+        if 'fqdn' in synced_kinds:
+            process_fqdn_zones(fqdn_zones, zone_results)
+        if 'ip' in synced_kinds:
+            with timed_stage(stages, 'ip_merged_write'):
+                process_ip_zones(ip_zones, zone_results)
+        with timed_stage(stages, 'manifest'):
+            files_changed = save_output_manifest()
         elapsed_time = time.time() - start_time
         logger.info(f"轉換完成，用時: {elapsed_time:.2f} 秒")
+        success = True
     except Exception as e:
         logger.error(f"轉換過程中發生錯誤: {e}", exc_info=True)
+    record_cycle_summary(build_cycle_summary(started_at.isoformat(timespec='seconds'), time.time() - start_time,
+                                             success, files_changed, zone_results))
+    return zone_results if success else None
 
 def main():
     """主函數"""
@@ -558,18 +2646,33 @@ def main():
 
     load_known_landing_ips() # 初始載入
     logger.info(f"初始載入的已知 Landing IP: {known_landing_ips}")
+    load_output_manifest() # 讓 /_generation 在初始轉換完成前即回應既有的 generation
     http_thread = threading.Thread(target=start_http_server, daemon=True)
     http_thread.start()
     time.sleep(2)
     if not http_thread.is_alive() and HTTP_PORT != 0:
          logger.warning("HTTP 伺服器線程未能成功啟動。請檢查日誌中的錯誤訊息。")
-    logger.info("執行初始轉換...")
-    run_conversion_cycle()
-    logger.info("初始轉換完成。")
+    notify_enabled = ENABLE_NOTIFY_LISTENER and start_notify_listener()
+    scheduler = ZoneScheduler(NOTIFY_SAFETY_POLL_INTERVAL if notify_enabled else 0)
+    logger.info("執行初始轉換 (之後各 zone 依 SOA refresh 各自排程)...")
     while True:
-        logger.info(f"等待 {UPDATE_INTERVAL} 秒後進行下一次轉換...")
-        time.sleep(UPDATE_INTERVAL)
-        run_conversion_cycle()
+        # 每次都重新讀取 zone 列表，新增的 zone 立即同步，移除的 zone 不再排程
+        scheduler.update_jobs([('fqdn', zone) for zone in read_zone_names(FQDN_ZONE_LIST_FILE)]
+                              + [('ip', zone) for zone in read_zone_names(IP_ZONE_LIST_FILE)])
+        jobs = scheduler.due_jobs()
+        if jobs:
+            notified_jobs = wait_for_notified_zones(0)
+        else:
+            wait_seconds = scheduler.seconds_until_due()
+            logger.info(f"等待 NOTIFY 或 {wait_seconds:.0f} 秒後下一個 zone 到期..." if notify_enabled
+                        else f"等待 {wait_seconds:.0f} 秒後下一個 zone 到期...")
+            notified_jobs = wait_for_notified_zones(wait_seconds)
+            if not notified_jobs:
+                continue
+        jobs |= notified_jobs
+        zone_results = run_conversion_cycle(jobs)
+        for job in jobs:
+            scheduler.record_result(job, zone_results.get(job) if zone_results else None, job in notified_jobs)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,111 @@
+"""
+rpz_converter.py 中 rpz-ip 觸發名稱解碼 (decode_ip_trigger) 與 IP 條目彙整 (aggregate_ip_entries) 的測試。
+執行: python -m pytest -q test_ip_triggers.py (或 python -m unittest test_ip_triggers)
+"""
+import ipaddress
+import random
+import unittest
+
+import rpz_converter
+
+ZONE = "rpzip.test."
+
+
+def decoded_network(ip_segment):
+    """將 decode_ip_trigger 的結果轉為 ipaddress 網段，方便比對"""
+    version, value, prefix_len = rpz_converter.decode_ip_trigger(ip_segment)
+    address = ipaddress.IPv4Address(value) if version == 4 else ipaddress.IPv6Address(value)
+    return ipaddress.ip_network(f"{address}/{prefix_len}")
+
+
+def expected_collapse(entries):
+    """以 ipaddress.collapse_addresses 計算彙整結果 (IPv4 在前)，轉為 host/network 條目"""
+    networks = {4: [], 6: []}
+    for entry in entries:
+        network = ipaddress.ip_network(entry.split(' ', 1)[1], strict=False)
+        networks[network.version].append(network)
+    result = []
+    for version in (4, 6):
+        for network in ipaddress.collapse_addresses(networks[version]):
+            if network.prefixlen == network.max_prefixlen:
+                result.append(f"host {network.network_address}")
+            else:
+                result.append(f"network {network}")
+    return result
+
+
+class DecodeIpTriggerTestCase(unittest.TestCase):
+
+    def test_ipv4_triggers(self):
+        self.assertEqual(decoded_network("32.4.3.2.1"), ipaddress.ip_network("1.2.3.4/32"))
+        self.assertEqual(decoded_network("24.0.2.0.192"), ipaddress.ip_network("192.0.2.0/24"))
+        self.assertEqual(decoded_network("0.0.0.0.0"), ipaddress.ip_network("0.0.0.0/0"))
+        # 主機位元不為 0 時直接清除 (strict=False)
+        self.assertEqual(decoded_network("24.55.2.0.192"), ipaddress.ip_network("192.0.2.0/24"))
+
+    def test_invalid_ipv4_triggers(self):
+        for ip_segment in ("33.4.3.2.1", "32.256.3.2.1", "32.4.3.2", "32.-1.3.2.1", "32.+4.3.2.1", "32.1_0.3.2.1",
+                           "32.0004.3.2.1", "32.4.3.2.٤", "²4.0.2.0.192", "x.4.3.2.1", "-8.4.3.2.1", "32", ""):
+            with self.subTest(ip_segment=ip_segment):
+                self.assertIsNone(rpz_converter.decode_ip_trigger(ip_segment))
+
+    def test_ipv6_triggers(self):
+        self.assertEqual(decoded_network("128.1.zz.db8.2001"), ipaddress.ip_network("2001:db8::1/128"))
+        self.assertEqual(decoded_network("48.zz.db8.2001"), ipaddress.ip_network("2001:db8::/48"))
+        self.assertEqual(decoded_network("128.8.7.6.5.4.3.2.1"), ipaddress.ip_network("1:2:3:4:5:6:7:8/128"))
+        self.assertEqual(decoded_network("64.zz.4.3.2.1"), ipaddress.ip_network("1:2:3:4::/64"))
+        self.assertEqual(decoded_network("128.1.zz"), ipaddress.ip_network("::1/128"))
+        self.assertEqual(decoded_network("56.FFFF.zz.DB8.2001"), ipaddress.ip_network("2001:db8::/56"))
+
+    def test_invalid_ipv6_triggers(self):
+        for ip_segment in ("128.-1.zz.2001", "128.+f.zz.2001", "128.1_0.zz.2001", "128. 1.zz.2001", "128.12345.zz.2001",
+                           "128.g.zz.2001", "128.٤.zz.2001", "128..zz.2001", "129.1.zz.2001", "128.1.zz.zz.2001",
+                           "128.1.zz.8.7.6.5.4.3.2", "128.8.7.6.5.4.3.2", "128.9.8.7.6.5.4.3.2.1"):
+            with self.subTest(ip_segment=ip_segment):
+                self.assertIsNone(rpz_converter.decode_ip_trigger(ip_segment))
+
+    def test_parse_ip_records_skips_invalid_triggers(self):
+        records = [rpz_converter.ZoneRecord(f"{segment}.rpz-ip.{ZONE}", 60, 'CNAME', '.')
+                   for segment in ("32.4.3.2.1", "128.-1.zz.2001", "128.1_0.zz.2001", "48.zz.db8.2001")]
+        self.assertEqual(list(rpz_converter.parse_ip_records(records, ZONE)),
+                         ["host 1.2.3.4", "network 2001:db8::/48"])
+
+
+class AggregateIpEntriesTestCase(unittest.TestCase):
+
+    def assert_same_as_ipaddress(self, entries):
+        self.assertEqual(list(rpz_converter.aggregate_ip_entries(entries)), expected_collapse(entries))
+
+    def test_adjacent_and_overlapping(self):
+        self.assert_same_as_ipaddress(["host 10.0.0.0", "host 10.0.0.1", "network 10.0.0.2/31", "network 10.0.0.0/24",
+                                       "network 10.0.1.0/24", "host 192.0.2.255", "host 192.0.3.0",
+                                       "network 2001:db8::/33", "network 2001:db8:8000::/33", "host ::1"])
+
+    def test_edges_of_address_space(self):
+        self.assert_same_as_ipaddress(["host 0.0.0.0", "host 255.255.255.255", "network 0.0.0.0/1",
+                                       "network 128.0.0.0/1", "host ::", "host ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"])
+
+    def test_random_entries_match_collapse_addresses(self):
+        rng = random.Random(20240501)
+        for _ in range(20):
+            entries = []
+            for _ in range(300):
+                if rng.random() < 0.8:
+                    prefix_len = rng.choice([32, 32, 31, 30, 28, 24, 22])
+                    network = ipaddress.ip_network(f"{ipaddress.IPv4Address(rng.getrandbits(12) << 20 | rng.getrandbits(10))}"
+                                                   f"/{prefix_len}", strict=False)
+                else:
+                    prefix_len = rng.choice([128, 127, 126, 120, 64])
+                    network = ipaddress.ip_network(f"{ipaddress.IPv6Address(0x20010db8 << 96 | rng.getrandbits(12))}"
+                                                   f"/{prefix_len}", strict=False)
+                entries.append(f"host {network.network_address}" if network.prefixlen == network.max_prefixlen
+                               else f"network {network}")
+            self.assert_same_as_ipaddress(entries)
+
+    def test_skips_unparseable_entries(self):
+        self.assertEqual(list(rpz_converter.aggregate_ip_entries(["host 1.2.3.4", "host nonsense", "network 1.2.3.5/40"])),
+                         ["host 1.2.3.4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
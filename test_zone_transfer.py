@@ -0,0 +1,223 @@
+"""
+rpz_converter.py 內建 AXFR/IXFR 客戶端的測試。
+以本機 TCP 上的簡易權威伺服器代替 DNS_SERVER，回應可分成多則訊息，並可選擇以 TSIG 簽署 (部分訊息不簽章或竄改 MAC)。
+執行: python -m pytest -q test_zone_transfer.py (或 python -m unittest test_zone_transfer)
+"""
+import base64
+import hashlib
+import hmac
+import socket
+import struct
+import threading
+import time
+import unittest
+from unittest import mock
+
+import rpz_converter
+
+ZONE = "rpz.test."
+KEY_NAME = "transfer-key."
+KEY_SECRET = b"0123456789abcdef0123456789abcdef"
+KEY_STRING = f"hmac-sha256:{KEY_NAME}:{base64.b64encode(KEY_SECRET).decode('ascii')}"
+
+
+def wire_name(name):
+    wire = b""
+    for label in name.rstrip('.').split('.'):
+        if label:
+            wire += bytes([len(label)]) + label.encode('ascii')
+    return wire + b"\x00"
+
+
+def rr(name, rtype, rdata, ttl=60):
+    return wire_name(name) + struct.pack('!HHIH', rtype, 1, ttl, len(rdata)) + rdata
+
+
+def soa(serial):
+    return rr(ZONE, 6, wire_name("ns.rpz.test.") + wire_name("admin.rpz.test.") + struct.pack('!IIIII', serial, 3600, 600, 86400, 60))
+
+
+def a(name, ip):
+    return rr(f"{name}.{ZONE}", 1, socket.inet_aton(ip))
+
+
+def cname(name, target):
+    return rr(f"{name}.{ZONE}", 5, wire_name(target))
+
+
+class FakeAuthoritativeServer:
+    """
+    只處理單一 zone 的 AXFR/IXFR (TCP)。
+    responses: 查詢類型 (252 AXFR / 251 IXFR) -> 回應的記錄 (wire 格式) 列表，依 per_message 筆分成多則訊息。
+    sign_every: 啟用 TSIG 時每幾則訊息簽章一次 (最後一則一律簽章，除非 unsigned_last)；corrupt_mac 竄改第一個 MAC。
+    hold_open: 回應後不關閉連線，直到 close() (用於確認客戶端不會等待更多訊息)。
+    """
+
+    def __init__(self, responses, per_message=2, key=False, sign_every=1, corrupt_mac=False, unsigned_last=False,
+                 hold_open=False):
+        self.responses = responses
+        self.per_message = per_message
+        self.key = key
+        self.sign_every = sign_every
+        self.corrupt_mac = corrupt_mac
+        self.unsigned_last = unsigned_last
+        self.hold_open = hold_open
+        self.queries = []
+        self.closed = threading.Event()
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.closed.set()
+        self.listener.close()
+
+    def serve(self):
+        try:
+            conn, _ = self.listener.accept()
+        except OSError:
+            return
+        with conn:
+            length = struct.unpack('!H', rpz_converter.recv_exact(conn, 2))[0]
+            query = rpz_converter.recv_exact(conn, length)
+            for message in self.answer(query):
+                conn.sendall(struct.pack('!H', len(message)) + message)
+            if self.hold_open:
+                self.closed.wait(10)
+
+    def answer(self, query):
+        header, _, tsig = rpz_converter.parse_dns_message(query)
+        question_end = rpz_converter.decode_dns_name(query, 12)[1] + 4
+        qtype = struct.unpack('!H', query[question_end - 4:question_end - 2])[0]
+        self.queries.append(qtype)
+        records = self.responses[qtype]
+        chunks = [records[i:i + self.per_message] for i in range(0, len(records), self.per_message)]
+        prior_mac = tsig['mac'] if tsig else b''
+        pending = b''
+        messages = []
+        for index, chunk in enumerate(chunks):
+            message = (struct.pack('!HHHHHH', header['id'], 0x8400, 1, len(chunk), 0, 0)
+                       + query[12:question_end] + b''.join(chunk))
+            last = index == len(chunks) - 1
+            if self.key and ((index % self.sign_every == 0 and not last) or (last and not self.unsigned_last)):
+                message, prior_mac = self.sign(message, prior_mac, pending, index == 0, header['id'])
+                pending = b''
+            else:
+                pending += message
+            messages.append(message)
+        return messages
+
+    def sign(self, message, prior_mac, pending, first, original_id):
+        """依 RFC 8945 為回應訊息附加 TSIG (第一則涵蓋完整 TSIG 變數，其後只涵蓋時間與 fudge)"""
+        time_signed = int(time.time())
+        timers = struct.pack('!HIH', time_signed >> 32, time_signed & 0xFFFFFFFF, 300)
+        if first:
+            variables = (wire_name(KEY_NAME) + struct.pack('!HI', 255, 0) + wire_name("hmac-sha256.")
+                         + timers + struct.pack('!HH', 0, 0))
+        else:
+            variables = timers
+        digest_input = struct.pack('!H', len(prior_mac)) + prior_mac + pending + message + variables
+        mac = hmac.new(KEY_SECRET, digest_input, hashlib.sha256).digest()
+        if self.corrupt_mac:
+            mac = bytes([mac[0] ^ 0xFF]) + mac[1:]
+        rdata = (wire_name("hmac-sha256.") + timers + struct.pack('!H', len(mac)) + mac
+                 + struct.pack('!HHH', original_id, 0, 0))
+        arcount = struct.unpack('!H', message[10:12])[0]
+        signed = (message[:10] + struct.pack('!H', arcount + 1) + message[12:]
+                  + wire_name(KEY_NAME) + struct.pack('!HHIH', 250, 255, 0, len(rdata)) + rdata)
+        return signed, mac
+
+
+ZONE_BODY = [a("blocked.com", "34.102.218.71"), a("*.wild.net", "34.102.218.71"),
+             cname("nx.org", "."), a("other.com", "182.173.0.181"), a("last.com", "34.102.218.71")]
+
+
+class ZoneTransferTestCase(unittest.TestCase):
+
+    def start_server(self, responses, key=False, **kwargs):
+        server = FakeAuthoritativeServer(responses, key=key, **kwargs)
+        self.addCleanup(server.close)
+        patches = {'DNS_SERVER': '127.0.0.1', 'DNS_PORT': server.port, 'DNS_TRANSFER_TIMEOUT': 5,
+                   'ZONE_TRANSFER_CLIENT': 'native', 'TSIG_KEY_STRING': KEY_STRING if key else None}
+        for name, value in patches.items():
+            patcher = mock.patch.object(rpz_converter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return server
+
+    def test_axfr_across_messages(self):
+        server = self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]})
+        records = list(rpz_converter.native_zone_transfer(ZONE))
+        self.assertEqual(server.queries, [252])
+        self.assertEqual([record.rtype for record in records], ['SOA', 'A', 'A', 'CNAME', 'A', 'A', 'SOA'])
+        self.assertEqual(records[1], rpz_converter.ZoneRecord("blocked.com.rpz.test.", 60, 'A', "34.102.218.71"))
+        self.assertEqual(records[2].name, "*.wild.net.rpz.test.")
+        self.assertEqual(records[3].rdata, ".")
+        self.assertEqual(rpz_converter.soa_serial(records[0]), 10)
+
+    def test_ixfr_deltas(self):
+        response = ([soa(12), soa(10), a("blocked.com", "34.102.218.71"), soa(11), a("new.com", "34.102.218.71"),
+                     soa(11), soa(12), a("newer.com", "182.173.0.181"), soa(12)])
+        for per_message in (1, 3):
+            with self.subTest(per_message=per_message):
+                self.start_server({251: response}, per_message=per_message)
+                serial, deltas, full_records = rpz_converter.read_ixfr_response(
+                    rpz_converter.native_zone_transfer(ZONE, serial=10))
+                self.assertEqual(serial, 12)
+                self.assertIsNone(full_records)
+                self.assertEqual([([r.name for r in removed], [r.name for r in added]) for removed, added in deltas],
+                                 [(["blocked.com.rpz.test."], ["new.com.rpz.test."]),
+                                  ([], ["newer.com.rpz.test."])])
+
+    def test_ixfr_answered_as_axfr(self):
+        self.start_server({251: [soa(20)] + ZONE_BODY + [soa(20)]})
+        serial, deltas, full_records = rpz_converter.read_ixfr_response(
+            rpz_converter.native_zone_transfer(ZONE, serial=10))
+        self.assertEqual(serial, 20)
+        self.assertIsNone(deltas)
+        self.assertEqual([record.rtype for record in full_records], ['SOA', 'A', 'A', 'CNAME', 'A', 'A', 'SOA'])
+
+    def test_ixfr_up_to_date_single_soa(self):
+        # 伺服器回應單一 SOA 後不關閉連線，客戶端必須在第一則訊息後結束，而不是等待第二筆 SOA 直到逾時
+        self.start_server({251: [soa(10)]}, hold_open=True)
+        started = time.monotonic()
+        serial, deltas, full_records = rpz_converter.read_ixfr_response(
+            rpz_converter.native_zone_transfer(ZONE, serial=10))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual((serial, deltas, full_records), (10, [], None))
+
+    def test_ixfr_newer_serial_in_single_record_first_message(self):
+        # 第一則訊息只有一筆較新序號的 SOA 時是傳輸的開頭，需繼續讀取後續訊息
+        self.start_server({251: [soa(11), soa(10), soa(11), a("new.com", "34.102.218.71"), soa(11)]}, per_message=1)
+        serial, deltas, _ = rpz_converter.read_ixfr_response(rpz_converter.native_zone_transfer(ZONE, serial=10))
+        self.assertEqual(serial, 11)
+        self.assertEqual([[r.name for r in added] for _, added in deltas], [["new.com.rpz.test."]])
+
+    def test_tsig_signed_every_message(self):
+        self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]}, key=True)
+        self.assertEqual(len(list(rpz_converter.native_zone_transfer(ZONE))), 7)
+
+    def test_tsig_unsigned_intermediate_messages(self):
+        self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]}, key=True, per_message=1, sign_every=3)
+        self.assertEqual(len(list(rpz_converter.native_zone_transfer(ZONE))), 7)
+
+    def test_tsig_bad_mac(self):
+        self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]}, key=True, corrupt_mac=True)
+        with self.assertRaisesRegex(rpz_converter.ZoneTransferError, "BADSIG"):
+            list(rpz_converter.native_zone_transfer(ZONE))
+
+    def test_tsig_unsigned_last_message(self):
+        self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]}, key=True, unsigned_last=True)
+        with self.assertRaisesRegex(rpz_converter.ZoneTransferError, "未簽章"):
+            list(rpz_converter.native_zone_transfer(ZONE))
+
+    def test_tsig_missing_on_signed_request(self):
+        server = self.start_server({252: [soa(10)] + ZONE_BODY + [soa(10)]}, key=True)
+        server.key = False
+        with self.assertRaisesRegex(rpz_converter.ZoneTransferError, "缺少 TSIG"):
+            list(rpz_converter.native_zone_transfer(ZONE))
+
+
+if __name__ == "__main__":
+    unittest.main()